@@ -1,12 +1,16 @@
 import copy
+import itertools
 import json
+import operator
 from datetime import datetime
 
 import click
+import msgpack
 
 import pygit2
 
 from .diff import Diff
+from .diff_output import MSGPACK_DIFF_FORMAT
 from .exceptions import (
     NO_CHANGES,
     NO_TABLE,
@@ -14,7 +18,7 @@ from .exceptions import (
     NotFound,
     NotYetImplemented,
 )
-from .gpkg import hex_wkb_to_gpkg_geom
+from .gpkg import hex_wkb_to_gpkg_geom, wkb_to_gpkg_geom
 from .structure import RepositoryStructure
 from .timestamps import iso8601_utc_to_datetime, iso8601_tz_to_timedelta
 from .working_copy import WorkingCopy
@@ -30,13 +34,102 @@ def unjson_feature(dataset, d):
     return r
 
 
-def apply_patch(*, repo, commit, patch_file, allow_empty, **kwargs):
+def unmsgpack_feature(dataset, d):
+    if d is None:
+        return d
+    if dataset.geom_column_name and d[dataset.geom_column_name] is not None:
+        # msgpack features are already new dicts, so can be changed in place.
+        d[dataset.geom_column_name] = wkb_to_gpkg_geom(d[dataset.geom_column_name])
+    return d
+
+
+def _is_msgpack_map(first_byte):
+    # fixmap, map 16 or map 32 - a JSON patch starts with "{" or whitespace instead.
+    return 0x80 <= first_byte[0] <= 0x8F or first_byte[0] in (0xDE, 0xDF)
+
+
+def load_json_patch(data, patch_file):
+    """
+    Loads a JSON patch (see sno.show.patch_output_json) from the given binary file,
+    after the bytes which have already been read from it (data).
+
+    Returns (metadata, dataset_diffs, load_feature) - where metadata is the patch
+    metadata or None, dataset_diffs is an iterable of (dataset_path, change_records),
+    and load_feature(dataset, feature) converts a feature from the patch to a feature
+    that can be committed.
+    """
     try:
-        patch = json.load(patch_file)
+        patch = json.loads(data + patch_file.read())
         json_diff = patch['sno.diff/v1+hexwkb']
-    except (KeyError, json.JSONDecodeError):
+    except (KeyError, ValueError):
         raise click.FileError("Failed to parse JSON patch file")
 
+    def _records(ds_diff_dict):
+        for k, (v_old, v_new) in (ds_diff_dict.get('metaChanges') or {}).items():
+            yield ("META", k, v_old, v_new)
+        for change in ds_diff_dict['featureChanges']:
+            yield (None, None, change.get('-'), change.get('+'))
+
+    dataset_diffs = (
+        (ds_name, _records(ds_diff_dict)) for ds_name, ds_diff_dict in json_diff.items()
+    )
+    return patch.get('sno.patch/v1'), dataset_diffs, unjson_feature
+
+
+def load_msgpack_patch(data, patch_file):
+    """
+    Loads a msgpack patch (see sno.diff_output.diff_output_msgpack) from the given
+    binary file, after the bytes which have already been read from it (data).
+    Change records are read from the file as they are needed.
+
+    Returns the same as load_json_patch.
+    """
+    objects = _iter_msgpack(data, patch_file)
+    try:
+        header = next(objects)
+        if header["format"] != MSGPACK_DIFF_FORMAT:
+            raise ValueError(header["format"])
+    except (KeyError, TypeError, ValueError, StopIteration):
+        raise click.FileError("Failed to parse msgpack patch file")
+
+    def _tagged_records():
+        ds_name = None
+        for obj in objects:
+            if isinstance(obj, dict):
+                ds_name = obj["dataset"]
+                # so datasets without any changes are still yielded.
+                yield ds_name, None
+            else:
+                yield ds_name, obj
+
+    dataset_diffs = (
+        (ds_name, (record for _, record in group if record is not None))
+        for ds_name, group in itertools.groupby(
+            _tagged_records(), key=operator.itemgetter(0)
+        )
+    )
+    return header.get('sno.patch/v1'), dataset_diffs, unmsgpack_feature
+
+
+def _iter_msgpack(data, patch_file, chunk_size=65536):
+    unpacker = msgpack.Unpacker(raw=False)
+    try:
+        while data:
+            unpacker.feed(data)
+            yield from unpacker
+            data = patch_file.read(chunk_size)
+    except (ValueError, msgpack.UnpackException):
+        raise click.FileError("Failed to parse msgpack patch file")
+
+
+def apply_patch(*, repo, commit, patch_file, allow_empty, **kwargs):
+    # A msgpack patch starts with a map, and a JSON patch can't.
+    data = patch_file.read(1)
+    if data and _is_msgpack_map(data):
+        metadata, dataset_diffs, load_feature = load_msgpack_patch(data, patch_file)
+    else:
+        metadata, dataset_diffs, load_feature = load_json_patch(data, patch_file)
+
     rs = RepositoryStructure(repo)
     wc = WorkingCopy.open(repo)
     if not commit and not wc:
@@ -47,7 +140,7 @@ def apply_patch(*, repo, commit, patch_file, allow_empty, **kwargs):
         wc.check_not_dirty()
 
     diff = Diff(None)
-    for ds_name, ds_diff_dict in json_diff.items():
+    for ds_name, records in dataset_diffs:
         dataset = rs.get(ds_name)
         if dataset is None:
             raise NotFound(
@@ -55,23 +148,18 @@ def apply_patch(*, repo, commit, patch_file, allow_empty, **kwargs):
                 exit_code=NO_TABLE,
             )
 
-        meta_changes = ds_diff_dict.get('metaChanges', {})
-        if meta_changes:
-            raise NotYetImplemented(
-                "Patches containing schema changes are not yet handled"
-            )
-
-        feature_changes = ds_diff_dict['featureChanges']
-        if not feature_changes:
-            continue
-
         inserts = []
         updates = {}
         deletes = {}
         pk_name = dataset.primary_key
-        for change in feature_changes:
-            old = unjson_feature(dataset, change.get('-'))
-            new = unjson_feature(dataset, change.get('+'))
+        for change, key, old, new in records:
+            if change == "META":
+                raise NotYetImplemented(
+                    "Patches containing schema changes are not yet handled"
+                )
+
+            old = load_feature(dataset, old)
+            new = load_feature(dataset, new)
             if old and new:
                 # update
                 assert old[pk_name] == new[pk_name]
@@ -80,14 +168,14 @@ def apply_patch(*, repo, commit, patch_file, allow_empty, **kwargs):
                 deletes[old[pk_name]] = old
             else:
                 inserts.append(new)
-        diff += Diff(dataset, inserts=inserts, updates=updates, deletes=deletes)
+
+        if inserts or updates or deletes:
+            diff += Diff(dataset, inserts=inserts, updates=updates, deletes=deletes)
 
     if commit:
         if not diff and not allow_empty:
             raise NotFound("No changes to commit", exit_code=NO_CHANGES)
-        try:
-            metadata = patch['sno.patch/v1']
-        except KeyError:
+        if metadata is None:
             # Not all diffs are patches. If we're given a raw diff, we can't commit it properly
             raise click.UsageError(
                 "Patch contains no author information, and --no-commit was not supplied"
@@ -146,9 +234,10 @@ def apply_patch(*, repo, commit, patch_file, allow_empty, **kwargs):
         "such a commit. This option bypasses the safety"
     ),
 )
-@click.argument("patch_file", type=click.File('r', encoding="utf-8"))
+@click.argument("patch_file", type=click.File('rb'))
 def apply(ctx, **kwargs):
     """
-    Applies and commits the given JSON patch (as created by `sno show -o json`)
+    Applies and commits the given JSON or msgpack patch
+    (as created by `sno show -o json` or `sno show -o msgpack`)
     """
     apply_patch(repo=ctx.obj.repo, **kwargs)
@@ -0,0 +1,268 @@
+import hashlib
+import logging
+import re
+import time
+from pathlib import Path
+
+import apsw
+import pygit2
+
+
+L = logging.getLogger("sno.attribute_index")
+
+
+def _chunk(iterable, size):
+    """Generator. Yield successive lists of length <size> from iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class AttributeIndex:
+    """
+    Secondary index from column values to primary keys, for a single dataset.
+    Any number of the dataset's non-geometry columns can be indexed.
+
+    Stored as a SQLite database - one per dataset. For every indexed column we also
+    store the ID of the dataset tree it was built from, so that the index can be
+    brought up to date by applying the diff between that tree and a newer one,
+    rather than rebuilding it from scratch. The path of the dataset is stored too, and
+    an index of some other dataset is emptied when it's opened - its trees would be
+    of the wrong dataset.
+    """
+
+    # operator (as the user types it) -> SQL operator
+    OPERATORS = {
+        "=": "=",
+        "eq": "=",
+        "<": "<",
+        "lt": "<",
+        "<=": "<=",
+        "le": "<=",
+        ">": ">",
+        "gt": ">",
+        ">=": ">=",
+        "ge": ">=",
+        "between": "BETWEEN",
+    }
+
+    CHUNK_SIZE = 10000
+
+    # How long to wait for another process to finish writing to the index.
+    BUSY_TIMEOUT_MS = 10000
+
+    @classmethod
+    def for_dataset(cls, repo, dataset):
+        # Dataset paths can be nested, and their names aren't unique - so the file is
+        # named by a hash of the whole path.
+        index_dir = Path(repo.path) / "attribute-indexes"
+        index_dir.mkdir(exist_ok=True)
+        name = hashlib.sha256(dataset.path.encode("utf8")).hexdigest()
+        return cls(index_dir / f"{name}.sno-attridx", dataset.path)
+
+    def __init__(self, path, dataset_path):
+        self.path = path
+        self.dataset_path = dataset_path
+        self.db = apsw.Connection(str(path))
+        self.db.setbusytimeout(self.BUSY_TIMEOUT_MS)
+        dbcur = self.db.cursor()
+        dbcur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS info (
+                key TEXT PRIMARY KEY NOT NULL,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS indexed_columns (
+                column_name TEXT PRIMARY KEY NOT NULL,
+                tree TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                column_name TEXT NOT NULL,
+                value,
+                pk NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_value ON entries (column_name, value);
+            CREATE INDEX IF NOT EXISTS entries_pk ON entries (column_name, pk);
+            """
+        )
+        self._check_dataset_path(dbcur)
+
+    def _check_dataset_path(self, dbcur):
+        row = dbcur.execute(
+            "SELECT value FROM info WHERE key='dataset_path';"
+        ).fetchone()
+        if row is not None and row[0] == self.dataset_path:
+            return
+
+        with self.db:
+            if row is not None:
+                L.warning(
+                    "%s is an index of %s, not %s - emptying it",
+                    self.path,
+                    row[0],
+                    self.dataset_path,
+                )
+                dbcur.execute("DELETE FROM entries;")
+                dbcur.execute("DELETE FROM indexed_columns;")
+            dbcur.execute(
+                "INSERT OR REPLACE INTO info (key, value) VALUES ('dataset_path', ?);",
+                (self.dataset_path,),
+            )
+
+    def close(self):
+        self.db.close()
+
+    def indexed_tree(self, column):
+        """Returns the hex ID of the dataset tree that column was indexed at, or None."""
+        row = (
+            self.db.cursor()
+            .execute(
+                "SELECT tree FROM indexed_columns WHERE column_name=?;", (column,)
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def _check_column(self, dataset, column):
+        if column == dataset.geom_column_name:
+            raise ValueError(
+                f"Can't index geometry column {column} - use the spatial index"
+            )
+        column_names = [c["name"] for c in dataset.get_meta_item("sqlite_table_info")]
+        if column not in column_names:
+            raise ValueError(f"No column named {column} in {dataset.path}")
+
+    def build(self, dataset, column):
+        """(Re)builds the index for the given column from scratch."""
+        self._check_column(dataset, column)
+        t0 = time.monotonic()
+
+        count = 0
+        with self.db:
+            dbcur = self.db.cursor()
+            dbcur.execute("DELETE FROM entries WHERE column_name=?;", (column,))
+            rows = (
+                (column, value, pk)
+                for pk, value in dataset.feature_tuples([dataset.primary_key, column])
+            )
+            for chunk in _chunk(rows, self.CHUNK_SIZE):
+                dbcur.executemany(
+                    "INSERT INTO entries (column_name, value, pk) VALUES (?, ?, ?);",
+                    chunk,
+                )
+                count += len(chunk)
+            self._set_indexed_tree(dbcur, column, dataset.tree)
+
+        L.info(
+            "Indexed %s.%s: %d features in %0.3fs",
+            dataset.path,
+            column,
+            count,
+            time.monotonic() - t0,
+        )
+
+    def update(self, repo, dataset, column):
+        """
+        Brings the index for the given column up to date with the given dataset.
+        If the column has been indexed before, only the features that have changed since
+        are re-indexed. Otherwise, the index is built from scratch.
+        """
+        indexed_tree = self.indexed_tree(column)
+        if indexed_tree == dataset.tree.hex:
+            return
+
+        old_tree = repo.get(indexed_tree) if indexed_tree else None
+        if old_tree is None:
+            self.build(dataset, column)
+            return
+
+        self._check_column(dataset, column)
+        t0 = time.monotonic()
+        diff_index = old_tree.diff_to_tree(dataset.tree)
+
+        with self.db:
+            dbcur = self.db.cursor()
+            for d in diff_index.deltas:
+                if d.old_file and dataset.decode_path(d.old_file.path)[0] == "meta":
+                    continue
+                elif d.new_file and dataset.decode_path(d.new_file.path)[0] == "meta":
+                    continue
+
+                if d.status in (pygit2.GIT_DELTA_DELETED, pygit2.GIT_DELTA_MODIFIED):
+                    old_pk = dataset.decode_path_to_1pk(d.old_file.path)
+                    dbcur.execute(
+                        "DELETE FROM entries WHERE column_name=? AND pk=?;",
+                        (column, old_pk),
+                    )
+                if d.status in (pygit2.GIT_DELTA_ADDED, pygit2.GIT_DELTA_MODIFIED):
+                    blob = dataset.tree / d.new_file.path
+                    feature = dataset.get_feature_from_blob(blob)
+                    dbcur.execute(
+                        "INSERT INTO entries (column_name, value, pk) VALUES (?, ?, ?);",
+                        (column, feature[column], feature[dataset.primary_key]),
+                    )
+            self._set_indexed_tree(dbcur, column, dataset.tree)
+
+        L.info(
+            "Updated index %s.%s: %d changes in %0.3fs",
+            dataset.path,
+            column,
+            len(diff_index),
+            time.monotonic() - t0,
+        )
+
+    def _set_indexed_tree(self, dbcur, column, tree):
+        dbcur.execute(
+            "INSERT OR REPLACE INTO indexed_columns (column_name, tree) VALUES (?, ?);",
+            (column, tree.hex),
+        )
+
+    def lookup(self, column, op, *values):
+        """
+        Generator. Yields the primary keys of all features where `column op value` is true.
+        op is one of the OPERATORS, and `between` expects two values - the lower and
+        upper bounds, inclusive.
+        """
+        sql_op = self.OPERATORS[op]
+        if sql_op == "BETWEEN":
+            if len(values) != 2:
+                raise ValueError("between expects two values")
+            predicate = "value BETWEEN ? AND ?"
+        else:
+            if len(values) != 1:
+                raise ValueError(f"{op} expects one value")
+            predicate = f"value {sql_op} ?"
+
+        dbcur = self.db.cursor()
+        dbcur.execute(
+            f"SELECT pk FROM entries WHERE column_name=? AND {predicate} ORDER BY pk;",
+            (column, *values),
+        )
+        for (pk,) in dbcur:
+            yield pk
+
+
+def cast_column_value(dataset, column, value):
+    """
+    Casts a value supplied as text to the type stored in the given column,
+    so it compares correctly with the values in the index.
+    """
+    for col in dataset.get_meta_item("sqlite_table_info"):
+        if col["name"] == column:
+            col_type = col["type"].upper()
+            break
+    else:
+        raise ValueError(f"No column named {column} in {dataset.path}")
+
+    # https://www.sqlite.org/datatype3.html
+    # 3.1. Determination Of Column Affinity
+    if "INT" in col_type or "BOOL" in col_type:
+        return int(value)
+    elif re.search("REAL|FLOA|DOUB|NUMERIC|DECIMAL", col_type):
+        return float(value)
+    return value
@@ -12,6 +12,7 @@ from .exceptions import (
     NO_WORKING_COPY,
 )
 
+from .spatial_filter import BBoxType
 from .structure import RepositoryStructure
 from .structs import CommitWithReference
 from .working_copy import WorkingCopy
@@ -26,8 +27,27 @@ from .working_copy import WorkingCopy
 )
 @click.option("--path", type=click.Path(writable=True, dir_okay=False))
 @click.option("datasets", "--dataset", "-d", multiple=True)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=1,
+    help=(
+        "Number of processes to decode features with, when creating a new working "
+        "copy. Several datasets are written in parallel."
+    ),
+)
+@click.option(
+    "--bbox",
+    type=BBoxType(),
+    help=(
+        "Only check out features whose envelope intersects this bounding box, given "
+        "as MINX,MINY,MAXX,MAXY in the dataset's coordinate reference system. "
+        "Only used when creating a new working copy."
+    ),
+)
 @click.argument("refish", default=None, required=False)
-def checkout(ctx, branch, fmt, force, path, datasets, refish):
+def checkout(ctx, branch, fmt, force, path, datasets, jobs, bbox, refish):
     """ Switch branches or restore working tree files """
     repo_path = ctx.obj.repo_path
     repo = ctx.obj.repo
@@ -78,6 +98,11 @@ def checkout(ctx, branch, fmt, force, path, datasets, refish):
             raise InvalidOperation(
                 f"This repository already has a working copy at: {wc.path}",
             )
+        if bbox is not None:
+            raise InvalidOperation(
+                "--bbox can only be used when creating a new working copy - "
+                f"this repository already has one at: {wc.path}",
+            )
 
         click.echo(f"Updating {wc.path} ...")
         print(f"commit={commit.id} head_ref={head_ref}")
@@ -94,7 +119,14 @@ def checkout(ctx, branch, fmt, force, path, datasets, refish):
         click.echo(f'Checkout {refish or "HEAD"} to {path} as {fmt} ...')
         repo.reset(commit.id, pygit2.GIT_RESET_SOFT)
 
-        checkout_new(repo_structure, path, datasets=datasets, commit=commit)
+        checkout_new(
+            repo_structure,
+            path,
+            datasets=datasets,
+            commit=commit,
+            jobs=jobs,
+            bbox=bbox,
+        )
 
 
 def checkout_empty_repo(repo, path):
@@ -107,7 +139,9 @@ def checkout_empty_repo(repo, path):
     return wc
 
 
-def checkout_new(repo_structure, path, *, datasets=None, commit=None):
+def checkout_new(
+    repo_structure, path, *, datasets=None, commit=None, jobs=1, bbox=None
+):
     if not datasets:
         datasets = list(repo_structure)
     else:
@@ -119,8 +153,7 @@ def checkout_new(repo_structure, path, *, datasets=None, commit=None):
     click.echo(f"Commit: {commit.hex}")
 
     wc = checkout_empty_repo(repo_structure.repo, path)
-    for dataset in datasets:
-        wc.write_full(commit, dataset, safe=False)
+    wc.write_full(commit, *datasets, safe=False, jobs=jobs, bbox=bbox)
 
 
 @click.command()
@@ -275,3 +308,47 @@ def workingcopy_set_path(ctx, new):
         new = os.path.relpath(os.path.join(repo_path, new), repo_path)
 
     repo.config["sno.workingcopy.path"] = str(new)
+
+
+@click.group()
+@click.pass_context
+def workingcopy(ctx, **kwargs):
+    """ Manage the working copy """
+
+
+@workingcopy.group("bulk-edit")
+@click.pass_context
+def bulk_edit(ctx, **kwargs):
+    """
+    Make many edits to the working copy without tracking each one as it's made.
+
+    Run `begin` before the edits and `end` after them - the changed rows are found
+    all at once by `end`. Other commands which need to know about changes in the
+    working copy (eg. diff, status and commit) can't be used in between.
+    """
+
+
+def _bulk_edit_working_copy(ctx):
+    repo_structure = RepositoryStructure(ctx.obj.repo)
+    working_copy = repo_structure.working_copy
+    if not working_copy:
+        raise NotFound("You don't have a working copy", exit_code=NO_WORKING_COPY)
+    return repo_structure, working_copy
+
+
+@bulk_edit.command("begin")
+@click.pass_context
+def bulk_edit_begin(ctx):
+    """ Stop tracking edits to the working copy as they're made """
+    repo_structure, working_copy = _bulk_edit_working_copy(ctx)
+    working_copy.bulk_edit_begin(repo_structure)
+    click.echo(f"Bulk-edit mode started for {working_copy.path}")
+
+
+@bulk_edit.command("end")
+@click.pass_context
+def bulk_edit_end(ctx):
+    """ Find the edits made since `begin`, and track edits as they're made again """
+    repo_structure, working_copy = _bulk_edit_working_copy(ctx)
+    count = working_copy.bulk_edit_end(repo_structure)
+    click.echo(f"Bulk-edit mode ended for {working_copy.path}: {count} changed rows")
@@ -137,6 +137,7 @@ cli.add_command(checkout.checkout)
 cli.add_command(checkout.restore)
 cli.add_command(checkout.switch)
 cli.add_command(checkout.workingcopy_set_path)
+cli.add_command(checkout.workingcopy)
 cli.add_command(clone.clone)
 cli.add_command(conflicts.conflicts)
 cli.add_command(commit.commit)
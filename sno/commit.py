@@ -106,8 +106,9 @@ def commit(ctx, message, allow_empty, output_format, filters):
     new_commit_id = rs.commit(wc_diff, commit_msg, allow_empty=allow_empty)
     new_commit = repo[new_commit_id].peel(pygit2.Commit)
 
-    working_copy.reset_tracking_table(wc_diff.to_filter())
-    working_copy.update_meta_table(new_commit.peel(pygit2.Tree).id.hex)
+    with working_copy.session(operation="commit"):
+        working_copy.reset_tracking_table(wc_diff.to_filter())
+        working_copy.update_meta_table(new_commit.peel(pygit2.Tree).id.hex)
 
     jdict = commit_obj_to_json(new_commit, repo, wc_diff)
     if do_json:
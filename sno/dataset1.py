@@ -179,16 +179,17 @@ class Dataset1(DatasetStructure):
         blob = self._get_feature(pk_value)
         return self.repo_feature_to_dict(blob.name, blob.data, ogr_geoms=ogr_geoms)
 
+    def get_feature_from_blob(self, blob, *, ogr_geoms=False):
+        return self.repo_feature_to_dict(blob.name, blob.data, ogr_geoms=ogr_geoms)
+
     def get_feature_tuples(self, pk_values, col_names, *, ignore_missing=False):
+        # Features are looked up in batches sorted by path - see get_feature_blobs_bulk.
         tupleizer = self.build_feature_tupleizer(col_names)
-        for pk in pk_values:
-            try:
-                blob = self._get_feature(pk)
-            except KeyError:
+        for pk, blob in self.get_feature_blobs_bulk(pk_values):
+            if blob is None:
                 if ignore_missing:
                     continue
-                else:
-                    raise
+                raise KeyError(self.encode_1pk_to_path(pk, relative=True))
 
             yield tupleizer(blob)
 
@@ -221,11 +222,13 @@ class Dataset1(DatasetStructure):
 
         return tupleizer
 
-    def _iter_feature_blobs(self, fast=False):
+    def _iter_feature_blobs(self, fast=False, partition=None):
         """
         Iterates over all the features in self.tree that match the expected
         pattern for a feature, and yields the following for each:
         >>> feature_builder(path_name, path_data)
+        If partition is given, only the features in that partition are yielded -
+        see feature_partitions.
         """
         sno_table_tree = self.tree / ".sno-table"
 
@@ -243,6 +246,8 @@ class Dataset1(DatasetStructure):
         for dir1 in sno_table_tree:
             if hasattr(dir1, "data") or not RE_DIR.match(dir1.name):
                 continue
+            if partition is not None and dir1.name != partition:
+                continue
 
             for dir2 in dir1:
                 if hasattr(dir2, "data") or not RE_DIR.match(dir2.name):
@@ -261,20 +266,44 @@ class Dataset1(DatasetStructure):
 
                     yield leaf
 
-    def features(self, *, ogr_geoms=False, **kwargs):
+    def features(self, *, ogr_geoms=False, partition=None, **kwargs):
         """ Feature iterator yielding (encoded_pk, feature-dict) pairs """
         return (
             (
                 blob.name,
                 self.repo_feature_to_dict(blob.name, blob.data, ogr_geoms=ogr_geoms),
             )
-            for blob in self._iter_feature_blobs(fast=False)
+            for blob in self._iter_feature_blobs(fast=False, partition=partition)
         )
 
-    def feature_tuples(self, col_names, **kwargs):
+    def feature_tuples(self, col_names, *, partition=None, **kwargs):
         """ Optimised feature iterator yielding tuples, ordered by the columns from col_names """
         tupleizer = self.build_feature_tupleizer(col_names)
-        return (tupleizer(blob) for blob in self._iter_feature_blobs(fast=True))
+        return (
+            tupleizer(blob)
+            for blob in self._iter_feature_blobs(fast=True, partition=partition)
+        )
+
+    def feature_blobs(self):
+        return self._iter_feature_blobs(fast=True)
+
+    def feature_partitions(self):
+        # .sno-table/[hex(pk-hash):2]/
+        return [
+            dir1.name
+            for dir1 in self.tree / ".sno-table"
+            if isinstance(dir1, pygit2.Tree) and re.match(r"[0-9a-f]{2}$", dir1.name)
+        ]
+
+    def feature_buckets(self):
+        # .sno-table/[hex(pk-hash):2]/[hex(pk-hash):2]/
+        return {
+            f"{dir1.name}/{dir2.name}": dir2
+            for dir1 in self.tree / ".sno-table"
+            if isinstance(dir1, pygit2.Tree) and re.match(r"[0-9a-f]{2}$", dir1.name)
+            for dir2 in dir1
+            if isinstance(dir2, pygit2.Tree) and re.match(r"[0-9a-f]{2}$", dir2.name)
+        }
 
     def feature_count(self, fast=True):
         return sum(1 for blob in self._iter_feature_blobs(fast=True))
@@ -536,10 +536,16 @@ class Dataset2(DatasetStructure):
         )
         return self.schema.feature_from_raw_dict(raw_dict, keys=keys)
 
-    def features(self, keys=True):
+    def get_feature_from_blob(self, blob, *, keys=True, **kwargs):
+        # blob.name is not actually the full_path, but since we provide data, the exact path is irrelevant.
+        return self.get_feature(full_path=blob.name, data=blob.data, keys=keys)
+
+    def features(self, keys=True, partition=None):
         """
         Returns a generator that calls get_feature once per feature.
         Each entry in the generator is the path of the feature and then the feature itself.
+        If partition is given, only the features in that partition are included -
+        see feature_partitions.
         """
 
         # TODO: optimise.
@@ -547,12 +553,40 @@ class Dataset2(DatasetStructure):
         # (but this is the interface shared by dataset1 at the moment.)
         if self.FEATURE_PATH not in self.tree:
             return
-        for blob in find_blobs_in_tree(self.tree / self.FEATURE_PATH):
+        feature_tree = self.tree / self.FEATURE_PATH
+        if partition is not None:
+            feature_tree = feature_tree / partition
+        for blob in find_blobs_in_tree(feature_tree):
             # blob.name is not actually the full_path, but since we provide data, the exact path is irrelevant.
             yield blob.name, self.get_feature(
                 full_path=blob.name, data=blob.data, keys=keys
             ),
 
+    def feature_blobs(self):
+        if self.FEATURE_PATH not in self.tree:
+            return iter(())
+        return find_blobs_in_tree(self.tree / self.FEATURE_PATH)
+
+    def feature_partitions(self):
+        if self.FEATURE_PATH not in self.tree:
+            return []
+        return [
+            entry.name
+            for entry in self.tree / self.FEATURE_PATH
+            if isinstance(entry, pygit2.Tree)
+        ]
+
+    def feature_buckets(self):
+        if self.FEATURE_PATH not in self.tree:
+            return {}
+        return {
+            f"{dir1.name}/{dir2.name}": dir2
+            for dir1 in self.tree / self.FEATURE_PATH
+            if isinstance(dir1, pygit2.Tree)
+            for dir2 in dir1
+            if isinstance(dir2, pygit2.Tree)
+        }
+
     def feature_count(self):
         if self.FEATURE_PATH not in self.tree:
             return 0
@@ -593,6 +627,10 @@ class Dataset2(DatasetStructure):
         raw_dict = schema.feature_to_raw_dict(feature)
         return self.encode_raw_feature_dict(raw_dict, schema.legend)
 
+    def cast_primary_key(self, pk_value):
+        """Casts a single primary key value to the type of the (only) primary key column."""
+        return self.schema.sanitise_pks(pk_value)[0]
+
     def encode_pks_to_path(self, pk_values, relative=False):
         """
         Given some pk values, returns the path the feature should be written to.
@@ -648,11 +686,11 @@ class Dataset2(DatasetStructure):
     def get_feature_tuples(self, row_pks, col_names=None, *, ignore_missing=False):
         # TODO - make the signature more like the features method, which supports results as tuples or dicts.
         # TODO - support col_names (and maybe support it for features method too).
-        for pk in row_pks:
-            try:
-                yield self.get_feature(pk, keys=False)
-            except KeyError:
+        # Features are looked up in batches sorted by path - see get_feature_blobs_bulk.
+        for pk, blob in self.get_feature_blobs_bulk(row_pks):
+            if blob is None:
                 if ignore_missing:
                     continue
-                else:
-                    raise
+                raise KeyError(self.encode_1pk_to_path(pk, relative=True))
+
+            yield self.get_feature_from_blob(blob, keys=False)
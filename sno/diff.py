@@ -1,12 +1,18 @@
 import collections
+import concurrent.futures
 import copy
+import itertools
 import logging
+import multiprocessing.util
 import re
 import sys
 from pathlib import Path
 
 import click
+import pygit2
 
+from . import gpkg
+from .diff_cache import DiffCache
 from .diff_output import *  # noqa - used from globals()
 from .exceptions import (
     InvalidOperation,
@@ -15,7 +21,10 @@ from .exceptions import (
     UNCATEGORIZED_ERROR,
 )
 from .filter_util import build_feature_filter, UNFILTERED
+from .lazy_feature import resolve_dataset_diff
+from .output_util import dump_json_output, resolve_output_path
 from .repo_files import RepoState
+from .spatial_filter import BBoxType, EnvelopeCache, SpatialFilter
 from .structure import RepositoryStructure
 
 
@@ -27,6 +36,18 @@ class Conflict(Exception):
 
 
 class Diff:
+    """
+    The changes to one or more datasets.
+
+    The features in a Diff are never modified, and the per-dataset change maps are
+    shared between Diffs rather than copied: cloning or combining Diffs only creates new
+    maps for the datasets that change. A Diff only updates a dataset's maps in place
+    (see __iadd__) if it created them itself - as it does when it's constructed - and
+    hasn't shared them with another Diff since. This is tracked in _owned.
+    Inserts are held in a map keyed by primary key, like updates and deletes, and are
+    only sorted by primary key when a dataset diff is requested (see __getitem__).
+    """
+
     def __init__(
         self, dataset_or_diff, meta=None, inserts=None, updates=None, deletes=None
     ):
@@ -38,38 +59,50 @@ class Diff:
             # empty
             self._data = {}
             self._datasets = {}
+            self._owned = set()
         elif isinstance(dataset_or_diff, Diff):
-            # clone
+            # clone - the maps are shared, so neither Diff can modify them now
             diff = dataset_or_diff
-            self._data = copy.deepcopy(diff._data)
+            self._data = copy.copy(diff._data)
             self._datasets = copy.copy(diff._datasets)
+            self._owned = set()
+            diff._owned.clear()
         else:
             dataset = dataset_or_diff
+            # The caller could still be using the maps it gave us, so they're copied -
+            # but not the features in them.
             self._data = {
                 dataset.path: {
-                    "META": meta or {},
-                    "I": inserts or [],
-                    "U": updates or {},
-                    "D": deletes or {},
+                    "META": dict(meta or {}),
+                    "I": self._inserts_by_pk(inserts, dataset.primary_key)
+                    if inserts
+                    else {},
+                    "U": dict(updates or {}),
+                    "D": dict(deletes or {}),
                 }
             }
             self._datasets = {dataset.path: dataset}
+            self._owned = {dataset.path}
+
+    @staticmethod
+    def _inserts_by_pk(inserts, pk_field):
+        return {str(o[pk_field]): o for o in inserts}
 
     def __invert__(self):
         """ Return a new Diff that is the reverse of this Diff """
         new_diff = Diff(self)
         for ds_path, od in new_diff._data.items():
-            ds = new_diff._datasets[ds_path]
             if od["META"]:
                 raise NotImplementedError(
                     "Can't invert diffs containing meta changes yet"
                 )
 
+            new_diff._owned.add(ds_path)
             new_diff._data[ds_path] = {
                 # deletes become inserts
-                "I": list(od["D"].values()),
+                "I": dict(od["D"]),
                 # inserts become deletes
-                "D": {str(o[ds.primary_key]): o for o in od["I"]},
+                "D": dict(od["I"]),
                 # updates are swapped old<>new
                 "U": {k: (v1, v0) for k, (v0, v1) in od["U"].items()},
                 "META": {},
@@ -89,8 +122,9 @@ class Diff:
             )
 
         new_diff = Diff(self)
-        new_diff._data.update(copy.deepcopy(other._data))
-        new_diff._datasets.update(copy.deepcopy(other._datasets))
+        new_diff._data.update(other._data)
+        new_diff._datasets.update(other._datasets)
+        other._owned.clear()
         return new_diff
 
     def __ior__(self, other):
@@ -105,158 +139,121 @@ class Diff:
                 f"Same dataset appears in both Diffs, do you want += ? {', '.join(my_datasets & other_datasets)}"
             )
 
-        self._data.update(copy.deepcopy(other._data))
-        self._datasets.update(copy.copy(other._datasets))
+        self._data.update(other._data)
+        self._datasets.update(other._datasets)
+        other._owned.clear()
         return self
 
+    @staticmethod
+    def _has_conflicts(a, b):
+        """Returns True if composing the dataset diffs a and b would conflict - see _add."""
+        return (
+            any(pk in a["I"] or pk in a["U"] for pk in b["I"])
+            or any(pk in a["D"] for pk in b["U"])
+            or any(pk in a["D"] for pk in b["D"])
+        )
+
     @classmethod
-    def _add(cls, a, b, a_pk, b_pk):
+    def _add(cls, a, b, in_place=False):
+        """
+        Composes the dataset diffs a and b - a followed by b.
+        Returns a tuple (dataset_diff, conflict_keys) - conflict_keys is None if
+        there weren't any conflicts.
+
+        The inserts of both a and b are maps keyed by primary key, as they are in a Diff.
+        Only b's changes are visited, and are looked up in a, so composing a large diff
+        with a small one is cheap. If in_place is True, a's maps are updated and
+        returned; otherwise a's maps are copied (without copying the features in them),
+        or if either side is empty, the other side's maps are returned as they are.
+        b is never modified.
+        """
 
         if any(a["META"].values()) or any(b["META"].values()):
             raise NotImplementedError("Metadata changes")
 
+        if not (b["I"] or b["U"] or b["D"]):
+            return a, None
+        if not (a["I"] or a["U"] or a["D"]):
+            return b, None
+
+        if in_place and cls._has_conflicts(a, b):
+            # Conflicting keys are left out of the result - but a has to be left as
+            # it was, since the result is discarded when there are conflicts.
+            in_place = False
+
+        if in_place:
+            out_ins, out_upd, out_del = a["I"], a["U"], a["D"]
+        else:
+            out_ins, out_upd, out_del = dict(a["I"]), dict(a["U"]), dict(a["D"])
+
+        # Each primary key is in at most one of b's maps, so looking a key up in the
+        # output maps finds what a had for it - whether or not they're a's own maps.
         conflict_keys = set()
 
-        # we edit both sides during iteration
-
-        a_inserts = {str(o[a_pk]): o for o in a["I"]}
-        a_updates = a["U"].copy()
-        a_deletes = a["D"].copy()
-        L.debug("initial a.inserts: %s", sorted(a_inserts.keys()))
-        L.debug("initial a.updates: %s", sorted(a_updates.keys()))
-        L.debug("initial a.deletes: %s", sorted(a_deletes.keys()))
-
-        b_inserts = {str(o[b_pk]): o for o in b["I"]}
-        b_updates = b["U"].copy()
-        b_deletes = b["D"].copy()
-        L.debug("initial b.inserts: %s", sorted(b_inserts.keys()))
-        L.debug("initial b.updates: %s", sorted(b_updates.keys()))
-        L.debug("initial b.deletes: %s", sorted(b_deletes.keys()))
-
-        out_ins = {}
-        out_upd = {}
-        out_del = {}
-
-        for pk, o in a_inserts.items():
-            # ins + ins -> Conflict
-            # ins + upd -> ins
-            # ins + del -> noop
-            # ins +     -> ins
-
-            b_ins = b_inserts.pop(pk, None)
-            if b_ins:
-                conflict_keys.add(pk)
-                continue
-
-            b_upd = b_updates.pop(pk, None)
-            if b_upd:
-                out_ins[pk] = b_upd[1]
-                continue
-
-            b_del = b_deletes.pop(pk, None)
-            if b_del:
-                continue  # never existed -> noop
-
-            out_ins[pk] = o
-
-        for pk, (a_old, a_new) in a_updates.items():
-            # upd + ins -> Conflict
-            # upd + upd -> upd?
-            # upd + del -> del
-            # upd +     -> upd
-
-            b_ins = b_inserts.pop(pk, None)
-            if b_ins:
-                conflict_keys.add(pk)
-                continue
-
-            b_upd = b_updates.pop(pk, None)
-            if b_upd:
-                b_old, b_new = b_upd
-                if a_old != b_new:
-                    out_upd[pk] = (a_old, b_new)
-                else:
-                    pass  # changed back -> noop
-                continue
-
-            b_del = b_deletes.pop(pk, None)
-            if b_del:
-                out_del[pk] = a_old
-                continue
-
-            out_upd[pk] = (a_old, a_new)
-
-        for pk, o in a_deletes.items():
-            # del + del -> Conflict
-            # del + upd -> Conflict
-            # del + ins -> upd?
-            # del +     -> del
-
-            b_del = b_deletes.pop(pk, None)
-            if b_del:
-                conflict_keys.add(pk)
-                continue
-
-            b_upd = b_updates.pop(pk, None)
-            if b_upd:
-                conflict_keys.add(pk)
-                continue
-
-            b_ins = b_inserts.pop(pk, None)
-            if b_ins:
-                if b_ins != o:
-                    out_upd[pk] = (o, b_ins)
+        def _conflict(pk):
+            conflict_keys.add(pk)
+            out_ins.pop(pk, None)
+            out_upd.pop(pk, None)
+            out_del.pop(pk, None)
+
+        for pk, o in b["I"].items():
+            if pk in out_ins or pk in out_upd:
+                # ins + ins -> Conflict
+                # upd + ins -> Conflict
+                _conflict(pk)
+            elif pk in out_del:
+                # del + ins -> upd?
+                a_old = out_del.pop(pk)
+                if not gpkg.features_equal(o, a_old):
+                    out_upd[pk] = (a_old, o)
                 else:
                     pass  # inserted same as deleted -> noop
-                continue
-
-            out_del[pk] = o
-
-        # we should only have keys left in b.* that weren't in a.*
-        L.debug("out_ins: %s", sorted(out_ins.keys()))
-        L.debug("out_upd: %s", sorted(out_upd.keys()))
-        L.debug("out_del: %s", sorted(out_del.keys()))
-        L.debug("remaining b.inserts: %s", sorted(b_inserts.keys()))
-        L.debug("remaining b.updates: %s", sorted(b_updates.keys()))
-        L.debug("remaining b.deletes: %s", sorted(b_deletes.keys()))
-
-        all_keys = sum(
-            [
-                list(l)
-                for l in [
-                    out_ins.keys(),
-                    out_upd.keys(),
-                    out_del.keys(),
-                    b_inserts.keys(),
-                    b_updates.keys(),
-                    b_deletes.keys(),
-                ]
-            ],
-            [],
-        )
-        e = set(all_keys)
-        if len(e) != len(all_keys):
-            e_keys = [
-                k for k, count in collections.Counter(all_keys).items() if count > 1
-            ]
-            raise AssertionError(
-                f"Unexpected key conflict between operations: {e_keys}"
-            )
+            else:
+                #     + ins -> ins
+                out_ins[pk] = o
+
+        for pk, (b_old, b_new) in b["U"].items():
+            if pk in out_ins:
+                # ins + upd -> ins
+                out_ins[pk] = b_new
+            elif pk in out_upd:
+                # upd + upd -> upd?
+                a_old = out_upd[pk][0]
+                if not gpkg.features_equal(a_old, b_new):
+                    out_upd[pk] = (a_old, b_new)
+                else:
+                    del out_upd[pk]  # changed back -> noop
+            elif pk in out_del:
+                # del + upd -> Conflict
+                _conflict(pk)
+            else:
+                #     + upd -> upd
+                out_upd[pk] = (b_old, b_new)
+
+        for pk, o in b["D"].items():
+            if pk in out_ins:
+                # ins + del -> noop
+                del out_ins[pk]  # never existed
+            elif pk in out_upd:
+                # upd + del -> del
+                out_del[pk] = out_upd.pop(pk)[0]
+            elif pk in out_del:
+                # del + del -> Conflict
+                _conflict(pk)
+            else:
+                #     + del -> del
+                out_del[pk] = o
 
-        #     + ins -> ins
-        #     + upd -> upd
-        #     + del -> del
-        out_ins.update(b_inserts)
-        out_upd.update(b_updates)
-        out_del.update(b_deletes)
+        L.debug(
+            "composed diff: %d inserts, %d updates, %d deletes, %d conflicts",
+            len(out_ins),
+            len(out_upd),
+            len(out_del),
+            len(conflict_keys),
+        )
 
         return (
-            {
-                "META": {},
-                "I": sorted(out_ins.values(), key=lambda o: o[b_pk]),
-                "U": out_upd,
-                "D": out_del,
-            },
+            {"META": {}, "I": out_ins, "U": out_upd, "D": out_del},
             conflict_keys or None,
         )
 
@@ -269,17 +266,17 @@ class Diff:
             if ds not in my_datasets:
                 new_diff._data[ds] = other._data[ds]
                 new_diff._datasets[ds] = other._datasets[ds]
+                other._owned.discard(ds)
             else:
-                rdiff, conflicts = self._add(
-                    a=self._data[ds],
-                    b=other._data[ds],
-                    a_pk=self._datasets[ds].primary_key,
-                    b_pk=other._datasets[ds].primary_key,
-                )
+                a, b = self._data[ds], other._data[ds]
+                rdiff, conflicts = self._add(a, b)
                 if conflicts:
                     raise Conflict(conflicts)
-                else:
-                    new_diff._data[ds] = rdiff
+                new_diff._data[ds] = rdiff
+                if rdiff["I"] is b["I"]:
+                    other._owned.discard(ds)
+                elif rdiff["I"] is not a["I"]:
+                    new_diff._owned.add(ds)
         return new_diff
 
     def __iadd__(self, other):
@@ -290,17 +287,21 @@ class Diff:
             if ds not in my_datasets:
                 self._data[ds] = other._data[ds]
                 self._datasets[ds] = other._datasets[ds]
+                other._owned.discard(ds)
             else:
-                rdiff, conflicts = self._add(
-                    a=self._data[ds],
-                    b=other._data[ds],
-                    a_pk=self._datasets[ds].primary_key,
-                    b_pk=other._datasets[ds].primary_key,
-                )
+                # If this Diff is the only one with the maps for this dataset, only
+                # other's changes need visiting - see _add.
+                a, b = self._data[ds], other._data[ds]
+                rdiff, conflicts = self._add(a, b, in_place=ds in self._owned)
                 if conflicts:
                     raise Conflict(conflicts)
-                else:
-                    self._data[ds] = rdiff
+                self._data[ds] = rdiff
+                if rdiff["I"] is b["I"]:
+                    # the maps are shared with other now
+                    self._owned.discard(ds)
+                    other._owned.discard(ds)
+                elif rdiff["I"] is not a["I"]:
+                    self._owned.add(ds)
         return self
 
     def __len__(self):
@@ -310,24 +311,32 @@ class Diff:
         return count
 
     def __getitem__(self, dataset):
-        if isinstance(dataset, str):
-            return self._data[dataset]
-        return self._data[dataset.path]
+        """
+        Returns the diff of the given dataset (or dataset path):
+        {"META": ..., "I": ..., "U": ..., "D": ...}, with the inserts sorted by
+        primary key. The maps shouldn't be modified.
+        """
+        ds_path = dataset if isinstance(dataset, str) else dataset.path
+        ds_diff = self._data[ds_path]
+        if not ds_diff["I"]:
+            return {**ds_diff, "I": []}
+        pk_field = self._datasets[ds_path].primary_key
+        return {
+            **ds_diff,
+            "I": sorted(ds_diff["I"].values(), key=lambda o: o[pk_field]),
+        }
 
     def __iter__(self):
-        for ds_path, dsdiff in self._data.items():
-            ds = self._datasets[ds_path]
-            yield ds, dsdiff
+        for ds_path, ds in self._datasets.items():
+            yield ds, self[ds_path]
 
     def __eq__(self, other):
         if set(self._datasets.keys()) != set(other._datasets.keys()):
             return False
 
-        for ds, sdiff in self:
-            odiff = other[ds]
-            if sorted(sdiff["I"], key=lambda o: o[ds.primary_key]) != sorted(
-                odiff["I"], key=lambda o: o[ds.primary_key]
-            ):
+        for ds_path, sdiff in self._data.items():
+            odiff = other._data[ds_path]
+            if sdiff["I"] != odiff["I"]:
                 return False
             if sdiff["META"] != odiff["META"]:
                 return False
@@ -353,7 +362,7 @@ class Diff:
         }
 
     def __repr__(self):
-        return repr(self._data)
+        return repr({ds_path: self[ds_path] for ds_path in self._data})
 
     def datasets(self):
         return self._datasets.values()
@@ -368,45 +377,549 @@ class Diff:
         """Returns the set of all pks affected by this diff within a particular dataset."""
         ds_data = self._data[dataset.path]
         primary_key = dataset.primary_key
-        inserts = [str(o[primary_key]) for o in ds_data["I"]]
+        inserts = [str(o[primary_key]) for o in ds_data["I"].values()]
         deletes = [str(o[primary_key]) for o in ds_data["D"].values()]
         update_olds = [str(o[0][primary_key]) for o in ds_data["U"].values()]
         update_news = [str(o[1][primary_key]) for o in ds_data["U"].values()]
         return set(inserts + deletes + update_olds + update_news)
 
 
+class DiffCounts:
+    """
+    The number of changes of each type in each dataset of a diff, without the changes
+    themselves. Can be used in place of a Diff where only the counts are needed.
+    """
+
+    def __init__(self, counts=None):
+        # @counts: {dataset_path: {"META": n, "I": n, "U": n, "D": n}, ...}
+        self._counts = counts or {}
+
+    def __len__(self):
+        return sum(sum(c.values()) for c in self._counts.values())
+
+    def __repr__(self):
+        return f"DiffCounts({self._counts!r})"
+
+    def counts(self):
+        """Returns a copy of the counts, in the same format as Diff.counts()."""
+        return {path: dict(c) for path, c in self._counts.items()}
+
+
 def get_dataset_diff(
-    base_rs, target_rs, working_copy, dataset_path, pk_filter=UNFILTERED
+    base_rs,
+    target_rs,
+    working_copy,
+    dataset_path,
+    pk_filter=UNFILTERED,
+    spatial_filter=None,
+    diff_cache=None,
 ):
+    """
+    Generates a Diff for a single dataset: base_rs<>target_rs, plus target_rs<>working_copy
+    if working_copy is not None. If a DiffCache is given, the base_rs<>target_rs part
+    is looked up in it, and stored in it if it wasn't there.
+    """
     dataset = base_rs.get(dataset_path) or target_rs.get(dataset_path)
     diff = Diff(dataset)
 
+    diff_wc = None
+    if working_copy:
+        # target_rs<>working_copy - calculated first, so that we know which features
+        # need to be in base_rs<>target_rs regardless of the spatial filter.
+        target_ds = target_rs.get(dataset_path)
+        diff_wc = working_copy.diff_db_to_tree(target_ds, pk_filter=pk_filter)
+        L.debug(
+            "commit<>working_copy diff (%s): %s", dataset_path, repr(diff_wc),
+        )
+    cc_spatial_filter = spatial_filter
+    if spatial_filter and diff_wc is not None:
+        cc_spatial_filter = spatial_filter.exempting(diff_wc._dataset_pks(target_ds))
+
     if base_rs != target_rs:
-        # diff += base_rs<>target_rs
+        # diff = base_rs<>target_rs
         base_ds = base_rs.get(dataset_path)
         target_ds = target_rs.get(dataset_path)
 
-        params = {}
-        if not base_ds:
-            base_ds, target_ds = target_ds, base_ds
-            params["reverse"] = True
-
-        diff_cc = base_ds.diff(target_ds, pk_filter=pk_filter, **params)
+        cached, cache_key = None, None
+        if diff_cache is not None:
+            cache_key = diff_cache.key(
+                base_ds.tree.id if base_ds else None,
+                target_ds.tree.id if target_ds else None,
+                pk_filter,
+                cc_spatial_filter,
+            )
+            cached = diff_cache.get(cache_key, base_ds, target_ds)
+
+        if cached is not None:
+            L.debug("commit<>commit diff (%s): cached", dataset_path)
+            diff_cc = Diff(
+                dataset,
+                meta=cached["META"],
+                inserts=cached["I"],
+                updates=cached["U"],
+                deletes=cached["D"],
+            )
+        else:
+            params = {}
+            if not base_ds:
+                base_ds, target_ds = target_ds, base_ds
+                params["reverse"] = True
+
+            diff_cc = base_ds.diff(
+                target_ds,
+                pk_filter=pk_filter,
+                spatial_filter=cc_spatial_filter,
+                **params,
+            )
+            if diff_cache is not None:
+                diff_cache[cache_key] = diff_cc[dataset_path]
         L.debug("commit<>commit diff (%s): %s", dataset_path, repr(diff_cc))
-        diff += diff_cc
+        # diff_cc made its maps itself, so the working copy diff is added in place.
+        diff = diff_cc
 
-    if working_copy:
+    if diff_wc is not None:
         # diff += target_rs<>working_copy
-        target_ds = target_rs.get(dataset_path)
-        diff_wc = working_copy.diff_db_to_tree(target_ds, pk_filter=pk_filter)
-        L.debug(
-            "commit<>working_copy diff (%s): %s", dataset_path, repr(diff_wc),
-        )
         diff += diff_wc
 
+    if spatial_filter:
+        # Features are only exempt while composing the diff - a feature which was
+        # moved in the working copy still only matches if its old or new geometry does.
+        ds_diff = spatial_filter.filter_dataset_diff(dataset, diff[dataset])
+        diff = Diff(
+            dataset,
+            meta=ds_diff["META"],
+            inserts=ds_diff["I"],
+            updates=ds_diff["U"],
+            deletes=ds_diff["D"],
+        )
+
     return diff
 
 
+def get_dataset_diff_stream(
+    base_rs,
+    target_rs,
+    working_copy,
+    dataset_path,
+    pk_filter=UNFILTERED,
+    spatial_filter=None,
+    stat_only=False,
+    rename_buffer_size=10000,
+):
+    """
+    Generator. Like get_dataset_diff, but yields change records as they are found
+    instead of building a Diff, so the whole diff is never held in memory.
+    Each record is one of:
+        ("META", name, old_value, new_value)
+        ("I", key, None, new_feature)
+        ("U", key, old_feature, new_feature)
+        ("D", key, old_feature, None)
+    META records come first, but otherwise the records aren't sorted.
+
+    If stat_only is True, features aren't decoded (unless a working copy geometry has
+    to be compared) - each one is replaced by a stub containing just its primary key
+    and blob ID (see DatasetStructure.feature_stub).
+    That's enough to count the changes, but it can't be combined with a spatial_filter.
+
+    Renames in the working copy are only paired up if they are within
+    rename_buffer_size of each other - see WorkingCopy.diff_db_to_tree_stream.
+    If it is None, they're always paired up, as they are by get_dataset_diff.
+    """
+    if stat_only and spatial_filter:
+        raise ValueError("Can't use a spatial filter for a stat-only diff")
+
+    dataset = base_rs.get(dataset_path) or target_rs.get(dataset_path)
+
+    def _matches(record):
+        change, key, old, new = record
+        if spatial_filter is None or change == "META":
+            return True
+        return any(
+            spatial_filter.matches_feature(dataset, f)
+            for f in (old, new)
+            if f is not None
+        )
+
+    target_ds = target_rs.get(dataset_path)
+    if working_copy and base_rs == target_rs:
+        # Only the working copy diff is needed.
+        records = working_copy.diff_db_to_tree_stream(
+            target_ds,
+            pk_filter=pk_filter,
+            rename_buffer_size=rename_buffer_size,
+            stat_only=stat_only,
+        )
+        yield from filter(_matches, records)
+        return
+
+    cc_spatial_filter = spatial_filter
+    wc_records = {}
+    if working_copy:
+        # The working copy diff has to be composed with the base_rs<>target_rs diff,
+        # so it is held in memory - but it's only as big as the working copy edits.
+        for record in working_copy.diff_db_to_tree_stream(
+            target_ds, pk_filter=pk_filter, rename_buffer_size=None, stat_only=stat_only
+        ):
+            if record[0] == "META":
+                yield record
+            else:
+                wc_records[record[1]] = record
+        if spatial_filter:
+            wc_pks = [
+                f[dataset.primary_key]
+                for change, key, old, new in wc_records.values()
+                for f in (old, new)
+                if f is not None
+            ]
+            cc_spatial_filter = spatial_filter.exempting(wc_pks)
+
+    base_ds = base_rs.get(dataset_path)
+    params = {}
+    if not base_ds:
+        base_ds, target_ds = target_ds, base_ds
+        params["reverse"] = True
+
+    for record in base_ds.diff_stream(
+        target_ds,
+        pk_filter=pk_filter,
+        spatial_filter=cc_spatial_filter,
+        stat_only=stat_only,
+        **params,
+    ):
+        wc_record = wc_records.pop(record[1], None)
+        if wc_record is not None:
+            record = _compose_records(dataset, record, wc_record)
+        if record is not None and _matches(record):
+            yield record
+
+    yield from filter(_matches, wc_records.values())
+
+
+def get_dataset_diff_counts(
+    base_rs, target_rs, working_copy, dataset_path, pk_filter=UNFILTERED
+):
+    """
+    Like get_dataset_diff(...).dataset_counts(), but without decoding any features -
+    changes are classified by comparing blob IDs, including for rename detection.
+    Feature stubs are small, so every rename is paired up however far apart it is, as
+    it is in the full diff - otherwise the counts could disagree with it.
+    """
+    counts = {"META": 0, "I": 0, "U": 0, "D": 0}
+    for record in get_dataset_diff_stream(
+        base_rs,
+        target_rs,
+        working_copy,
+        dataset_path,
+        pk_filter,
+        stat_only=True,
+        rename_buffer_size=None,
+    ):
+        counts[record[0]] += 1
+    return counts
+
+
+def get_repo_diff_counts(
+    base_rs, target_rs, working_copy=None, feature_filter=UNFILTERED
+):
+    """
+    Counts the changes in every dataset in both RepositoryStructures, plus the
+    working copy if one is given. Returns a DiffCounts.
+    """
+    all_datasets = {ds.path for ds in base_rs} | {ds.path for ds in target_rs}
+
+    if feature_filter is not UNFILTERED:
+        all_datasets = all_datasets.intersection(feature_filter.keys())
+
+    return DiffCounts(
+        {
+            dataset_path: get_dataset_diff_counts(
+                base_rs,
+                target_rs,
+                working_copy,
+                dataset_path,
+                feature_filter[dataset_path],
+            )
+            for dataset_path in all_datasets
+        }
+    )
+
+
+def get_dataset_has_changes(
+    base_rs,
+    target_rs,
+    working_copy,
+    dataset_path,
+    pk_filter=UNFILTERED,
+    spatial_filter=None,
+):
+    """
+    Returns True if get_dataset_diff would find any changes, but stops at the first one.
+    Unchanged dataset trees are skipped without diffing them, and features are only
+    decoded if they are needed for the spatial_filter.
+    """
+    base_ds = base_rs.get(dataset_path)
+    target_ds = target_rs.get(dataset_path)
+    stat_only = spatial_filter is None
+
+    if base_ds and target_ds and base_ds.tree.id == target_ds.tree.id:
+        # base_rs<>target_rs is empty, so only the working copy can have changes.
+        if working_copy is None:
+            return False
+
+        # Changes are checked without pairing up renames: a rename is a delete and an
+        # insert of the same feature, and the delete is already enough to show a change.
+        for change, key, old, new, blob_hash in working_copy._diff_db_to_tree_changes(
+            target_ds, pk_filter, stat_only=stat_only
+        ):
+            if change == "META" or spatial_filter is None:
+                return True
+            if any(
+                spatial_filter.matches_feature(target_ds, f)
+                for f in (old, new)
+                if f is not None
+            ):
+                return True
+        return False
+
+    # Changes in the working copy can undo changes between the commits, so records are
+    # composed as usual - the first record that survives composition is a real change.
+    records = get_dataset_diff_stream(
+        base_rs,
+        target_rs,
+        working_copy,
+        dataset_path,
+        pk_filter,
+        spatial_filter,
+        stat_only=stat_only,
+        rename_buffer_size=None,
+    )
+    return next(records, None) is not None
+
+
+def get_repo_has_changes(
+    base_rs,
+    target_rs,
+    working_copy=None,
+    feature_filter=UNFILTERED,
+    spatial_filter=None,
+):
+    """
+    Returns True if any dataset in either RepositoryStructure has changes -
+    see get_dataset_has_changes. Stops at the first dataset with changes.
+    """
+    if working_copy is None and base_rs.tree == target_rs.tree:
+        return False
+
+    all_datasets = {ds.path for ds in base_rs} | {ds.path for ds in target_rs}
+
+    if feature_filter is not UNFILTERED:
+        all_datasets = all_datasets.intersection(feature_filter.keys())
+
+    return any(
+        get_dataset_has_changes(
+            base_rs,
+            target_rs,
+            working_copy,
+            dataset_path,
+            feature_filter[dataset_path],
+            spatial_filter,
+        )
+        for dataset_path in sorted(all_datasets)
+    )
+
+
+def _records_to_dataset_diff(records):
+    ds_diff = {"META": {}, "I": {}, "U": {}, "D": {}}
+    for change, key, old, new in records:
+        if change == "META":
+            ds_diff["META"][key] = (old, new)
+        elif change == "I":
+            ds_diff["I"][key] = new
+        elif change == "U":
+            ds_diff["U"][key] = (old, new)
+        elif change == "D":
+            ds_diff["D"][key] = old
+    return ds_diff
+
+
+def _compose_records(dataset, a, b):
+    """
+    Given change records a and b for the same feature, returns the record for
+    a followed by b - or None, if b undoes a.
+    """
+    ds_diff, conflicts = Diff._add(
+        _records_to_dataset_diff([a]), _records_to_dataset_diff([b])
+    )
+    if conflicts:
+        raise Conflict(conflicts)
+    ds_diff = {**ds_diff, "I": list(ds_diff["I"].values())}
+    return next(dataset_diff_records(dataset, ds_diff), None)
+
+
+def iter_dataset_diffs(
+    base_rs,
+    target_rs,
+    working_copy,
+    dataset_paths,
+    feature_filter=UNFILTERED,
+    spatial_filter=None,
+    *,
+    diff_cache=None,
+    jobs=1,
+    max_buffered=None,
+):
+    """
+    Generator. Yields a Diff for each of the given datasets, in the order given -
+    see get_dataset_diff.
+
+    If jobs > 1, the diffs are calculated by a pool of that many processes - decoding
+    features is mostly Python, so threads wouldn't run in parallel. Each process opens
+    its own repository, working copy and caches, and sends back each diff with its
+    features decoded. Diffs are calculated ahead of the one being yielded, but no more
+    than max_buffered (default: 2 * jobs) at a time - so at most that many completed
+    diffs are held in memory.
+    """
+    if jobs <= 1:
+        for dataset_path in dataset_paths:
+            yield get_dataset_diff(
+                base_rs,
+                target_rs,
+                working_copy,
+                dataset_path,
+                feature_filter[dataset_path],
+                spatial_filter,
+                diff_cache,
+            )
+        return
+
+    max_buffered = max(max_buffered or 2 * jobs, 1)
+    worker_args = (
+        base_rs.repo.path,
+        base_rs.id.hex if base_rs.id else None,
+        target_rs.id.hex if target_rs.id else None,
+        working_copy is not None,
+        spatial_filter.bbox if spatial_filter else None,
+        spatial_filter.envelope_cache.path
+        if spatial_filter and spatial_filter.envelope_cache
+        else None,
+        (diff_cache.path, diff_cache.max_size) if diff_cache is not None else None,
+    )
+
+    def _to_diff(result):
+        dataset_path, ds_diff = result
+        dataset = base_rs.get(dataset_path) or target_rs.get(dataset_path)
+        return Diff(
+            dataset,
+            meta=ds_diff["META"],
+            inserts=ds_diff["I"],
+            updates=ds_diff["U"],
+            deletes=ds_diff["D"],
+        )
+
+    paths = iter(dataset_paths)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_diff_worker, initargs=worker_args
+    ) as executor:
+        pending = collections.deque(
+            executor.submit(_diff_dataset_in_worker, path, feature_filter[path])
+            for path in itertools.islice(paths, max_buffered)
+        )
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for path in itertools.islice(paths, 1):
+                    pending.append(
+                        executor.submit(
+                            _diff_dataset_in_worker, path, feature_filter[path]
+                        )
+                    )
+                yield _to_diff(result)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+# State of a diff worker process - see iter_dataset_diffs.
+_worker = None
+
+
+def _init_diff_worker(
+    repo_path,
+    base_id,
+    target_id,
+    has_working_copy,
+    bbox,
+    envelope_cache_path,
+    diff_cache_args,
+):
+    global _worker
+    from .working_copy import WorkingCopy
+
+    repo = pygit2.Repository(repo_path)
+
+    def _lookup(rs_id):
+        if rs_id is None:
+            return RepositoryStructure(repo)
+        return RepositoryStructure.lookup(repo, rs_id)
+
+    spatial_filter = None
+    if bbox is not None:
+        envelope_cache = None
+        if envelope_cache_path is not None:
+            envelope_cache = EnvelopeCache(envelope_cache_path)
+        spatial_filter = SpatialFilter(bbox, envelope_cache)
+
+    _worker = {
+        "base_rs": _lookup(base_id),
+        "target_rs": _lookup(target_id),
+        "working_copy": WorkingCopy.open(repo) if has_working_copy else None,
+        "spatial_filter": spatial_filter,
+        "diff_cache": DiffCache(*diff_cache_args) if diff_cache_args else None,
+    }
+    # Worker processes don't run atexit handlers, but they do run these.
+    multiprocessing.util.Finalize(None, _close_diff_worker, exitpriority=10)
+
+
+def _close_diff_worker():
+    """Flushes and closes the caches of a diff worker process, as it exits."""
+    spatial_filter = _worker["spatial_filter"]
+    if spatial_filter and spatial_filter.envelope_cache:
+        spatial_filter.envelope_cache.close()
+    if _worker["diff_cache"] is not None:
+        _worker["diff_cache"].close()
+
+
+def _diff_dataset_in_worker(dataset_path, pk_filter):
+    """
+    Returns (dataset_path, dataset_diff) for the given dataset, with every feature
+    decoded into a plain dict - so that it can be sent back to the parent process.
+    """
+    spatial_filter = _worker["spatial_filter"]
+    diff = get_dataset_diff(
+        _worker["base_rs"],
+        _worker["target_rs"],
+        _worker["working_copy"],
+        dataset_path,
+        pk_filter,
+        spatial_filter,
+        _worker["diff_cache"],
+    )
+    if spatial_filter and spatial_filter.envelope_cache:
+        spatial_filter.envelope_cache.flush()
+
+    ds_diff = diff[dataset_path]
+    resolve_dataset_diff(ds_diff)
+    return (
+        dataset_path,
+        {
+            "META": ds_diff["META"],
+            "I": [dict(o) for o in ds_diff["I"]],
+            "U": {k: (dict(o), dict(n)) for k, (o, n) in ds_diff["U"].items()},
+            "D": {k: dict(o) for k, o in ds_diff["D"].items()},
+        },
+    )
+
+
 def get_repo_diff(base_rs, target_rs, feature_filter=UNFILTERED):
     """Generates a Diff for every dataset in both RepositoryStructures."""
     all_datasets = {ds.path for ds in base_rs} | {ds.path for ds in target_rs}
@@ -436,6 +949,81 @@ def get_common_ancestor(repo, rs1, rs2):
     return RepositoryStructure.lookup(repo, ancestor_id)
 
 
+def parse_commit_spec(repo, commit_spec):
+    """
+    Parses <commit> or <commit>...<commit> or <commit>..<commit>
+    Returns a tuple (base_rs, target_rs, working_copy) - the diff is base<>target,
+    plus target<>working_copy if working_copy is not None.
+    """
+    from .working_copy import WorkingCopy
+
+    commit_spec = commit_spec or "HEAD"
+    commit_parts = re.split(r"(\.{2,3})", commit_spec)
+
+    if len(commit_parts) == 3:
+        # Two commits specified - base and target. We diff base<>target.
+        base_rs = RepositoryStructure.lookup(repo, commit_parts[0] or "HEAD")
+        target_rs = RepositoryStructure.lookup(repo, commit_parts[2] or "HEAD")
+        if commit_parts[1] == "..":
+            # A   C    A...C is A<>C
+            #  \ /     A..C  is B<>C
+            #   B      (git log semantics)
+            base_rs = get_common_ancestor(repo, base_rs, target_rs)
+        working_copy = None
+    else:
+        # When one commit is specified, it is base, and we diff base<>working_copy.
+        # When no commits are specified, base is HEAD, and we do the same.
+        # We diff base<>working_copy by diffing base<>target + target<>working_copy,
+        # and target is set to HEAD.
+        base_rs = RepositoryStructure.lookup(repo, commit_parts[0])
+        target_rs = RepositoryStructure.lookup(repo, "HEAD")
+        working_copy = WorkingCopy.open(repo)
+        if not working_copy:
+            raise NotFound("No working copy, use 'checkout'", exit_code=NO_WORKING_COPY)
+        working_copy.assert_db_tree_match(target_rs.tree)
+
+    return base_rs, target_rs, working_copy
+
+
+def diff_stat(
+    ctx, *, output_format, output_path='-', exit_code, json_style, commit_spec, filters
+):
+    """
+    Counts the changes in the appropriate diff - see diff_with_writer - and writes
+    a summary of them, in the same format as `sno status`.
+    Features are not decoded, so this is much faster than generating the diff.
+    """
+    from .status import diff_status_to_text, get_diff_status_json
+
+    if isinstance(output_path, str) and output_path != "-":
+        output_path = Path(output_path).expanduser()
+
+    repo = ctx.obj.get_repo(allowed_states=RepoState.ALL_STATES)
+    base_rs, target_rs, working_copy = parse_commit_spec(repo, commit_spec)
+    feature_filter = build_feature_filter(filters)
+
+    if output_format == "quiet":
+        has_changes = get_repo_has_changes(
+            base_rs, target_rs, working_copy, feature_filter
+        )
+        if exit_code and has_changes:
+            sys.exit(1)
+        return
+
+    diff_counts = get_repo_diff_counts(base_rs, target_rs, working_copy, feature_filter)
+    jdict = get_diff_status_json(diff_counts)
+
+    if output_format == "json":
+        dump_json_output({"sno.diffstat/v1": jdict}, output_path, json_style=json_style)
+    elif output_format == "text":
+        text = diff_status_to_text(jdict)
+        if text:
+            click.echo(text, file=resolve_output_path(output_path))
+
+    if exit_code and len(diff_counts):
+        sys.exit(1)
+
+
 def diff_with_writer(
     ctx,
     diff_writer,
@@ -445,6 +1033,9 @@ def diff_with_writer(
     json_style="pretty",
     commit_spec,
     filters,
+    bbox=None,
+    stream=False,
+    jobs=1,
 ):
     """
     Calculates the appropriate diff from the arguments,
@@ -459,42 +1050,20 @@ def diff_with_writer(
       exit_code:   If True, the process will exit with code 1 if the diff is non-empty.
       commit_spec: The commit-ref or -refs to diff.
       filters:     Limit the diff to certain datasets or features.
+      bbox:        Limit the diff to features whose old or new envelope intersects
+                   this (min_x, min_y, max_x, max_y) bounding box.
+      stream:      If True, the diff_writer is called with an iterable of change records
+                   for each dataset instead of a Diff, so that the diff is written out
+                   as it is generated - see get_dataset_diff_stream.
+      jobs:        The number of datasets to diff in parallel - see iter_dataset_diffs.
+                   Either way, the datasets are passed to the diff_writer in order of path.
     """
-    from .working_copy import WorkingCopy
-
     try:
         if isinstance(output_path, str) and output_path != "-":
             output_path = Path(output_path).expanduser()
 
         repo = ctx.obj.get_repo(allowed_states=RepoState.ALL_STATES)
-
-        # Parse <commit> or <commit>...<commit>
-        commit_spec = commit_spec or "HEAD"
-        commit_parts = re.split(r"(\.{2,3})", commit_spec)
-
-        if len(commit_parts) == 3:
-            # Two commits specified - base and target. We diff base<>target.
-            base_rs = RepositoryStructure.lookup(repo, commit_parts[0] or "HEAD")
-            target_rs = RepositoryStructure.lookup(repo, commit_parts[2] or "HEAD")
-            if commit_parts[1] == "..":
-                # A   C    A...C is A<>C
-                #  \ /     A..C  is B<>C
-                #   B      (git log semantics)
-                base_rs = get_common_ancestor(repo, base_rs, target_rs)
-            working_copy = None
-        else:
-            # When one commit is specified, it is base, and we diff base<>working_copy.
-            # When no commits are specified, base is HEAD, and we do the same.
-            # We diff base<>working_copy by diffing base<>target + target<>working_copy,
-            # and target is set to HEAD.
-            base_rs = RepositoryStructure.lookup(repo, commit_parts[0])
-            target_rs = RepositoryStructure.lookup(repo, "HEAD")
-            working_copy = WorkingCopy.open(repo)
-            if not working_copy:
-                raise NotFound(
-                    "No working copy, use 'checkout'", exit_code=NO_WORKING_COPY
-                )
-            working_copy.assert_db_tree_match(target_rs.tree)
+        base_rs, target_rs, working_copy = parse_commit_spec(repo, commit_spec)
 
         # Parse [<dataset>[:pk]...]
         feature_filter = build_feature_filter(filters)
@@ -507,6 +1076,7 @@ def diff_with_writer(
 
         if feature_filter is not UNFILTERED:
             all_datasets = all_datasets.intersection(feature_filter.keys())
+        all_datasets = sorted(all_datasets)
 
         writer_params = {
             "repo": repo,
@@ -515,6 +1085,7 @@ def diff_with_writer(
             "output_path": output_path,
             "dataset_count": len(all_datasets),
             "json_style": json_style,
+            "stream": stream,
         }
 
         L.debug(
@@ -524,20 +1095,75 @@ def diff_with_writer(
             base_rs == target_rs,
         )
 
-        num_changes = 0
-        with diff_writer(**writer_params) as w:
-            for dataset_path in all_datasets:
-                diff = get_dataset_diff(
-                    base_rs,
-                    target_rs,
-                    working_copy,
-                    dataset_path,
-                    feature_filter[dataset_path],
+        spatial_filter = None
+        if bbox:
+            spatial_filter = SpatialFilter(bbox, EnvelopeCache.for_repo(repo))
+
+        # Diffs between two commits can't change, so they are cached. Diffs that are
+        # streamed aren't, since they'd have to be held in memory to be cached.
+        diff_cache = None
+        if base_rs != target_rs and not stream and diff_writer is not diff_output_quiet:
+            diff_cache = DiffCache.for_repo(repo)
+
+        try:
+            num_changes = 0
+
+            def _count_changes(records):
+                nonlocal num_changes
+                for record in records:
+                    num_changes += 1
+                    yield record
+
+            if diff_writer is diff_output_quiet:
+                # Nothing is written, so we only need to know whether anything changed.
+                num_changes = int(
+                    get_repo_has_changes(
+                        base_rs,
+                        target_rs,
+                        working_copy,
+                        feature_filter,
+                        spatial_filter,
+                    )
                 )
-                [dataset] = diff.datasets()
-                num_changes += len(diff)
-                L.debug("overall diff (%s): %s", dataset_path, repr(diff))
-                w(dataset, diff[dataset])
+            else:
+                with diff_writer(**writer_params) as w:
+                    if stream:
+                        for dataset_path in all_datasets:
+                            dataset = base_rs.get(dataset_path) or target_rs.get(
+                                dataset_path
+                            )
+                            records = get_dataset_diff_stream(
+                                base_rs,
+                                target_rs,
+                                working_copy,
+                                dataset_path,
+                                feature_filter[dataset_path],
+                                spatial_filter,
+                            )
+                            w(dataset, _count_changes(records))
+                    else:
+                        for diff in iter_dataset_diffs(
+                            base_rs,
+                            target_rs,
+                            working_copy,
+                            all_datasets,
+                            feature_filter,
+                            spatial_filter,
+                            diff_cache=diff_cache,
+                            jobs=jobs,
+                        ):
+                            [dataset] = diff.datasets()
+                            num_changes += len(diff)
+                            L.debug(
+                                "overall diff (%s): %s", dataset.path, repr(diff)
+                            )
+                            resolve_dataset_diff(diff[dataset])
+                            w(dataset, diff[dataset])
+        finally:
+            if diff_cache is not None:
+                diff_cache.close()
+            if spatial_filter:
+                spatial_filter.envelope_cache.close()
 
     except click.ClickException as e:
         L.debug("Caught ClickException: %s", e)
@@ -561,11 +1187,13 @@ def diff_with_writer(
 @click.option(
     "--output-format",
     "-o",
-    type=click.Choice(["text", "json", "geojson", "quiet", "html"]),
+    type=click.Choice(["text", "json", "geojson", "quiet", "html", "msgpack"]),
     default="text",
     help=(
         "Output format. 'quiet' disables all output and implies --exit-code.\n"
-        "'html' attempts to open a browser unless writing to stdout ( --output=- )"
+        "'html' attempts to open a browser unless writing to stdout ( --output=- )\n"
+        "'msgpack' is a binary stream of change records with WKB geometries, "
+        "for other programs or `sno apply`"
     ),
 )
 @click.option(
@@ -585,9 +1213,52 @@ def diff_with_writer(
     default="pretty",
     help="How to format the output. Only used with -o json or -o geojson",
 )
+@click.option(
+    "--bbox",
+    type=BBoxType(),
+    help=(
+        "Only show features whose old or new envelope intersects this bounding box, "
+        "given as MINX,MINY,MAXX,MAXY in the dataset's coordinate reference system."
+    ),
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of datasets to diff in parallel.",
+)
+@click.option(
+    "--stat",
+    is_flag=True,
+    help=(
+        "Only show the number of features changed in each dataset. Features aren't "
+        "decoded, so this is much faster than a full diff. Only for -o text, json or quiet"
+    ),
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    help=(
+        "Write changes out as they are found, instead of holding the whole diff in "
+        "memory. Changes aren't sorted."
+    ),
+)
 @click.argument("commit_spec", required=False, nargs=1)
 @click.argument("filters", nargs=-1)
-def diff(ctx, output_format, output_path, exit_code, json_style, commit_spec, filters):
+def diff(
+    ctx,
+    output_format,
+    output_path,
+    exit_code,
+    json_style,
+    bbox,
+    jobs,
+    stat,
+    stream,
+    commit_spec,
+    filters,
+):
     """
     Show changes between two commits, or between a commit and the working copy.
 
@@ -608,6 +1279,30 @@ def diff(ctx, output_format, output_path, exit_code, json_style, commit_spec, fi
     diff_writer = globals()[f"diff_output_{output_format}"]
     if output_format == "quiet":
         exit_code = True
+    if stream and jobs > 1:
+        raise click.BadParameter(
+            "--stream can't be combined with --jobs", param_hint="--jobs"
+        )
+
+    if stat:
+        if output_format not in ("text", "json", "quiet"):
+            raise click.BadParameter(
+                f"--stat is not supported for {output_format} output",
+                param_hint="--stat",
+            )
+        if bbox:
+            raise click.BadParameter(
+                "--stat can't be combined with --bbox", param_hint="--stat"
+            )
+        return diff_stat(
+            ctx,
+            output_format=output_format,
+            output_path=output_path,
+            exit_code=exit_code,
+            json_style=json_style,
+            commit_spec=commit_spec,
+            filters=filters,
+        )
 
     return diff_with_writer(
         ctx,
@@ -617,4 +1312,7 @@ def diff(ctx, output_format, output_path, exit_code, json_style, commit_spec, fi
         json_style=json_style,
         commit_spec=commit_spec,
         filters=filters,
+        bbox=bbox,
+        stream=stream,
+        jobs=jobs,
     )
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import logging
+import threading
+import zlib
+from pathlib import Path
+
+import apsw
+import msgpack
+import pygit2
+
+from .filter_util import UNFILTERED
+from .lazy_feature import LazyFeature
+
+
+L = logging.getLogger("sno.diff_cache")
+
+
+class DiffCache:
+    """
+    Persistent cache of the diffs between two versions of a dataset, keyed by the IDs of
+    both dataset trees and the filters used. Trees can't change, so neither can their
+    diffs - and a cached diff never needs to be invalidated.
+
+    Each diff is stored as zlib-compressed msgpack. Features which haven't been decoded
+    are stored as just their path and blob ID, and come back from the cache as
+    LazyFeatures. When the total size of the cached diffs is more than max_size bytes,
+    the least recently used are evicted.
+    A DiffCache can be shared between threads, and the cache file between processes.
+    """
+
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+    # How long to wait for another process to finish writing to the cache.
+    BUSY_TIMEOUT_MS = 10000
+
+    # msgpack extension type of a LazyFeature - [path, blob ID]
+    _EXT_LAZY_FEATURE = 1
+
+    # last_used is a counter rather than a timestamp, so the order diffs were used in
+    # is exact.
+    _NEXT_USED = "SELECT IFNULL(MAX(last_used), 0) + 1 FROM diffs"
+
+    @classmethod
+    def for_repo(cls, repo):
+        max_size = cls.DEFAULT_MAX_SIZE
+        if "sno.diffcache.maxsize" in repo.config:
+            max_size = repo.config.get_int("sno.diffcache.maxsize")
+        return cls(Path(repo.path) / "diffs.sno-cache", max_size)
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.db = apsw.Connection(str(path))
+        self.db.setbusytimeout(self.BUSY_TIMEOUT_MS)
+        self.db.cursor().execute(
+            """
+            CREATE TABLE IF NOT EXISTS diffs (
+                key TEXT PRIMARY KEY NOT NULL,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS diffs_last_used ON diffs (last_used);
+            """
+        )
+        self._lock = threading.Lock()
+        # Keys of the diffs read since last_used was last updated, in the order they
+        # were read - see _update_last_used.
+        self._used = {}
+
+    @staticmethod
+    def key(old_tree_id, new_tree_id, pk_filter=UNFILTERED, spatial_filter=None):
+        """
+        Returns the cache key for the diff between two dataset trees - either of which
+        can be None, if the dataset doesn't exist on that side of the diff.
+        """
+        parts = [
+            old_tree_id.hex if old_tree_id else None,
+            new_tree_id.hex if new_tree_id else None,
+            None if pk_filter is UNFILTERED else sorted(str(pk) for pk in pk_filter),
+        ]
+        if spatial_filter is not None:
+            parts.append(spatial_filter.bbox)
+            parts.append(sorted(spatial_filter.exempt_pks))
+        return hashlib.sha256(json.dumps(parts).encode("utf8")).hexdigest()
+
+    def get(self, key, old_dataset=None, new_dataset=None):
+        """
+        Returns the cached dataset diff - {"META": ..., "I": ..., "U": ..., "D": ...} -
+        or None if it isn't in the cache. Features which weren't decoded when the diff
+        was cached are returned as LazyFeatures of old_dataset (deleted features and the
+        old side of updates) or new_dataset (inserted features and the new side).
+        """
+        with self._lock:
+            row = (
+                self.db.cursor()
+                .execute("SELECT data FROM diffs WHERE key=?;", (key,))
+                .fetchone()
+            )
+            if row is None:
+                return None
+            self._used.pop(key, None)
+            self._used[key] = None
+
+        ds_diff = msgpack.unpackb(zlib.decompress(row[0]), raw=False)
+
+        def _feature(value, dataset):
+            # LazyFeatures can only be made once we know which dataset they belong to.
+            if isinstance(value, msgpack.ExtType):
+                path, blob_id = msgpack.unpackb(value.data, raw=False)
+                return LazyFeature(dataset, path, pygit2.Oid(hex=blob_id))
+            return value
+
+        old_dataset = old_dataset or new_dataset
+        new_dataset = new_dataset or old_dataset
+        ds_diff["I"] = [_feature(n, new_dataset) for n in ds_diff["I"]]
+        ds_diff["U"] = {
+            k: (_feature(o, old_dataset), _feature(n, new_dataset))
+            for k, (o, n) in ds_diff["U"].items()
+        }
+        ds_diff["D"] = {k: _feature(o, old_dataset) for k, o in ds_diff["D"].items()}
+        ds_diff["META"] = {k: tuple(v) for k, v in ds_diff["META"].items()}
+        return ds_diff
+
+    @classmethod
+    def _pack_feature(cls, feature):
+        if isinstance(feature, LazyFeature) and not feature.is_resolved:
+            return msgpack.ExtType(
+                cls._EXT_LAZY_FEATURE,
+                msgpack.packb([feature.path, feature.blob_id.hex], use_bin_type=True),
+            )
+        return dict(feature)
+
+    def _pack_diff(self, ds_diff):
+        """
+        Generator. Yields the given dataset diff as msgpack, a feature at a time - so
+        that it can be compressed as it's packed.
+        """
+        packer = msgpack.Packer(use_bin_type=True)
+        f = self._pack_feature
+        yield packer.pack_map_header(4)
+        yield packer.pack("META")
+        yield packer.pack(ds_diff["META"])
+        yield packer.pack("I")
+        yield packer.pack_array_header(len(ds_diff["I"]))
+        for n in ds_diff["I"]:
+            yield packer.pack(f(n))
+        yield packer.pack("U")
+        yield packer.pack_map_header(len(ds_diff["U"]))
+        for k, (o, n) in ds_diff["U"].items():
+            yield packer.pack(k)
+            yield packer.pack((f(o), f(n)))
+        yield packer.pack("D")
+        yield packer.pack_map_header(len(ds_diff["D"]))
+        for k, o in ds_diff["D"].items():
+            yield packer.pack(k)
+            yield packer.pack(f(o))
+
+    def __setitem__(self, key, ds_diff):
+        """
+        Caches the given dataset diff. Features which aren't decoded yet aren't decoded.
+        Diffs bigger than max_size once compressed aren't cached - packing stops as soon
+        as the compressed size is past it.
+        """
+        compressor = zlib.compressobj()
+        chunks = []
+        size = 0
+        for packed in self._pack_diff(ds_diff):
+            chunk = compressor.compress(packed)
+            size += len(chunk)
+            if size > self.max_size:
+                L.debug("Not caching diff %s: more than %d bytes", key, self.max_size)
+                return
+            chunks.append(chunk)
+        chunks.append(compressor.flush())
+        data = b"".join(chunks)
+        if len(data) > self.max_size:
+            L.debug("Not caching diff %s: %d bytes", key, len(data))
+            return
+
+        with self._lock:
+            with self.db:
+                dbcur = self.db.cursor()
+                self._update_last_used(dbcur)
+                dbcur.execute(
+                    f"""
+                    INSERT OR REPLACE INTO diffs (key, data, size, last_used)
+                    VALUES (?, ?, ?, ({self._NEXT_USED}));
+                    """,
+                    (key, data, len(data)),
+                )
+                self._evict(dbcur)
+
+    def _update_last_used(self, dbcur):
+        # Reading a diff doesn't write to the cache - the diffs which were read are
+        # marked as used in one go, before anything is evicted or the cache is closed.
+        for key in self._used:
+            dbcur.execute(
+                f"UPDATE diffs SET last_used=({self._NEXT_USED}) WHERE key=?;", (key,)
+            )
+        self._used.clear()
+
+    def _evict(self, dbcur):
+        total_size = dbcur.execute("SELECT TOTAL(size) FROM diffs;").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        evicted = []
+        for key, size in dbcur.execute(
+            "SELECT key, size FROM diffs ORDER BY last_used;"
+        ).fetchall():
+            if total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+
+        dbcur.executemany("DELETE FROM diffs WHERE key=?;", evicted)
+        L.debug("Evicted %d cached diffs", len(evicted))
+
+    def close(self):
+        with self._lock:
+            if self._used:
+                with self.db:
+                    self._update_last_used(self.db.cursor())
+        self.db.close()
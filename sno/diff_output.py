@@ -1,22 +1,41 @@
 import contextlib
 import io
 import json
-import os
 import string
 import sys
-import tempfile
 import webbrowser
 from pathlib import Path
 
 import click
+import msgpack
 
 from . import gpkg
-from .output_util import dump_json_output, resolve_output_path
+from .output_util import (
+    JsonFragmentFormatter,
+    dump_json_output,
+    resolve_output_path,
+)
 from .utils import ungenerator
 
 
+def dataset_diff_records(dataset, diff):
+    """
+    Generator. Yields the change records which make up the given dataset diff
+    (see sno.diff.get_dataset_diff_stream), in the order META, D, I, U.
+    """
+    pk_field = dataset.primary_key
+    for k, (v_old, v_new) in diff["META"].items():
+        yield ("META", k, v_old, v_new)
+    for k, v_old in diff["D"].items():
+        yield ("D", k, v_old, None)
+    for o in diff["I"]:
+        yield ("I", str(o[pk_field]), None, o)
+    for k, (v_old, v_new) in diff["U"].items():
+        yield ("U", k, v_old, v_new)
+
+
 @contextlib.contextmanager
-def diff_output_quiet(**kwargs):
+def diff_output_quiet(*, stream=False, **kwargs):
     """
     Contextmanager.
     Yields a callable which can be called with dataset diffs
@@ -28,13 +47,16 @@ def diff_output_quiet(**kwargs):
     """
 
     def _out(dataset, diff):
-        pass
+        if stream:
+            # the records still need to be generated to find out if anything changed.
+            for record in diff:
+                pass
 
     yield _out
 
 
 @contextlib.contextmanager
-def diff_output_text(*, output_path, **kwargs):
+def diff_output_text(*, output_path, stream=False, **kwargs):
     """
     Contextmanager.
 
@@ -42,7 +64,8 @@ def diff_output_text(*, output_path, **kwargs):
     The callable takes two arguments:
         dataset: A sno.structure.DatasetStructure instance representing
                  either the old or new version of the dataset.
-        diff:    The sno.diff.Diff instance to serialize
+        diff:    The sno.diff.Diff instance to serialize - or if stream is True,
+                 an iterable of change records (see sno.diff.get_dataset_diff_stream)
 
     On exit, writes a human-readable diff to the given output file.
 
@@ -61,72 +84,77 @@ def diff_output_text(*, output_path, **kwargs):
     def _out(dataset, diff):
         path = dataset.path
         pk_field = dataset.primary_key
-        prefix = f"{path}:"
+        meta_prefix = f"{path}:"
+        prefix = f"{path}:{pk_field}="
         repr_excl = [pk_field]
 
-        for k, (v_old, v_new) in diff["META"].items():
-            click.secho(
-                f"--- {prefix}meta/{k}\n+++ {prefix}meta/{k}", bold=True, **pecho
-            )
-
-            s_old = set(v_old.items())
-            s_new = set(v_new.items())
-
-            diff_add = dict(s_new - s_old)
-            diff_del = dict(s_old - s_new)
-            all_keys = set(diff_del.keys()) | set(diff_add.keys())
-
-            for k in all_keys:
-                if k in diff_del:
-                    click.secho(
-                        text_row({k: diff_del[k]}, prefix="- ", exclude=repr_excl),
-                        fg="red",
-                        **pecho,
-                    )
-                if k in diff_add:
-                    click.secho(
-                        text_row({k: diff_add[k]}, prefix="+ ", exclude=repr_excl),
-                        fg="green",
-                        **pecho,
-                    )
-
-        prefix = f"{path}:{pk_field}="
+        records = diff if stream else dataset_diff_records(dataset, diff)
+        for change, key, v_old, v_new in records:
+            if change == "META":
+                click.secho(
+                    f"--- {meta_prefix}meta/{key}\n+++ {meta_prefix}meta/{key}",
+                    bold=True,
+                    **pecho,
+                )
 
-        for k, v_old in diff["D"].items():
-            click.secho(f"--- {prefix}{k}", bold=True, **pecho)
-            click.secho(
-                text_row(v_old, prefix="- ", exclude=repr_excl), fg="red", **pecho
-            )
+                s_old = set(v_old.items())
+                s_new = set(v_new.items())
+
+                diff_add = dict(s_new - s_old)
+                diff_del = dict(s_old - s_new)
+                all_keys = set(diff_del.keys()) | set(diff_add.keys())
+
+                for k in all_keys:
+                    if k in diff_del:
+                        click.secho(
+                            text_row({k: diff_del[k]}, prefix="- ", exclude=repr_excl),
+                            fg="red",
+                            **pecho,
+                        )
+                    if k in diff_add:
+                        click.secho(
+                            text_row({k: diff_add[k]}, prefix="+ ", exclude=repr_excl),
+                            fg="green",
+                            **pecho,
+                        )
+
+            elif change == "D":
+                click.secho(f"--- {prefix}{key}", bold=True, **pecho)
+                click.secho(
+                    text_row(v_old, prefix="- ", exclude=repr_excl), fg="red", **pecho
+                )
 
-        for o in diff["I"]:
-            click.secho(f"+++ {prefix}{o[pk_field]}", bold=True, **pecho)
-            click.secho(
-                text_row(o, prefix="+ ", exclude=repr_excl), fg="green", **pecho
-            )
+            elif change == "I":
+                click.secho(f"+++ {prefix}{v_new[pk_field]}", bold=True, **pecho)
+                click.secho(
+                    text_row(v_new, prefix="+ ", exclude=repr_excl),
+                    fg="green",
+                    **pecho,
+                )
 
-        for _, (v_old, v_new) in diff["U"].items():
-            click.secho(
-                f"--- {prefix}{v_old[pk_field]}\n+++ {prefix}{v_new[pk_field]}",
-                bold=True,
-                **pecho,
-            )
+            elif change == "U":
+                click.secho(
+                    f"--- {prefix}{v_old[pk_field]}\n+++ {prefix}{v_new[pk_field]}",
+                    bold=True,
+                    **pecho,
+                )
 
-            s_old = set(v_old.items())
-            s_new = set(v_new.items())
+                s_old = set(v_old.items())
+                s_new = set(v_new.items())
 
-            diff_add = dict(s_new - s_old)
-            diff_del = dict(s_old - s_new)
-            all_keys = sorted(set(diff_del.keys()) | set(diff_add.keys()))
+                diff_add = dict(s_new - s_old)
+                diff_del = dict(s_old - s_new)
+                all_keys = sorted(set(diff_del.keys()) | set(diff_add.keys()))
 
-            for k in all_keys:
-                if k in diff_del:
-                    rk = text_row({k: diff_del[k]}, prefix="- ", exclude=repr_excl)
-                    if rk:
-                        click.secho(rk, fg="red", **pecho)
-                if k in diff_add:
-                    rk = text_row({k: diff_add[k]}, prefix="+ ", exclude=repr_excl)
-                    if rk:
-                        click.secho(rk, fg="green", **pecho)
+                for k in all_keys:
+                    if k in diff_del:
+                        rk = text_row({k: diff_del[k]}, prefix="- ", exclude=repr_excl)
+                        if rk:
+                            click.secho(rk, fg="red", **pecho)
+                    if k in diff_add:
+                        rk = text_row({k: diff_add[k]}, prefix="+ ", exclude=repr_excl)
+                        if rk:
+                            click.secho(rk, fg="green", **pecho)
 
     yield _out
 
@@ -156,7 +184,9 @@ def text_row(row, prefix="", exclude=None):
 
 
 @contextlib.contextmanager
-def diff_output_geojson(*, output_path, dataset_count, json_style='pretty', **kwargs):
+def diff_output_geojson(
+    *, output_path, dataset_count, json_style='pretty', stream=False, **kwargs
+):
     """
     Contextmanager.
 
@@ -167,14 +197,17 @@ def diff_output_geojson(*, output_path, dataset_count, json_style='pretty', **kw
     one for the 'deleted' version of the feature, and one for the 'added' version.
     This is intended for visualising in a map diff.
 
-    On exit, writes the diff as GeoJSON to the given output file.
+    Writes the diff as GeoJSON to the given output file, one feature at a time.
     For repos with more than one dataset, the output path must be a directory.
     In that case:
         * any .geojson files already in that directory will be deleted
         * files will be written to `{layer_name}.geojson in the given directory
 
     If the output file is stdout and isn't piped anywhere,
-    the json is prettified before writing.
+    the json is prettified and highlighted before writing.
+
+    If stream is True, each dataset diff is an iterable of change records, and
+    features are written to the output as they are generated.
     """
     if dataset_count > 1:
         # output_path needs to be a directory
@@ -205,34 +238,65 @@ def diff_output_geojson(*, output_path, dataset_count, json_style='pretty', **kw
         else:
             fp = output_path.open("w")
 
-        pk_field = dataset.primary_key
+        records = diff if stream else dataset_diff_records(dataset, diff)
+        features = _geojson_features(dataset, records)
 
-        fc = {"type": "FeatureCollection", "features": []}
+        if json_style == "pretty" and fp == sys.stdout and fp.isatty() and not stream:
+            # dump it all at once, so it gets syntax highlighting.
+            fc = {"type": "FeatureCollection", "features": list(features)}
+            dump_json_output(fc, fp, json_style=json_style)
+            return
 
-        for k, (v_old, v_new) in diff["META"].items():
+        fp.writelines(_iter_feature_collection(features, json_style))
+        fp.write("\n")
+
+    yield _out
+
+
+def _geojson_features(dataset, records):
+    """
+    Generator. Yields a GeoJSON feature for each feature in the given change records -
+    two for each update, one for the old version and one for the new.
+    """
+    pk_field = dataset.primary_key
+    for change, key, v_old, v_new in records:
+        if change == "META":
             click.secho(
-                f"Warning: meta changes aren't included in GeoJSON output: {k}",
+                f"Warning: meta changes aren't included in GeoJSON output: {key}",
                 fg="yellow",
                 file=sys.stderr,
             )
+        elif change == "U":
+            yield geojson_row(v_old, pk_field, "U-")
+            yield geojson_row(v_new, pk_field, "U+")
+        elif change == "D":
+            yield geojson_row(v_old, pk_field, "D")
+        else:
+            yield geojson_row(v_new, pk_field, "I")
 
-        for k, v_old in diff["D"].items():
-            fc["features"].append(geojson_row(v_old, pk_field, "D"))
-
-        for o in diff["I"]:
-            fc["features"].append(geojson_row(o, pk_field, "I"))
-
-        for _, (v_old, v_new) in diff["U"].items():
-            fc["features"].append(geojson_row(v_old, pk_field, "U-"))
-            fc["features"].append(geojson_row(v_new, pk_field, "U+"))
-
-        dump_json_output(fc, fp, json_style=json_style)
 
-    yield _out
+def _iter_feature_collection(features, json_style):
+    """
+    Generator. Yields the pieces of a GeoJSON FeatureCollection containing the given
+    features, which are dumped one at a time - so they needn't all be held in memory.
+    """
+    fmt = JsonFragmentFormatter(json_style)
+    # keys are written in sorted order, to match the pretty output of json.dumps.
+    yield "{" + fmt.key("features", 1)
+    yield from fmt.iter_array(features, 1)
+    yield (
+        fmt.item_separator
+        + fmt.key("type", 1)
+        + fmt.dumps("FeatureCollection")
+        + fmt.newline(0)
+        + "}"
+    )
 
 
 @contextlib.contextmanager
-def diff_output_json(*, output_path, dataset_count, json_style="pretty", **kwargs):
+def diff_output_json(
+    *, output_path, dataset_count, json_style="pretty", stream=False, **kwargs
+):
     """
     Contextmanager.
     Yields a callable which can be called with dataset diffs
@@ -241,6 +305,9 @@ def diff_output_json(*, output_path, dataset_count, json_style="pretty", **kwarg
     On exit, writes the diff as JSON to the given output file.
     If the output file is stdout and isn't piped anywhere,
     the json is prettified first.
+
+    If stream is True, each dataset diff is an iterable of change records, and
+    feature changes are written to the output as they are generated - unsorted.
     """
     if isinstance(output_path, Path):
         if output_path.is_dir():
@@ -249,6 +316,11 @@ def diff_output_json(*, output_path, dataset_count, json_style="pretty", **kwarg
                 param_hint="--output",
             )
 
+    if stream:
+        with _diff_output_json_stream(output_path, json_style) as _out:
+            yield _out
+        return
+
     accumulated = {}
 
     def _out(dataset, diff):
@@ -291,6 +363,53 @@ def diff_output_json(*, output_path, dataset_count, json_style="pretty", **kwarg
     )
 
 
+@contextlib.contextmanager
+def _diff_output_json_stream(output_path, json_style):
+    fp = resolve_output_path(output_path)
+    fmt = JsonFragmentFormatter(json_style)
+    dataset_count = 0
+
+    fp.write("{" + fmt.key("sno.diff/v1+hexwkb", 1) + "{")
+
+    def _out(dataset, records):
+        nonlocal dataset_count
+        pk_field = dataset.primary_key
+        meta_changes = {}
+
+        def _feature_changes():
+            for change, key, v_old, v_new in records:
+                if change == "META":
+                    meta_changes[key] = [v_old, v_new]
+                elif change == "U":
+                    yield {
+                        '-': json_row(v_old, pk_field, "U-"),
+                        '+': json_row(v_new, pk_field, "U+"),
+                    }
+                elif change == "D":
+                    yield {'-': json_row(v_old, pk_field, "D")}
+                else:
+                    yield {'+': json_row(v_new, pk_field, "I")}
+
+        if dataset_count:
+            fp.write(fmt.item_separator)
+        dataset_count += 1
+
+        # keys are written in sorted order, to match the non-streaming output.
+        fp.write(fmt.key(dataset.path, 2) + "{" + fmt.key("featureChanges", 3))
+        fp.writelines(fmt.iter_array(_feature_changes(), 3))
+        fp.write(
+            fmt.item_separator
+            + fmt.key("metaChanges", 3)
+            + fmt.dumps(meta_changes, 3)
+            + fmt.newline(2)
+            + "}"
+        )
+
+    yield _out
+
+    fp.write((fmt.newline(1) if dataset_count else "") + "}" + fmt.newline(0) + "}\n")
+
+
 @ungenerator(dict)
 def json_row(row, pk_field, change=None):
     """
@@ -303,6 +422,76 @@ def json_row(row, pk_field, change=None):
         yield k, v
 
 
+MSGPACK_DIFF_FORMAT = "sno.diff/v1+wkb"
+
+
+@contextlib.contextmanager
+def diff_output_msgpack(*, output_path, stream=False, patch=None, **kwargs):
+    """
+    Contextmanager.
+    Yields a callable which can be called with dataset diffs
+    (see `diff_output_text` docstring for more on that)
+
+    Writes the diff to the given output file as a stream of msgpack objects,
+    each of which is written as soon as it is generated:
+        * a header: {"format": "sno.diff/v1+wkb"}
+          If patch is given, the header also contains it as "sno.patch/v1"
+          (see `sno.show.patch_output_json`)
+        * for each dataset, {"dataset": <dataset path>}, followed by that dataset's
+          change records as [change, key, old, new] arrays - see
+          sno.diff.get_dataset_diff_stream. The key is only set for META changes,
+          since the primary key of a feature is in the feature itself.
+
+    Geometries are raw little-endian WKB. This is much faster to produce and parse than
+    JSON, for large diffs that are being consumed by other programs or applied
+    with `sno apply`.
+    """
+    if isinstance(output_path, Path) and output_path.is_dir():
+        raise click.BadParameter(
+            "Directory is not valid for --output with --output-format=msgpack",
+            param_hint="--output",
+        )
+
+    fp = resolve_output_path(output_path, binary=True)
+    packer = msgpack.Packer(use_bin_type=True)
+    header = {"format": MSGPACK_DIFF_FORMAT}
+    if patch is not None:
+        header["sno.patch/v1"] = patch
+    fp.write(packer.pack(header))
+
+    def _out(dataset, diff):
+        fp.write(packer.pack({"dataset": dataset.path}))
+        records = diff if stream else dataset_diff_records(dataset, diff)
+        for change, key, v_old, v_new in records:
+            if change != "META":
+                key = None
+                v_old = msgpack_row(v_old)
+                v_new = msgpack_row(v_new)
+            fp.write(packer.pack([change, key, v_old, v_new]))
+
+    try:
+        yield _out
+    finally:
+        # Only close the file if it was opened here.
+        if isinstance(output_path, Path):
+            fp.close()
+        else:
+            fp.flush()
+
+
+def msgpack_row(row):
+    """
+    Turns a row into a dict for serialization as msgpack.
+    The geometry is serialized as WKB.
+    """
+    if row is None:
+        return None
+    return {
+        k: (gpkg.gpkg_geom_to_wkb(v) if isinstance(v, bytes) else v)
+        for k, v in row.items()
+    }
+
+
 def geojson_row(row, pk_field, change=None):
     """
     Turns a row into a dict representing a GeoJSON feature.
@@ -319,8 +508,7 @@ def geojson_row(row, pk_field, change=None):
     for k in row.keys():
         v = row[k]
         if isinstance(v, bytes):
-            g = gpkg.gpkg_geom_to_ogr(v)
-            f['geometry'] = json.loads(g.ExportToJson())
+            f['geometry'] = gpkg.gpkg_geom_to_geojson(v)
         else:
             f["properties"][k] = v
 
@@ -328,14 +516,17 @@ def geojson_row(row, pk_field, change=None):
 
 
 @contextlib.contextmanager
-def diff_output_html(*, output_path, repo, base, target, dataset_count, **kwargs):
+def diff_output_html(
+    *, output_path, repo, base, target, dataset_count, stream=False, **kwargs
+):
     """
     Contextmanager.
     Yields a callable which can be called with dataset diffs
     (see `diff_output_text` docstring for more on that)
 
-    On exit, writes an HTML diff to the given output file
+    Writes an HTML diff to the given output file
     (defaults to 'DIFF.html' in the repo directory).
+    The GeoJSON for each dataset is written into the page as it is generated.
 
     If `-` is given as the output file, the HTML is written to stdout,
     and no web browser is opened.
@@ -348,34 +539,38 @@ def diff_output_html(*, output_path, repo, base, target, dataset_count, **kwargs
     with open(
         Path(__file__).resolve().with_name("diff-view.html"), "r", encoding="utf8"
     ) as ft:
-        template = string.Template(ft.read())
+        template = ft.read()
 
     title = f"{Path(repo.path).name}: {base.short_id} .. {target.short_id if target else 'working-copy'}"
+    # Split the template around the data, so the data can be written out piece by piece.
+    head, tail = [
+        string.Template(t).substitute({"title": title})
+        for t in template.split("${geojson_data}")
+    ]
+
+    if not output_path:
+        output_path = Path(repo.path) / "DIFF.html"
+    fo = resolve_output_path(output_path)
+    fo.write(head + "{")
+    written = 0
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        tempdir = Path(tempdir)
-        # Write a bunch of geojson files to a temporary directory
-        with diff_output_geojson(
-            output_path=tempdir, dataset_count=dataset_count, json_style="extracompact",
-        ) as json_writer:
-            yield json_writer
+    def _out(dataset, diff):
+        nonlocal written
+        if written:
+            fo.write(",")
+        written += 1
+
+        records = diff if stream else dataset_diff_records(dataset, diff)
+        fo.write(json.dumps(dataset.name) + ":")
+        for piece in _iter_feature_collection(
+            _geojson_features(dataset, records), "extracompact"
+        ):
+            # "</script>" in a string would end the script element.
+            fo.write(piece.replace("</", "<\\/"))
 
-        if not output_path:
-            output_path = Path(repo.path) / "DIFF.html"
-        fo = resolve_output_path(output_path)
-
-        # Read all the geojson back in, and stick them in a dict
-        all_datasets_geojson = {}
-        for filename in os.listdir(tempdir):
-            with open(tempdir / filename) as json_file:
-                all_datasets_geojson[os.path.splitext(filename)[0]] = json.load(
-                    json_file
-                )
-        fo.write(
-            template.substitute(
-                {"title": title, "geojson_data": json.dumps(all_datasets_geojson)}
-            )
-        )
+    yield _out
+
+    fo.write("}" + tail)
     if fo != sys.stdout:
         fo.close()
         webbrowser.open_new(f"file://{output_path.resolve()}")
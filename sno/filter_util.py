@@ -19,6 +19,10 @@ class _Unfiltered:
         # Adding more items to this filter is a no-op.
         pass
 
+    def __reduce__(self):
+        # Unpickles as the same UNFILTERED object, so `is UNFILTERED` still works.
+        return "UNFILTERED"
+
 
 # The result of build_feature_filter when all datasets or features should be returned.
 UNFILTERED = _Unfiltered()
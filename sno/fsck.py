@@ -7,10 +7,12 @@ from osgeo import gdal
 
 from . import gpkg
 from .exceptions import NotFound, NO_WORKING_COPY
+from .spatial_filter import SpatialFilter
 from .structure import RepositoryStructure
 
 
 def _fsck_reset(repo_structure, working_copy, dataset_paths):
+    working_copy.check_not_bulk_editing()
     datasets = [repo_structure[p] for p in dataset_paths]
 
     for ds in datasets:
@@ -59,6 +61,58 @@ def _fsck_reset(repo_structure, working_copy, dataset_paths):
         working_copy.write_full(commit, ds)
 
 
+def _bucket_mismatches(
+    dataset, dbcur, bucket, repo_blobs, wc_blob_ids, spatial_filter=None
+):
+    """
+    Generator. Compares one bucket of the given dataset feature by feature, and yields
+    a message for each feature which differs between the repository and the working
+    copy. repo_blobs is {name: blob} from the repository, wc_blob_ids is
+    {name: blob_id} from WorkingCopy.dirty_buckets. If the working copy is limited
+    to a bounding box, features outside it are expected to be missing.
+    """
+    pk = dataset.primary_key
+    for name in sorted(repo_blobs.keys() | wc_blob_ids.keys()):
+        repo_blob = repo_blobs.get(name)
+        wc_blob_id = wc_blob_ids.get(name)
+        if repo_blob is not None and repo_blob.id.hex == wc_blob_id:
+            continue
+
+        if repo_blob is None:
+            # This could also be a feature stored in the wrong place in the repository.
+            pk_value = dataset.decode_path_to_1pk(name)
+            yield f"Feature {pk}={pk_value} is in the working-copy but not the repository"
+            continue
+
+        feature = dataset.get_feature_from_blob(repo_blob, ogr_geoms=False)
+        if dataset.feature_bucket(feature[pk]) != (bucket, name):
+            yield f"Hash mismatch for feature '{feature[pk]}': repo says {bucket}/{name} but should be {dataset.encode_1pk_to_path(feature[pk])}"
+            continue
+
+        if wc_blob_id is None:
+            if (
+                spatial_filter is not None
+                and dataset.has_geometry
+                and not spatial_filter.matches_feature(dataset, feature)
+            ):
+                continue
+            yield f"Feature {pk}={feature[pk]} is in the repository but not the working-copy"
+            continue
+
+        dbcur.execute(
+            f"SELECT * FROM {gpkg.ident(dataset.name)} WHERE {gpkg.ident(pk)}=?;",
+            [feature[pk]],
+        )
+        row = dict(dbcur.fetchone().items())
+        if not gpkg.features_equal(feature, row):
+            s_old = set(feature.items())
+            s_new = set(row.items())
+            diff_add = dict(s_new - s_old)
+            diff_del = dict(s_old - s_new)
+            all_keys = sorted(set(diff_del.keys()) | set(diff_add.keys()))
+            yield f"Mismatch between repository and working-copy for feature {pk}={feature[pk]}: fields: {', '.join(all_keys)}"
+
+
 @click.command(context_settings=dict(ignore_unknown_options=True))
 @click.pass_context
 @click.option(
@@ -118,6 +172,14 @@ def fsck(ctx, reset_datasets, fsck_args):
             click.echo("This might be fixable via `checkout --force`")
             raise click.Abort()
 
+        bbox = working_copy.get_bbox()
+        spatial_filter = None
+        if bbox is not None:
+            spatial_filter = SpatialFilter(bbox)
+            click.echo(
+                f"Working copy is limited to features within {','.join(str(c) for c in bbox)}"
+            )
+
         has_err = False
         for dataset in rs:
             click.secho(
@@ -138,7 +200,7 @@ def fsck(ctx, reset_datasets, fsck_args):
             wc_count = dbcur.fetchall()[0][0]
             click.echo(f"{wc_count} features in {table}")
             ds_count = dataset.feature_count(fast=False)
-            if wc_count != ds_count:
+            if wc_count != ds_count and spatial_filter is None:
                 has_err = True
                 click.secho(
                     f"✘ Feature Count mismatch between repo ({ds_count}) & working-copy table ({wc_count})",
@@ -194,42 +256,32 @@ def fsck(ctx, reset_datasets, fsck_args):
 
             if not has_err:
                 click.echo("Checking features...")
-                feature_err_count = 0
-                for pk_hash, feature in dataset.features(fast=False):
-                    h_verify = dataset.encode_1pk_to_path(feature[pk])
-
-                    if pk_hash != h_verify:
-                        has_err = True
-                        click.secho(
-                            f"✘ Hash mismatch for feature '{feature[pk]}': repo says {pk_hash} but should be {h_verify}",
-                            fg="red",
-                        )
-
-                    dbcur.execute(
-                        f"SELECT * FROM {gpkg.ident(table)} WHERE {gpkg.ident(pk)}=?;",
-                        [feature[pk]],
-                    )
-                    row = dbcur.fetchone()
-                    if dict(row) != feature:
-                        s_old = set(feature.items())
-                        s_new = set(dict(row).items())
-                        diff_add = dict(s_new - s_old)
-                        diff_del = dict(s_old - s_new)
-                        all_keys = sorted(set(diff_del.keys()) | set(diff_add.keys()))
+                repo_buckets = dataset.feature_buckets()
+                # every row is checked - rows can be changed without being tracked
+                dirty_buckets = working_copy.dirty_buckets(dataset, tracked_only=False)
+                click.echo(
+                    f"{len(dirty_buckets)} of {len(repo_buckets)} buckets differ from the repository"
+                )
 
+                feature_err_count = 0
+                for bucket, wc_blob_ids in sorted(dirty_buckets.items()):
+                    repo_blobs = {b.name: b for b in repo_buckets.get(bucket, [])}
+                    for message in _bucket_mismatches(
+                        dataset, dbcur, bucket, repo_blobs, wc_blob_ids, spatial_filter
+                    ):
                         has_err = True
-                        click.secho(
-                            f"✘ Mismatch between repository and working-copy for feature {pk}={feature[pk]}: fields: {', '.join(all_keys)}",
-                            fg="red",
-                        )
+                        click.secho(f"✘ {message}", fg="red")
 
                         feature_err_count += 1
                         if feature_err_count == 100:
-                            click.secho(
-                                "! More than 100 errors, stopping for now.", fg="yellow"
-                            )
                             break
 
+                    if feature_err_count == 100:
+                        click.secho(
+                            "! More than 100 errors, stopping for now.", fg="yellow"
+                        )
+                        break
+
         if has_err:
             raise click.Abort()
 
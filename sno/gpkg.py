@@ -1,5 +1,6 @@
 import binascii
 import collections
+import hashlib
 import json
 import math
 import struct
@@ -255,6 +256,53 @@ def gpkg_geom_to_hex_wkb(gpkg_geom):
         return binascii.hexlify(wkb).decode("ascii").upper()
 
 
+def geom_fingerprint(gpkg_geom):
+    """
+    Returns a fingerprint (as bytes) of the given GeoPackage geometry, or `None` if
+    gpkg_geom is `None`. It's the same for any encoding of the same geometry, since it
+    hashes the SRS ID and normalised WKB - little-endian ISO WKB with no envelope.
+    """
+    if gpkg_geom is None:
+        return None
+    flags = _validate_gpkg_geom(gpkg_geom)
+    is_le = (flags & 0b0000001) != 0
+    srid = struct.unpack_from(f'{"<" if is_le else ">"}i', gpkg_geom, 4)[0]
+
+    wkb = gpkg_geom_to_wkb(gpkg_geom)
+    (wkb_type,) = struct.unpack_from("<I", wkb, 1)
+    if wkb_type & 0xE0000000:
+        # Force ISO type codes instead of EWKB Z/M/SRID flags
+        wkb = ogr.CreateGeometryFromWkb(wkb).ExportToIsoWkb(ogr.wkbNDR)
+    return hashlib.sha256(struct.pack("<i", srid) + wkb).digest()
+
+
+def _is_gpkg_geom(value):
+    return isinstance(value, bytes) and value[:2] == b"GP"
+
+
+def features_equal(a, b):
+    """
+    Returns True if the two features (mappings of column name to value) are equal.
+    Geometries are compared by geom_fingerprint, so two encodings of the same geometry -
+    eg. with and without an envelope - are equal. Other values must be equal.
+    """
+    if a is b:
+        return True
+    if a.keys() != b.keys():
+        return False
+    for k, v_a in a.items():
+        v_b = b[k]
+        if v_a == v_b:
+            continue
+        if not (
+            _is_gpkg_geom(v_a)
+            and _is_gpkg_geom(v_b)
+            and geom_fingerprint(v_a) == geom_fingerprint(v_b)
+        ):
+            return False
+    return True
+
+
 def gpkg_geom_to_ogr(gpkg_geom, parse_srs=False):
     """
     Parse GeoPackage geometry values to an OGR Geometry object
@@ -297,6 +345,106 @@ def gpkg_geom_to_ogr(gpkg_geom, parse_srs=False):
     return geom
 
 
+_WKB_GEOJSON_TYPES = {
+    1: "Point",
+    2: "LineString",
+    3: "Polygon",
+    4: "MultiPoint",
+    5: "MultiLineString",
+    6: "MultiPolygon",
+    7: "GeometryCollection",
+}
+
+
+class _WKBToGeoJSON:
+    """
+    Parses WKB - ISO or extended, either byte order - to a GeoJSON geometry dict.
+    Z values are kept and M values dropped, like OGR's ExportToJson.
+    Raises NotImplementedError for geometry types which GeoJSON doesn't support, and
+    for extended WKB with an embedded SRID.
+    """
+
+    def __init__(self, wkb, offset=0):
+        self.wkb = wkb
+        self.offset = offset
+
+    def _unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.wkb, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def _coords(self, bo, count, ndims, keep):
+        flat = self._unpack(f"{bo}{count * ndims}d")
+        return [list(flat[i : i + keep]) for i in range(0, len(flat), ndims)]
+
+    def geometry(self):
+        bo = "<" if self.wkb[self.offset] == 1 else ">"
+        self.offset += 1
+        (wkb_type,) = self._unpack(f"{bo}I")
+        if wkb_type & 0x20000000:
+            # Extended WKB SRID flag - the SRID follows the type, but isn't parsed here
+            raise NotImplementedError(f"WKB geometry type {wkb_type} with SRID")
+
+        # Extended WKB flags, then ISO WKB type codes
+        has_z = bool(wkb_type & 0x80000000)
+        has_m = bool(wkb_type & 0x40000000)
+        dims, base_type = divmod(wkb_type & 0x0FFFFFFF, 1000)
+        has_z = has_z or dims in (1, 3)
+        has_m = has_m or dims in (2, 3)
+
+        geojson_type = _WKB_GEOJSON_TYPES.get(base_type)
+        if geojson_type is None:
+            raise NotImplementedError(f"WKB geometry type {wkb_type}")
+        ndims = 2 + has_z + has_m
+        keep = 3 if has_z else 2
+
+        if base_type == 1:
+            [coords] = self._coords(bo, 1, ndims, keep)
+            # GPKG stores POINT EMPTY as POINT(nan nan)
+            if all(math.isnan(c) for c in coords):
+                coords = []
+        elif base_type == 2:
+            (count,) = self._unpack(f"{bo}I")
+            coords = self._coords(bo, count, ndims, keep)
+        elif base_type == 3:
+            (num_rings,) = self._unpack(f"{bo}I")
+            coords = []
+            for i in range(num_rings):
+                (count,) = self._unpack(f"{bo}I")
+                coords.append(self._coords(bo, count, ndims, keep))
+        else:
+            (num_parts,) = self._unpack(f"{bo}I")
+            parts = [self.geometry() for i in range(num_parts)]
+            if base_type == 7:
+                return {"type": geojson_type, "geometries": parts}
+            coords = [p["coordinates"] for p in parts]
+
+        return {"type": geojson_type, "coordinates": coords}
+
+
+def gpkg_geom_to_geojson(gpkg_geom):
+    """
+    Parse GeoPackage geometry values to a GeoJSON geometry dict.
+    This is a shortcut to avoid instantiating a full OGR geometry - the result is the
+    same as json.loads(gpkg_geom_to_ogr(gpkg_geom).ExportToJson()), which is only used
+    for geometry types that GeoJSON doesn't support (eg curves).
+    http://www.geopackage.org/spec/#gpb_format
+    """
+    if gpkg_geom is None:
+        return None
+    flags = _validate_gpkg_geom(gpkg_geom)
+
+    envelope_typ = (flags & 0b00001110) >> 1
+    if envelope_typ > 4:
+        raise ValueError("Invalid envelope contents indicator")
+    wkb_offset = 8 + (0, 32, 48, 48, 64)[envelope_typ]
+
+    try:
+        return _WKBToGeoJSON(gpkg_geom, wkb_offset).geometry()
+    except NotImplementedError:
+        return json.loads(gpkg_geom_to_ogr(gpkg_geom).ExportToJson())
+
+
 def wkb_to_gpkg_geom(wkb, **kwargs):
     ogr_geom = ogr.CreateGeometryFromWkb(wkb)
     return ogr_to_gpkg_geom(ogr_geom, **kwargs)
@@ -411,6 +559,16 @@ def geom_envelope(gpkg_geom):
     # 5-7: invalid
 
     if envelope_typ == 0:
+        # points are common, and their envelope is just the point
+        wkb_is_le = gpkg_geom[8] == 1
+        (wkb_type,) = struct.unpack_from("<I" if wkb_is_le else ">I", gpkg_geom, 9)
+        # ISO or (without an SRID) extended WKB Point
+        if (wkb_type & 0x2FFFFFFF) in (1, 1001, 2001, 3001):
+            x, y = struct.unpack_from("<dd" if wkb_is_le else ">dd", gpkg_geom, 13)
+            if math.isnan(x) or math.isnan(y):
+                return None
+            return (x, x, y, y)
+
         # parse the full geometry then get it's envelope
         ogr_geom = gpkg_geom_to_ogr(gpkg_geom)
         if ogr_geom.IsEmpty():
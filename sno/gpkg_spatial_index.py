@@ -0,0 +1,280 @@
+import contextlib
+import logging
+import struct
+import time
+
+from . import gpkg
+
+
+L = logging.getLogger("sno.gpkg_spatial_index")
+
+
+# The steps which spread the low 16 bits of an integer out to the even bits of a 32
+# bit integer - v = (v | (v << shift)) & mask - for interleaving x and y into a
+# Z-order (Morton) code.
+_SPREAD_BITS_STEPS = (
+    (8, 0x00FF00FF),
+    (4, 0x0F0F0F0F),
+    (2, 0x33333333),
+    (1, 0x55555555),
+)
+
+
+class GpkgSpatialIndex:
+    """
+    The GeoPackage spatial index of a table's geometry column - an SQLite R*Tree
+    virtual table named rtree_<table>_<column>, which is kept up to date by triggers
+    on the table. http://www.geopackage.org/spec/#extension_rtree
+
+    Rather than indexing rows one at a time, the index is bulk-loaded in Z-order -
+    which is much faster, and packs the tree better. For bulk changes to the table, the triggers can be
+    suspended and the index rebuilt afterwards - see suspended().
+    """
+
+    EXTENSION_NAME = "gpkg_rtree_index"
+    EXTENSION_DEFINITION = "http://www.geopackage.org/spec120/#extension_rtree"
+
+    def __init__(self, db, table, geom_col):
+        self.db = db
+        self.table = table
+        self.geom_col = geom_col
+
+    @property
+    def name(self):
+        return f"rtree_{self.table}_{self.geom_col}"
+
+    def exists(self):
+        dbcur = self.db.cursor()
+        dbcur.execute(
+            "SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type='table' AND name=?);",
+            (self.name,),
+        )
+        return bool(dbcur.fetchone()[0])
+
+    def create(self):
+        """Creates and populates the spatial index, and the triggers which maintain it."""
+        dbcur = self.db.cursor()
+        dbcur.execute(
+            f"""
+            CREATE VIRTUAL TABLE {gpkg.ident(self.name)}
+            USING rtree(id, minx, maxx, miny, maxy);
+            """
+        )
+        dbcur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS gpkg_extensions (
+                table_name TEXT,
+                column_name TEXT,
+                extension_name TEXT NOT NULL,
+                definition TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name)
+            );
+            """
+        )
+        dbcur.execute(
+            """
+            INSERT OR REPLACE INTO gpkg_extensions
+                (table_name, column_name, extension_name, definition, scope)
+            VALUES (?, ?, ?, ?, 'write-only');
+            """,
+            (
+                self.table,
+                self.geom_col,
+                self.EXTENSION_NAME,
+                self.EXTENSION_DEFINITION,
+            ),
+        )
+        self.rebuild()
+        for sql in self._trigger_sqls():
+            dbcur.execute(sql)
+
+    def rebuild(self):
+        """
+        Empties the spatial index, then bulk-loads it with the envelope of every
+        non-empty geometry in the table - ordered by the Z-order (Morton) code of their
+        centre point within the bounds of all of them, so entries which are near each
+        other are loaded near each other. It's all one statement, so the envelopes are
+        read from the geometries by spatialite, and sorted by SQLite.
+        """
+        t0 = time.monotonic()
+        pk_field = gpkg.pk(self.db, self.table)
+        g = gpkg.ident(self.geom_col)
+
+        spread_ctes = []
+        prev = "cells"
+        for i, (shift, mask) in enumerate(_SPREAD_BITS_STEPS):
+            spread_ctes.append(
+                f"""
+                spread{i} AS (
+                    SELECT id, minx, maxx, miny, maxy,
+                        (x | (x << {shift})) & {mask} AS x,
+                        (y | (y << {shift})) & {mask} AS y
+                    FROM {prev}
+                )"""
+            )
+            prev = f"spread{i}"
+
+        dbcur = self.db.cursor()
+        dbcur.execute(f"DELETE FROM {gpkg.ident(self.name)};")
+        dbcur.execute(
+            f"""
+            WITH
+                envelopes AS (
+                    SELECT {gpkg.ident(pk_field)} AS id,
+                        ST_MinX({g}) AS minx, ST_MaxX({g}) AS maxx,
+                        ST_MinY({g}) AS miny, ST_MaxY({g}) AS maxy
+                    FROM {gpkg.ident(self.table)}
+                    WHERE {g} NOT NULL AND NOT ST_IsEmpty({g})
+                ),
+                bounds AS (
+                    SELECT Min(minx) AS x0, Max(maxx) AS x1,
+                        Min(miny) AS y0, Max(maxy) AS y1
+                    FROM envelopes
+                ),
+                cells AS (
+                    SELECT id, minx, maxx, miny, maxy,
+                        CAST(((minx + maxx) / 2 - x0) * 65535
+                            / IFNULL(NULLIF(x1 - x0, 0), 1) AS INTEGER) AS x,
+                        CAST(((miny + maxy) / 2 - y0) * 65535
+                            / IFNULL(NULLIF(y1 - y0, 0), 1) AS INTEGER) AS y
+                    FROM envelopes, bounds
+                ),{','.join(spread_ctes)}
+            INSERT INTO {gpkg.ident(self.name)} (id, minx, maxx, miny, maxy)
+            SELECT id, minx, maxx, miny, maxy FROM {prev}
+            ORDER BY x | (y << 1);
+            """
+        )
+        L.info(
+            "Built spatial index %s with %d entries in %.1fs",
+            self.name,
+            self.db.changes(),
+            time.monotonic() - t0,
+        )
+
+    def bounds(self):
+        """
+        Returns the (minx, maxx, miny, maxy) bounds of everything in the index, from
+        the cells of the root node of the R*Tree - or None if the index is empty.
+        R*Tree coordinates are 32-bit floats rounded outwards, so the bounds can be
+        very slightly larger than the exact extent of the geometries.
+        """
+        dbcur = self.db.cursor()
+        dbcur.execute(
+            f"SELECT data FROM {gpkg.ident(self.name + '_node')} WHERE nodeno=1;"
+        )
+        data = dbcur.fetchone()[0]
+        # This is the on-disk format of an SQLite R*Tree node - see "Integrity Check"
+        # at https://sqlite.org/rtree.html, and the comments at the top of rtree.c.
+        # A node is a 2-byte tree depth (only meaningful in the root node), a 2-byte
+        # cell count, then the cells - each an 8-byte rowid (or child node number)
+        # and four 4-byte floats (minx, maxx, miny, maxy) - all big-endian.
+        (cell_count,) = struct.unpack_from(">H", data, 2)
+        if not cell_count:
+            return None
+        cells = [
+            struct.unpack_from(">q4f", data, 4 + i * 24) for i in range(cell_count)
+        ]
+        return (
+            min(c[1] for c in cells),
+            max(c[2] for c in cells),
+            min(c[3] for c in cells),
+            max(c[4] for c in cells),
+        )
+
+    def _existing_triggers(self):
+        """Returns (name, sql) for each of the triggers which maintain the index."""
+        prefix = f"{self.name}_"
+        dbcur = self.db.cursor()
+        dbcur.execute(
+            """
+            SELECT name, sql FROM sqlite_master
+            WHERE type='trigger' AND tbl_name=? AND substr(name, 1, ?)=?;
+            """,
+            (self.table, len(prefix), prefix),
+        )
+        return dbcur.fetchall()
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """
+        Contextmanager. Drops the triggers which maintain the spatial index, and on
+        exit rebuilds the index and recreates the triggers - for bulk changes, where
+        that's much faster than updating the index one row at a time.
+        Does nothing if there is no spatial index.
+        """
+        triggers = self._existing_triggers()
+        if not triggers:
+            yield
+            return
+
+        dbcur = self.db.cursor()
+        for name, sql in triggers:
+            dbcur.execute(f"DROP TRIGGER {gpkg.ident(name)};")
+        try:
+            yield
+        finally:
+            self.rebuild()
+            for name, sql in triggers:
+                dbcur.execute(sql)
+
+    def _trigger_sqls(self):
+        """The triggers from the GeoPackage spec which maintain the spatial index."""
+        t = gpkg.ident(self.table)
+        c = gpkg.ident(self.geom_col)
+        i = gpkg.ident(gpkg.pk(self.db, self.table))
+        rtree = gpkg.ident(self.name)
+
+        def trigger_name(suffix):
+            return gpkg.ident(f"{self.name}_{suffix}")
+
+        insert_new = f"""
+            INSERT OR REPLACE INTO {rtree} VALUES (
+                NEW.{i}, ST_MinX(NEW.{c}), ST_MaxX(NEW.{c}), ST_MinY(NEW.{c}), ST_MaxY(NEW.{c})
+            );
+        """
+        return [
+            f"""
+            CREATE TRIGGER {trigger_name('insert')} AFTER INSERT ON {t}
+            WHEN (NEW.{c} NOT NULL AND NOT ST_IsEmpty(NEW.{c}))
+            BEGIN
+                {insert_new}
+            END;
+            """,
+            f"""
+            CREATE TRIGGER {trigger_name('update1')} AFTER UPDATE OF {c} ON {t}
+            WHEN OLD.{i} = NEW.{i} AND (NEW.{c} NOT NULL AND NOT ST_IsEmpty(NEW.{c}))
+            BEGIN
+                {insert_new}
+            END;
+            """,
+            f"""
+            CREATE TRIGGER {trigger_name('update2')} AFTER UPDATE OF {c} ON {t}
+            WHEN OLD.{i} = NEW.{i} AND (NEW.{c} IS NULL OR ST_IsEmpty(NEW.{c}))
+            BEGIN
+                DELETE FROM {rtree} WHERE id = OLD.{i};
+            END;
+            """,
+            f"""
+            CREATE TRIGGER {trigger_name('update3')} AFTER UPDATE ON {t}
+            WHEN OLD.{i} != NEW.{i} AND (NEW.{c} NOT NULL AND NOT ST_IsEmpty(NEW.{c}))
+            BEGIN
+                DELETE FROM {rtree} WHERE id = OLD.{i};
+                {insert_new}
+            END;
+            """,
+            f"""
+            CREATE TRIGGER {trigger_name('update4')} AFTER UPDATE ON {t}
+            WHEN OLD.{i} != NEW.{i} AND (NEW.{c} IS NULL OR ST_IsEmpty(NEW.{c}))
+            BEGIN
+                DELETE FROM {rtree} WHERE id IN (OLD.{i}, NEW.{i});
+            END;
+            """,
+            f"""
+            CREATE TRIGGER {trigger_name('delete')} AFTER DELETE ON {t}
+            WHEN OLD.{c} NOT NULL
+            BEGIN
+                DELETE FROM {rtree} WHERE id = OLD.{i};
+            END;
+            """,
+        ]
@@ -0,0 +1,130 @@
+import collections
+import itertools
+import logging
+from collections.abc import Mapping
+
+
+L = logging.getLogger("sno.lazy_feature")
+
+
+class LazyFeature(Mapping):
+    """
+    A feature in a dataset tree that isn't decoded until one of its values is needed.
+
+    The primary key is decoded from the feature's path, and the blob ID comes from the
+    tree diff it was found in - so the primary key can be looked up, and two versions
+    of a feature can be compared by blob ID, without decoding either of them.
+    Otherwise it behaves like the (read-only) dict that get_feature would return.
+    """
+
+    __slots__ = ("dataset", "path", "blob_id", "pk", "_feature")
+
+    def __init__(self, dataset, path, blob_id):
+        # @dataset: the DatasetStructure whose tree contains the feature
+        # @path: the feature's path, relative to the dataset tree
+        self.dataset = dataset
+        self.path = path
+        self.blob_id = blob_id
+        self.pk = dataset.decode_path_to_1pk(path)
+        self._feature = None
+
+    @property
+    def is_resolved(self):
+        return self._feature is not None
+
+    def resolve(self, blob=None):
+        """Decodes the feature, if it hasn't been already, and returns it as a dict."""
+        if self._feature is None:
+            if blob is None:
+                blob = self.dataset.tree / self.path
+            self._feature = self.dataset.get_feature_from_blob(blob)
+        return self._feature
+
+    def __getitem__(self, key):
+        if self._feature is None and key == self.dataset.primary_key:
+            return self.pk
+        return self.resolve()[key]
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __contains__(self, key):
+        return key in self.resolve()
+
+    def keys(self):
+        return self.resolve().keys()
+
+    def items(self):
+        return self.resolve().items()
+
+    def values(self):
+        return self.resolve().values()
+
+    def __eq__(self, other):
+        if (
+            isinstance(other, LazyFeature)
+            and other.blob_id == self.blob_id
+            and other.pk == self.pk
+        ):
+            return True
+        if isinstance(other, LazyFeature):
+            other = other.resolve()
+        return self.resolve() == other
+
+    def __repr__(self):
+        # Doesn't decode the feature, since diffs are often repr()'d for debug logs.
+        if self._feature is not None:
+            return repr(self._feature)
+        return f"<LazyFeature {self.dataset.path}:{self.pk} blob={self.blob_id}>"
+
+
+def resolve_features(features, *, batch_size=1000):
+    """
+    Decodes all the LazyFeatures in the given iterable - anything else is ignored.
+
+    They are decoded in batches of batch_size. Each batch is sorted by dataset and path,
+    so features in the same subtree are decoded together and each subtree is only looked
+    up once per batch - see DatasetStructure.get_features_bulk.
+    """
+    unresolved = (
+        f for f in features if isinstance(f, LazyFeature) and not f.is_resolved
+    )
+    count = 0
+    while True:
+        batch = list(itertools.islice(unresolved, batch_size))
+        if not batch:
+            break
+
+        by_dataset = collections.defaultdict(list)
+        for feature in batch:
+            by_dataset[id(feature.dataset)].append(feature)
+
+        for ds_features in by_dataset.values():
+            subtree_path, subtree = None, None
+            for feature in sorted(ds_features, key=lambda f: f.path):
+                dir_path, name = feature.path.rsplit("/", 1)
+                if dir_path != subtree_path:
+                    subtree_path = dir_path
+                    subtree = feature.dataset.tree / dir_path
+                feature.resolve(subtree / name)
+        count += len(batch)
+
+    if count:
+        L.debug("Resolved %d features", count)
+
+
+def iter_dataset_diff_features(dataset_diff):
+    """Generator. Yields every feature in the given dataset diff, old and new."""
+    yield from dataset_diff["I"]
+    yield from dataset_diff["D"].values()
+    for old, new in dataset_diff["U"].values():
+        yield old
+        yield new
+
+
+def resolve_dataset_diff(dataset_diff, **kwargs):
+    """Decodes all the LazyFeatures in the given dataset diff - see resolve_features."""
+    resolve_features(iter_dataset_diff_features(dataset_diff), **kwargs)
@@ -9,7 +9,7 @@ from .conflicts import (
     list_conflicts,
     conflicts_json_as_text,
 )
-from .diff import get_repo_diff
+from .diff import get_repo_diff_counts
 from .exceptions import InvalidOperation
 from .merge_util import AncestorOursTheirs, MergeIndex, MergeContext
 from .output_util import dump_json_output
@@ -39,7 +39,7 @@ def get_commit_message(
         merge_message = merge_context.get_message()
     head = RepositoryStructure.lookup(repo, "HEAD")
     merged = RepositoryStructure.lookup(repo, merge_tree_id)
-    diff = get_repo_diff(head, merged)
+    diff = get_repo_diff_counts(head, merged)
     return commit.get_commit_message(
         repo, diff, draft_message=merge_message, quiet=quiet
     )
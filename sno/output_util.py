@@ -39,20 +39,68 @@ def dump_json_output(output, output_path, json_style="pretty"):
     fp.write(format_json_for_output(output, fp, json_style=json_style))
 
 
-def resolve_output_path(output_path):
+class JsonFragmentFormatter:
+    """
+    Formats a JSON document piece by piece - for documents which are written out as
+    they are generated, rather than held in memory and dumped all at once.
+    The caller writes the brackets and keys; values are dumped and indented to match
+    the given json_style. No syntax highlighting is added.
+    """
+
+    def __init__(self, json_style="pretty"):
+        self.params = JSON_PARAMS[json_style]
+        self.indent = self.params.get("indent")
+        item_separator, self.key_separator = self.params.get(
+            "separators", (", ", ": ")
+        )
+        # When indenting, the json module puts newlines after item separators instead.
+        self.item_separator = "," if self.indent else item_separator
+
+    def newline(self, level):
+        """Returns the whitespace that starts a new line at the given nesting level."""
+        return "\n" + " " * (self.indent * level) if self.indent else ""
+
+    def dumps(self, obj, level=0):
+        """Dumps obj as JSON, for writing at the given nesting level."""
+        dumped = json.dumps(obj, **self.params)
+        return dumped.replace("\n", self.newline(level)) if self.indent else dumped
+
+    def key(self, key, level):
+        """Returns an object key and separator, starting a new line at the given level."""
+        return self.newline(level) + json.dumps(key) + self.key_separator
+
+    def iter_array(self, items, level):
+        """
+        Generator. Yields the pieces of a JSON array containing the given items,
+        for writing at the given nesting level. Items are dumped one at a time.
+        """
+        yield "["
+        empty = True
+        for item in items:
+            yield (
+                ("" if empty else self.item_separator)
+                + self.newline(level + 1)
+                + self.dumps(item, level + 1)
+            )
+            empty = False
+        yield "]" if empty else self.newline(level) + "]"
+
+
+def resolve_output_path(output_path, binary=False):
     """
     Takes a path-ish thing, and returns the appropriate writable file-like object.
     The path-ish thing could be:
       * a pathlib.Path object
       * a file-like object
       * the string '-' or None (both will return sys.stdout)
+    If binary is True, the file-like object returned accepts bytes instead of str.
     """
     if isinstance(output_path, io.IOBase):
         return output_path
     elif (not output_path) or output_path == "-":
-        return sys.stdout
+        return sys.stdout.buffer if binary else sys.stdout
     else:
-        return output_path.open("w")
+        return output_path.open("wb" if binary else "w")
 
 
 class InputMode:
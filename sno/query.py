@@ -9,7 +9,9 @@ import types
 import click
 from osgeo import ogr
 
-from . import structure
+from . import gpkg, structure
+from .attribute_index import AttributeIndex, cast_column_value
+from .diff_output import geojson_row
 from .exceptions import NotFound
 
 
@@ -23,25 +25,77 @@ def _json_encode_default(o):
     if isinstance(o, ogr.Geometry):
         return json.loads(o.ExportToJson())
 
+    if isinstance(o, bytes):
+        # features decoded without OGR have their geometries as GPKG geometry blobs.
+        return _json_encode_default(gpkg.gpkg_geom_to_ogr(o))
+
     if isinstance(o, (datetime.date, datetime.datetime, datetime.time)):
         return o.isoformat()
 
     raise TypeError(f"Object of type {type(o)} is not JSON serializable")
 
 
+def _write_features_bulk(dataset, pk_file, output_format, fp):
+    """
+    Reads primary keys from pk_file (one per line) and writes each feature found
+    to fp as soon as it is decoded - either as newline-delimited JSON,
+    or as a GeoJSON text sequence (RFC 8142).
+    Primary keys which aren't found in the dataset are skipped.
+    """
+    pk_field = dataset.primary_key
+    pks = (line.strip() for line in pk_file)
+    pks = (pk for pk in pks if pk)
+
+    count = 0
+    for pk, feature in dataset.get_features_bulk(pks, ignore_missing=True):
+        if output_format == "geojsonseq":
+            # Each GeoJSON text is preceded by an ASCII record separator.
+            fp.write("\x1e")
+            feature = geojson_row(feature, pk_field)
+        json.dump(feature, fp, default=_json_encode_default)
+        fp.write("\n")
+        count += 1
+    return count
+
+
 @click.command("query", hidden=True)
 @click.pass_context
+@click.option(
+    "--output-format",
+    "-o",
+    type=click.Choice(["ndjson", "geojsonseq"]),
+    default="ndjson",
+    help="Output format for get-bulk: one JSON feature per line, or a GeoJSON text sequence",
+)
 @click.argument("path")
 @click.argument(
     "command",
-    type=click.Choice(("get", "geo-nearest", "geo-intersects", "geo-count", "index")),
+    type=click.Choice(
+        (
+            "get",
+            "get-bulk",
+            "where",
+            "geo-nearest",
+            "geo-intersects",
+            "geo-count",
+            "index",
+        )
+    ),
     required=True,
 )
 @click.argument("params", nargs=-1, required=False)
-def query(ctx, path, command, params):
+def query(ctx, output_format, path, command, params):
     """
     Find features in a Dataset
 
+    get-bulk [FILE] reads primary keys from FILE (or stdin) - one per line - and
+    writes the features to stdout as they are found. It doesn't need a spatial index.
+
+    index COLUMN [COLUMN...] builds attribute indexes on the given columns.
+    where COLUMN OP VALUE [VALUE] uses them to find features, where OP is one of
+    = < <= > >= (or eq lt le gt ge), or between - which takes two values.
+    Attribute indexes are brought up to date with the dataset before each lookup.
+
     WARNING: Spatial indexing is a proof of concept.
     Significantly, indexes don't update when the repo changes in any way.
     """
@@ -49,8 +103,30 @@ def query(ctx, path, command, params):
     rs = structure.RepositoryStructure(repo)
     dataset = rs[path]
 
+    if command == "get-bulk":
+        USAGE = "get-bulk [FILE]"
+        if len(params) > 1:
+            raise click.BadParameter(USAGE)
+
+        t0 = time.monotonic()
+        with click.open_file(params[0] if params else "-", encoding="utf-8") as f:
+            count = _write_features_bulk(dataset, f, output_format, sys.stdout)
+        L.debug("Output %d features in %0.3fs", count, time.monotonic() - t0)
+        return
+
     if command == "index":
-        USAGE = "index"
+        USAGE = "index [COLUMN...]"
+
+        if params:
+            index = AttributeIndex.for_dataset(repo, dataset)
+            for column in params:
+                t0 = time.monotonic()
+                try:
+                    index.build(dataset, column)
+                except ValueError as e:
+                    raise click.BadParameter(f"{e}\n{USAGE}") from e
+                L.debug("Indexed %s.%s in %0.3fs", path, column, time.monotonic() - t0)
+            return
 
         t0 = time.monotonic()
         dataset.build_spatial_index(dataset.name)
@@ -58,12 +134,35 @@ def query(ctx, path, command, params):
         L.debug("Indexed {dataset} in %0.3fs", t1 - t0)
         return
 
-    try:
-        dataset.get_spatial_index(dataset.name)
-    except OSError:
-        raise NotFound("No spatial index found. Run `sno query {path} index`")
+    if command != "where":
+        try:
+            dataset.get_spatial_index(dataset.name)
+        except OSError:
+            raise NotFound("No spatial index found. Run `sno query {path} index`")
+
+    if command == "where":
+        USAGE = "where COLUMN OP VALUE [VALUE]"
+        if len(params) not in (3, 4) or params[1] not in AttributeIndex.OPERATORS:
+            raise click.BadParameter(USAGE)
+
+        column, op, *values = params
+        index = AttributeIndex.for_dataset(repo, dataset)
+        if index.indexed_tree(column) is None:
+            raise NotFound(
+                f"No index found for {column}. Run `sno query {path} index {column}`"
+            )
+
+        try:
+            values = [cast_column_value(dataset, column, v) for v in values]
+            index.update(repo, dataset, column)
+            t0 = time.monotonic()
+            pks = index.lookup(column, op, *values)
+            results = [feature for pk, feature in dataset.get_features_bulk(pks)]
+        except ValueError as e:
+            raise click.BadParameter(f"{e}\n{USAGE}") from e
+        t1 = time.monotonic()
 
-    if command == "get":
+    elif command == "get":
         USAGE = "get PK"
         if len(params) != 1:
             raise click.BadParameter(USAGE)
@@ -20,9 +20,12 @@ EMPTY_TREE_SHA = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
 @click.option(
     "--output-format",
     "-o",
-    type=click.Choice(["text", "json", "patch"]),
+    type=click.Choice(["text", "json", "patch", "msgpack"]),
     default="text",
-    help="Output format. 'patch' is a synonym for 'json'",
+    help=(
+        "Output format. 'patch' is a synonym for 'json'. "
+        "'msgpack' is a binary patch, which is faster to generate and apply"
+    ),
 )
 @click.option(
     "--json-style",
@@ -138,17 +141,37 @@ def patch_output_json(*, target, output_path, json_style, **kwargs):
     # the diff output in it. Now we can add some patch info
     buf.seek(0)
     output = json.load(buf)
-    commit = target.head_commit
+    output['sno.patch/v1'] = patch_metadata(target.head_commit)
+
+    dump_json_output(output, original_output_path, json_style=json_style)
+
+
+@contextlib.contextmanager
+def patch_output_msgpack(*, target, **kwargs):
+    """
+    Contextmanager.
+
+    Same arguments and usage as `patch_output_text`; see that docstring for usage.
+
+    Writes the patch as a msgpack stream (see `sno.diff.diff_output_msgpack`), with
+    the same metadata about the commit as `patch_output_json` in the header.
+    """
+    with diff.diff_output_msgpack(
+        patch=patch_metadata(target.head_commit), **kwargs
+    ) as diff_writer:
+        yield diff_writer
+
+
+def patch_metadata(commit):
+    """Returns the "sno.patch/v1" metadata for the given commit."""
     author = commit.author
     author_time = datetime.fromtimestamp(author.time, timezone.utc)
     author_time_offset = timedelta(minutes=author.offset)
 
-    output['sno.patch/v1'] = {
+    return {
         'authorName': author.name,
         'authorEmail': author.email,
         "authorTime": datetime_to_iso8601_utc(author_time),
         "authorTimeOffset": timedelta_to_iso8601_tz(author_time_offset),
         "message": commit.message,
     }
-
-    dump_json_output(output, original_output_path, json_style=json_style)
@@ -0,0 +1,255 @@
+import logging
+import re
+import threading
+from pathlib import Path
+
+import apsw
+import click
+import pygit2
+
+from . import gpkg
+from .lazy_feature import LazyFeature
+
+
+L = logging.getLogger("sno.spatial_filter")
+
+
+class BBoxType(click.ParamType):
+    """Click parameter type for a bounding box: MINX,MINY,MAXX,MAXY"""
+
+    name = "bbox"
+
+    def convert(self, value, param, ctx):
+        try:
+            coords = [float(c) for c in re.split(r"[ ,]+", value.strip())]
+        except ValueError:
+            coords = []
+        if len(coords) != 4:
+            self.fail(f"Expected MINX,MINY,MAXX,MAXY, got {value!r}", param, ctx)
+
+        min_x, min_y, max_x, max_y = coords
+        if min_x > max_x or min_y > max_y:
+            self.fail(f"Invalid bounding box {value!r}: min > max", param, ctx)
+        return tuple(coords)
+
+
+class EnvelopeCache:
+    """
+    Persistent cache of the 2D envelope of each feature blob, keyed by blob ID.
+
+    A blob ID is a hash of the feature's contents, so an envelope that was calculated
+    while diffing one pair of commits is still valid when diffing any other commits
+    that contain the same feature blob - only new blobs need to be decoded.
+    Features with no geometry, or with an empty geometry, are cached as None.
+    An EnvelopeCache can be shared between threads.
+    """
+
+    _MISSING = object()
+
+    # How long to wait for another process to finish writing to the cache.
+    BUSY_TIMEOUT_MS = 10000
+
+    @classmethod
+    def for_repo(cls, repo):
+        return cls(Path(repo.path) / "envelopes.sno-cache")
+
+    def __init__(self, path):
+        self.path = path
+        self.db = apsw.Connection(str(path))
+        self.db.setbusytimeout(self.BUSY_TIMEOUT_MS)
+        self.db.cursor().execute(
+            """
+            CREATE TABLE IF NOT EXISTS envelopes (
+                blob_id TEXT PRIMARY KEY NOT NULL,
+                min_x REAL,
+                max_x REAL,
+                min_y REAL,
+                max_y REAL
+            );
+            """
+        )
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, blob_id, default=None):
+        blob_id = str(blob_id)
+        with self._lock:
+            if blob_id in self._pending:
+                return self._pending[blob_id]
+
+            row = (
+                self.db.cursor()
+                .execute(
+                    "SELECT min_x, max_x, min_y, max_y FROM envelopes WHERE blob_id=?;",
+                    (blob_id,),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return default
+        return None if row[0] is None else tuple(row)
+
+    def __setitem__(self, blob_id, envelope):
+        with self._lock:
+            self._pending[str(blob_id)] = envelope
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        with self.db:
+            self.db.cursor().executemany(
+                "INSERT OR REPLACE INTO envelopes (blob_id, min_x, max_x, min_y, max_y) VALUES (?, ?, ?, ?, ?);",
+                (
+                    (blob_id, *(envelope or (None, None, None, None)))
+                    for blob_id, envelope in self._pending.items()
+                ),
+            )
+        L.debug("Cached %d envelopes", len(self._pending))
+        self._pending = {}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class SpatialFilter:
+    """
+    Matches features whose envelope intersects a bounding box.
+
+    Feature blobs found in a tree diff can be checked without decoding them if their
+    envelope is already in the EnvelopeCache. Features which have already been
+    decoded (eg, from the working copy) are checked directly.
+    """
+
+    def __init__(self, bbox, envelope_cache=None, exempt_pks=frozenset()):
+        self.bbox = bbox
+        self.envelope_cache = envelope_cache
+        # Features that match regardless of their geometry - stored as strings,
+        # like the values of a feature filter.
+        self.exempt_pks = exempt_pks
+
+    def exempting(self, pks):
+        """Returns a copy of this filter that also matches the given primary keys."""
+        return SpatialFilter(
+            self.bbox, self.envelope_cache, frozenset(str(pk) for pk in pks)
+        )
+
+    def matches_envelope(self, envelope):
+        if envelope is None:
+            return False
+        min_x, max_x, min_y, max_y = envelope
+        b_min_x, b_min_y, b_max_x, b_max_y = self.bbox
+        return (
+            min_x <= b_max_x
+            and max_x >= b_min_x
+            and min_y <= b_max_y
+            and max_y >= b_min_y
+        )
+
+    def matches_feature(self, dataset, feature):
+        """
+        Feature should be a dict with its geometry as a GPKG geometry blob,
+        or a LazyFeature - which is only decoded if its envelope isn't cached.
+        """
+        if not dataset.has_geometry:
+            return False
+        if str(feature[dataset.primary_key]) in self.exempt_pks:
+            return True
+
+        blob_id = None
+        if isinstance(feature, LazyFeature) and self.envelope_cache is not None:
+            blob_id = feature.blob_id
+        envelope = EnvelopeCache._MISSING
+        if blob_id is not None:
+            envelope = self.envelope_cache.get(blob_id, EnvelopeCache._MISSING)
+
+        if envelope is EnvelopeCache._MISSING:
+            envelope = gpkg.geom_envelope(feature[dataset.geom_column_name])
+            if blob_id is not None:
+                self.envelope_cache[blob_id] = envelope
+
+        return self.matches_envelope(envelope)
+
+    def matches_blob(self, dataset, pk, rel_path, blob_id):
+        """
+        Checks the feature blob at rel_path in the given dataset.
+        It is only decoded if its envelope isn't cached.
+        """
+        if not dataset.has_geometry:
+            return False
+        if str(pk) in self.exempt_pks:
+            return True
+
+        envelope = EnvelopeCache._MISSING
+        if self.envelope_cache is not None:
+            envelope = self.envelope_cache.get(blob_id, EnvelopeCache._MISSING)
+
+        if envelope is EnvelopeCache._MISSING:
+            feature = dataset.get_feature_from_blob(dataset.tree / rel_path)
+            envelope = gpkg.geom_envelope(feature[dataset.geom_column_name])
+            if self.envelope_cache is not None:
+                self.envelope_cache[blob_id] = envelope
+
+        return self.matches_envelope(envelope)
+
+    def feature_tuples(self, dataset, col_names):
+        """
+        Generator. Like dataset.feature_tuples, but only yields the features which
+        match. Feature blobs whose envelope is already cached are only decoded if they
+        match.
+        """
+        for blob in dataset.feature_blobs():
+            feature = None
+            envelope = EnvelopeCache._MISSING
+            if self.envelope_cache is not None:
+                envelope = self.envelope_cache.get(blob.id, EnvelopeCache._MISSING)
+
+            if envelope is EnvelopeCache._MISSING:
+                feature = dataset.get_feature_from_blob(blob)
+                envelope = gpkg.geom_envelope(feature[dataset.geom_column_name])
+                if self.envelope_cache is not None:
+                    self.envelope_cache[blob.id] = envelope
+
+            if self.matches_envelope(envelope):
+                if feature is None:
+                    feature = dataset.get_feature_from_blob(blob)
+                yield tuple(feature[c] for c in col_names)
+
+    def matches_delta(self, old, new, delta):
+        """
+        Checks a delta from a diff between the trees of two versions of a dataset.
+        Matches if either the old or the new version of the feature matches.
+        """
+        if delta.status != pygit2.GIT_DELTA_ADDED:
+            old_pk = old.decode_path_to_1pk(delta.old_file.path)
+            if self.matches_blob(old, old_pk, delta.old_file.path, delta.old_file.id):
+                return True
+        if delta.status != pygit2.GIT_DELTA_DELETED:
+            new_pk = new.decode_path_to_1pk(delta.new_file.path)
+            if self.matches_blob(new, new_pk, delta.new_file.path, delta.new_file.id):
+                return True
+        return False
+
+    def filter_dataset_diff(self, dataset, ds_diff):
+        """
+        Given the diff for a single dataset - {"META": ..., "I": ..., "U": ..., "D": ...} -
+        returns a new one containing only the features that match.
+        """
+
+        def _matches(feature):
+            return self.matches_feature(dataset, feature)
+
+        return {
+            "META": ds_diff["META"],
+            "I": [o for o in ds_diff["I"] if _matches(o)],
+            "U": {
+                k: (o, n)
+                for k, (o, n) in ds_diff["U"].items()
+                if _matches(o) or _matches(n)
+            },
+            "D": {k: o for k, o in ds_diff["D"].items() if _matches(o)},
+        }
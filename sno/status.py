@@ -4,6 +4,7 @@ import click
 import pygit2
 
 from .conflicts import list_conflicts
+from .diff import get_repo_diff_counts
 from .output_util import dump_json_output
 from .structure import RepositoryStructure
 from .repo_files import RepoState
@@ -76,7 +77,7 @@ def get_working_copy_status_json(repo):
 
     output = {"path": working_copy.path, "changes": None}
 
-    wc_diff = working_copy.diff_to_tree(rs)
+    wc_diff = get_repo_diff_counts(rs, rs, working_copy)
     if wc_diff:
         output["changes"] = get_diff_status_json(wc_diff)
 
@@ -84,7 +85,10 @@ def get_working_copy_status_json(repo):
 
 
 def get_diff_status_json(diff):
-    """Given a diff.Diff object, returns a JSON object describing the diff status."""
+    """
+    Given a diff.Diff or diff.DiffCounts object, returns a JSON object describing
+    the diff status.
+    """
     output = {}
     for dataset_path, counts in diff.counts().items():
         if sum(counts.values()):
@@ -198,7 +202,7 @@ def get_branch_status_message(repo):
 
 
 def get_diff_status_message(diff):
-    """Given a diff.Diff, return a status message describing it."""
+    """Given a diff.Diff or diff.DiffCounts, return a status message describing it."""
     return diff_status_to_text(get_diff_status_json(diff))
 
 
@@ -18,6 +18,7 @@ from .exceptions import (
     PATCH_DOES_NOT_APPLY,
 )
 from .filter_util import UNFILTERED
+from .lazy_feature import LazyFeature
 from .structure_version import get_structure_version
 
 
@@ -372,13 +373,134 @@ class DatasetStructure:
     def get_feature(self, pk_value):
         raise NotImplementedError()
 
-    def feature_tuples(self, col_names, **kwargs):
-        """ Feature iterator yielding tuples, ordered by the columns from col_names """
+    def get_feature_from_blob(self, blob, **kwargs):
+        """Decodes the given feature blob - as found in this dataset's tree - into a feature."""
+        raise NotImplementedError()
+
+    def cast_primary_key(self, pk_value):
+        """Casts a primary key value (eg, supplied by the user as text) to the right type."""
+        raise NotImplementedError()
+
+    def get_features_bulk(
+        self, pk_values, *, ignore_missing=False, batch_size=1000, **kwargs
+    ):
+        """
+        Generator. Looks up many features by primary key, yielding (pk, feature) tuples.
+
+        pk_values is consumed lazily, batch_size primary keys at a time, so it can be
+        a generator of any length. Each batch is sorted by feature path before it is
+        resolved, so features in the same subtree are found together and each subtree
+        is only looked up once per batch. This means results are yielded in path order
+        within each batch, not in the order they were requested.
+
+        Any remaining kwargs are passed to get_feature_from_blob.
+        """
+        for pk, blob in self.get_feature_blobs_bulk(pk_values, batch_size=batch_size):
+            if blob is None:
+                if ignore_missing:
+                    continue
+                raise KeyError(self.encode_1pk_to_path(pk, relative=True))
+
+            yield pk, self.get_feature_from_blob(blob, **kwargs)
+
+    def get_feature_blobs_bulk(self, pk_values, *, batch_size=1000):
+        """
+        Generator. Looks up the blobs of many features by primary key without decoding
+        them, yielding (pk, blob) tuples - blob is None if there is no such feature.
+        Primary keys are cast to the right type, and are batched and sorted by path in
+        the same way as get_features_bulk.
+        """
+        pk_iter = iter(pk_values)
+        while True:
+            batch = tuple(itertools.islice(pk_iter, batch_size))
+            if not batch:
+                return
+
+            batch_paths = set()
+            for pk in batch:
+                pk = self.cast_primary_key(pk)
+                batch_paths.add((self.encode_1pk_to_path(pk, relative=True), pk))
+
+            subtree_path, subtree = None, None
+            for rel_path, pk in sorted(batch_paths, key=lambda p: p[0]):
+                dir_path, name = rel_path.rsplit("/", 1)
+                if dir_path != subtree_path:
+                    subtree_path = dir_path
+                    try:
+                        subtree = self.tree / dir_path
+                    except KeyError:
+                        subtree = None
+
+                try:
+                    if subtree is None:
+                        raise KeyError(rel_path)
+                    blob = subtree / name
+                except KeyError:
+                    blob = None
+
+                yield pk, blob
+
+    def get_feature_blob_id(self, pk_value):
+        """
+        Returns the ID of the blob that the feature with the given primary key is
+        stored in - without decoding it - or None if there is no such feature.
+        """
+        pk_value = self.cast_primary_key(pk_value)
+        try:
+            return (self.tree / self.encode_1pk_to_path(pk_value, relative=True)).id
+        except KeyError:
+            return None
+
+    def feature_stub(self, pk_value, blob_id):
+        """
+        Returns a stand-in for a feature that hasn't been decoded, for diffs that only
+        count changes. It contains just the primary key and the ID of the feature blob,
+        which is enough to tell whether two versions of a feature are the same.
+        """
+        return {self.primary_key: pk_value, "__blob_id": str(blob_id)}
+
+    def feature_tuples(self, col_names, *, partition=None, **kwargs):
+        """
+        Feature iterator yielding tuples, ordered by the columns from col_names.
+        If partition is given, only the features in that partition are included.
+        """
 
         # not optimised in V0
-        for k, f in self.features():
+        for k, f in self.features(partition=partition):
             yield tuple(f[c] for c in col_names)
 
+    def feature_blobs(self):
+        """
+        Iterates over the blob of every feature in this dataset, without decoding them.
+        Each blob's name is the last component of the feature's path.
+        """
+        raise NotImplementedError()
+
+    def feature_partitions(self):
+        """
+        Returns the names of partitions which split up this dataset's features - the
+        top level of the tree they're stored in. Any of them can be passed to
+        feature_tuples, so that partitions can be decoded separately (eg. in parallel).
+        """
+        raise NotImplementedError()
+
+    def feature_buckets(self):
+        """
+        Returns {bucket: tree} for each bucket of this dataset - the "xx/yy" subtrees
+        which features are stored in, by the hash of their primary key. Two versions of
+        a bucket with the same tree ID contain exactly the same features.
+        """
+        raise NotImplementedError()
+
+    def feature_bucket(self, pk_value):
+        """
+        Returns (bucket, name) for the feature with the given primary key - the bucket
+        it is stored in (see feature_buckets) and the name of its blob in the bucket.
+        """
+        path = self.encode_1pk_to_path(pk_value, relative=True)
+        *_, dir1, dir2, name = path.split("/")
+        return f"{dir1}/{dir2}", name
+
     RTREE_INDEX_EXTENSIONS = ("sno-idxd", "sno-idxi")
 
     def build_spatial_index(self, path):
@@ -442,17 +564,65 @@ class DatasetStructure:
         idx = rtree.index.Index(path, properties=p)
         return idx
 
-    def diff(self, other, pk_filter=UNFILTERED, reverse=False):
+    def diff(self, other, pk_filter=UNFILTERED, reverse=False, spatial_filter=None):
         """
         Generates a Diff from self -> other.
         If reverse is true, generates a diff from other -> self.
+        The features in the Diff are LazyFeatures, which aren't decoded until used.
         """
-        # TODO - support multiple primary keys.
-
         candidates_ins = defaultdict(list)
         candidates_upd = {}
         candidates_del = defaultdict(list)
 
+        for change, key, old_feature, new_feature in self.diff_stream(
+            other, pk_filter=pk_filter, reverse=reverse, spatial_filter=spatial_filter
+        ):
+            if change == "D":
+                candidates_del[key].append((key, old_feature))
+            elif change == "U":
+                candidates_upd[key] = (old_feature, new_feature)
+            elif change == "I":
+                candidates_ins[key].append(new_feature)
+
+        # detect renames
+        for h in list(candidates_del.keys()):
+            if h in candidates_ins:
+                track_pk, my_obj = candidates_del[h].pop(0)
+                other_obj = candidates_ins[h].pop(0)
+
+                candidates_upd[track_pk] = (my_obj, other_obj)
+
+                if not candidates_del[h]:
+                    del candidates_del[h]
+                if not candidates_ins[h]:
+                    del candidates_ins[h]
+
+        from .diff import Diff
+
+        return Diff(
+            self,
+            meta={},
+            inserts=list(itertools.chain(*candidates_ins.values())),
+            deletes=dict(itertools.chain(*candidates_del.values())),
+            updates=candidates_upd,
+        )
+
+    def diff_stream(
+        self,
+        other,
+        pk_filter=UNFILTERED,
+        reverse=False,
+        spatial_filter=None,
+        stat_only=False,
+    ):
+        """
+        Generator. Like diff, but yields change records as each delta is found,
+        instead of building a Diff - see diff.get_dataset_diff_stream.
+        Features are LazyFeatures, which aren't decoded until they are used.
+        If stat_only is True, features are stubs instead - see feature_stub.
+        """
+        # TODO - support multiple primary keys.
+
         params = {}
         if reverse:
             params = {"swap": True}
@@ -494,17 +664,24 @@ class DatasetStructure:
                 old_pk = old.decode_path_to_1pk(d.old_file.path)
                 if str(old_pk) not in pk_filter:
                     continue
+                if spatial_filter and not spatial_filter.matches_delta(old, new, d):
+                    continue
 
                 self.L.debug("diff(): D %s (%s)", d.old_file.path, old_pk)
 
-                old_feature = old.get_feature(old_pk, ogr_geoms=False)
-                candidates_del[str(old_pk)].append((str(old_pk), old_feature))
+                if stat_only:
+                    old_feature = old.feature_stub(old_pk, d.old_file.id)
+                else:
+                    old_feature = LazyFeature(old, d.old_file.path, d.old_file.id)
+                yield ("D", str(old_pk), old_feature, None)
 
             elif d.status == pygit2.GIT_DELTA_MODIFIED:
                 old_pk = old.decode_path_to_1pk(d.old_file.path)
                 new_pk = new.decode_path_to_1pk(d.new_file.path)
                 if str(old_pk) not in pk_filter and str(new_pk) not in pk_filter:
                     continue
+                if spatial_filter and not spatial_filter.matches_delta(old, new, d):
+                    continue
 
                 self.L.debug(
                     "diff(): M %s (%s) -> %s (%s)",
@@ -514,19 +691,28 @@ class DatasetStructure:
                     new_pk,
                 )
 
-                old_feature = old.get_feature(old_pk, ogr_geoms=False)
-                new_feature = other.get_feature(new_pk, ogr_geoms=False)
-                candidates_upd[str(old_pk)] = (old_feature, new_feature)
+                if stat_only:
+                    old_feature = old.feature_stub(old_pk, d.old_file.id)
+                    new_feature = new.feature_stub(new_pk, d.new_file.id)
+                else:
+                    old_feature = LazyFeature(old, d.old_file.path, d.old_file.id)
+                    new_feature = LazyFeature(new, d.new_file.path, d.new_file.id)
+                yield ("U", str(old_pk), old_feature, new_feature)
 
             elif d.status == pygit2.GIT_DELTA_ADDED:
                 new_pk = new.decode_path_to_1pk(d.new_file.path)
                 if str(new_pk) not in pk_filter:
                     continue
+                if spatial_filter and not spatial_filter.matches_delta(old, new, d):
+                    continue
 
                 self.L.debug("diff(): A %s (%s)", d.new_file.path, new_pk)
 
-                new_feature = new.get_feature(new_pk, ogr_geoms=False)
-                candidates_ins[str(new_pk)].append(new_feature)
+                if stat_only:
+                    new_feature = new.feature_stub(new_pk, d.new_file.id)
+                else:
+                    new_feature = LazyFeature(new, d.new_file.path, d.new_file.id)
+                yield ("I", str(new_pk), None, new_feature)
 
             else:
                 # GIT_DELTA_RENAMED
@@ -538,29 +724,6 @@ class DatasetStructure:
                 # GIT_DELTA_UNTRACKED
                 raise NotImplementedError(f"Delta status: {d.status_char()}")
 
-        # detect renames
-        for h in list(candidates_del.keys()):
-            if h in candidates_ins:
-                track_pk, my_obj = candidates_del[h].pop(0)
-                other_obj = candidates_ins[h].pop(0)
-
-                candidates_upd[track_pk] = (my_obj, other_obj)
-
-                if not candidates_del[h]:
-                    del candidates_del[h]
-                if not candidates_ins[h]:
-                    del candidates_ins[h]
-
-        from .diff import Diff
-
-        return Diff(
-            self,
-            meta={},
-            inserts=list(itertools.chain(*candidates_ins.values())),
-            deletes=dict(itertools.chain(*candidates_del.values())),
-            updates=candidates_upd,
-        )
-
     def write_index(self, dataset_diff, index, repo):
         """
         Given a diff that only affects this dataset, write it to the given index + repo.
@@ -598,7 +761,6 @@ class DatasetStructure:
             entry = pygit2.IndexEntry(feature_path, blob_id, pygit2.GIT_FILEMODE_BLOB)
             index.add(entry)
 
-        geom_column_name = self.geom_column_name
         for _, (old_feature, new_feature) in dataset_diff["U"].items():
             old_pk = old_feature[pk_field]
             old_feature_path = self.encode_1pk_to_path(old_pk)
@@ -609,16 +771,8 @@ class DatasetStructure:
                 )
                 continue
 
-            actual_existing_feature = self.get_feature(old_pk)
-            if geom_column_name:
-                # FIXME: actually compare the geometries here.
-                # Turns out this is quite hard - geometries are hard to compare sanely.
-                # Even if we add hacks to ignore endianness, WKB seems to vary a bit,
-                # and ogr_geometry.Equal(other) can return false for seemingly-identical geometries...
-                actual_existing_feature.pop(geom_column_name)
-                old_feature = old_feature.copy()
-                old_feature.pop(geom_column_name)
-            if actual_existing_feature != old_feature:
+            actual_existing_feature = self.get_feature(old_pk, ogr_geoms=False)
+            if not gpkg.features_equal(actual_existing_feature, old_feature):
                 conflicts = True
                 click.echo(
                     f"{self.path}: Trying to update already-changed feature: {old_pk}"
@@ -1,12 +1,20 @@
+import atexit
 import collections
+import concurrent.futures
 import contextlib
+import hashlib
 import itertools
+import json
 import logging
 import os
+import re
+import tempfile
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
 
+import apsw
 import pygit2
 from osgeo import gdal
 
@@ -14,10 +22,348 @@ from . import gpkg, diff
 from .exceptions import InvalidOperation
 from .filter_util import UNFILTERED
 from .gpkg_adapter import GPKG_META_ITEMS
+from .gpkg_spatial_index import GpkgSpatialIndex
+from .spatial_filter import EnvelopeCache, SpatialFilter
 
 L = logging.getLogger("sno.working_copy")
 
 
+# Repository used by checkout worker processes - see _decode_features_parallel.
+_worker_repo = None
+
+
+def _init_decode_worker(repo_path):
+    global _worker_repo
+    _worker_repo = pygit2.Repository(repo_path)
+
+
+def _decode_feature_partition(tree_hex, dataset_path, version, col_names, partition):
+    from .structure import DatasetStructure
+
+    dataset = DatasetStructure.instantiate(
+        _worker_repo[tree_hex], dataset_path, version
+    )
+    return list(dataset.feature_tuples(col_names, partition=partition))
+
+
+def _write_dataset_to_db(
+    tree_hex, dataset_path, version, table, col_names, col_specs, db_path
+):
+    from .structure import DatasetStructure
+
+    dataset = DatasetStructure.instantiate(
+        _worker_repo[tree_hex], dataset_path, version
+    )
+    db = apsw.Connection(db_path)
+    try:
+        dbcur = db.cursor()
+        # This is a throwaway database, so durability doesn't matter
+        dbcur.execute("PRAGMA journal_mode = OFF;")
+        dbcur.execute("PRAGMA synchronous = OFF;")
+        with db:
+            dbcur.execute(
+                f"CREATE TABLE {gpkg.ident(table)} ({', '.join(col_specs)});"
+            )
+            dbcur.executemany(
+                f"""
+                INSERT INTO {gpkg.ident(table)}
+                    ({','.join([gpkg.ident(k) for k in col_names])})
+                VALUES
+                    ({','.join(['?'] * len(col_names))});
+                """,
+                dataset.feature_tuples(col_names),
+            )
+        return db.totalchanges()
+    finally:
+        db.close()
+
+
+def _bucket_tree_id(blob_ids):
+    """
+    Returns the ID the git tree containing the given {name: blob_id} blobs would have -
+    without writing it to the repository.
+    """
+    body = b"".join(
+        b"100644 " + name.encode("utf8") + b"\0" + bytes.fromhex(blob_id)
+        for name, blob_id in sorted(blob_ids.items())
+    )
+    header = f"tree {len(body)}\0".encode("utf8")
+    return hashlib.sha1(header + body).hexdigest()
+
+
+class _RenameBuffer:
+    """
+    Holds unpaired insert and delete records, keyed by blob hash, until a matching
+    delete or insert arrives - at which point the two are paired up as an update.
+    If max_size is set and the buffer is full, the oldest record is evicted unpaired.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._seq = itertools.count()
+        # seq -> (blob_hash, record), oldest first
+        self._records = collections.OrderedDict()
+        # (change, blob_hash) -> deque of seq
+        self._by_hash = collections.defaultdict(collections.deque)
+
+    def add(self, blob_hash, record):
+        """Adds an insert or delete record. Returns a list of records ready to yield."""
+        change = record[0]
+        match_change = "D" if change == "I" else "I"
+        matches = self._by_hash.get((match_change, blob_hash))
+        if matches:
+            _, match = self._records.pop(matches.popleft())
+            if not matches:
+                del self._by_hash[(match_change, blob_hash)]
+            delete, insert = (match, record) if change == "I" else (record, match)
+            return [("U", delete[1], delete[2], insert[3])]
+
+        seq = next(self._seq)
+        self._records[seq] = (blob_hash, record)
+        self._by_hash[(change, blob_hash)].append(seq)
+
+        if self.max_size is not None and len(self._records) > self.max_size:
+            seq, (old_hash, old_record) = self._records.popitem(last=False)
+            key = (old_record[0], old_hash)
+            self._by_hash[key].popleft()
+            if not self._by_hash[key]:
+                del self._by_hash[key]
+            return [old_record]
+
+        return []
+
+    def flush(self):
+        """Generator. Yields all the records still waiting to be paired."""
+        for blob_hash, record in self._records.values():
+            yield record
+        self._records.clear()
+        self._by_hash.clear()
+
+
+class _ExtentTracker:
+    """
+    Keeps track of the extent of a GeoPackage table's geometries while features are
+    removed and added, without a full pass over the table. The extent stored in
+    gpkg_contents can't be trusted - it could have been written by anything - so
+    tracking starts from the bounds of the spatial index, and the envelopes of the
+    removed and added features are read from their geometries.
+    The extent has to be recalculated at the end if there's no spatial index, if a
+    removed envelope touched its edge, or if too many features change for reading
+    their envelopes to be quicker than that: then it's read from the spatial index if
+    there is one, or recalculated from the whole table if not.
+    """
+
+    BATCH_SIZE = 1000
+
+    # Above this many changed features, recalculating the extent is quicker.
+    MAX_TRACKED = 10000
+
+    def __init__(self, db, table, geom_col):
+        self.db = db
+        self.table = table
+        self.geom_col = geom_col
+        self.spatial_index = GpkgSpatialIndex(db, table, geom_col)
+        self.extent = None
+        self.stale = not self.spatial_index.exists()
+        if not self.stale:
+            self.extent = self.spatial_index.bounds()
+        self.tracked = 0
+
+    def _track(self, pks):
+        # Returns the pks as a list, or None if the extent is (now) stale.
+        if self.stale:
+            return None
+        pks = list(pks)
+        self.tracked += len(pks)
+        if self.tracked > self.MAX_TRACKED:
+            self.stale = True
+            return None
+        return pks
+
+    def _envelopes(self, pks):
+        pk_field = gpkg.pk(self.db, self.table)
+        dbcur = self.db.cursor()
+        pks = iter(pks)
+        while True:
+            batch = list(itertools.islice(pks, self.BATCH_SIZE))
+            if not batch:
+                return
+            dbcur.execute(
+                f"""
+                SELECT {gpkg.ident(self.geom_col)} FROM {gpkg.ident(self.table)}
+                WHERE {gpkg.ident(pk_field)} IN ({','.join(['?'] * len(batch))});
+                """,
+                batch,
+            )
+            for (geom,) in dbcur.fetchall():
+                envelope = gpkg.geom_envelope(geom)
+                if envelope is not None:
+                    yield envelope
+
+    def _touches_edge(self, envelope):
+        # The extent might have come from the spatial index, which rounds outwards
+        # to 32-bit floats - so envelopes that near the edge count as touching it.
+        def near(a, b):
+            return abs(a - b) <= abs(b) * 2 ** -22
+
+        e_min_x, e_max_x, e_min_y, e_max_y = envelope
+        min_x, max_x, min_y, max_y = self.extent
+        return (
+            e_min_x <= min_x
+            or near(e_min_x, min_x)
+            or e_max_x >= max_x
+            or near(e_max_x, max_x)
+            or e_min_y <= min_y
+            or near(e_min_y, min_y)
+            or e_max_y >= max_y
+            or near(e_max_y, max_y)
+        )
+
+    def remove(self, pks):
+        """Call before the features with these primary keys are deleted or overwritten."""
+        pks = self._track(pks)
+        if pks is None or self.extent is None:
+            return
+        for envelope in self._envelopes(pks):
+            if self._touches_edge(envelope):
+                self.stale = True
+                return
+
+    def add(self, pks):
+        """Call after the features with these primary keys are inserted or updated."""
+        pks = self._track(pks)
+        if pks is None:
+            return
+        for envelope in self._envelopes(pks):
+            if self.extent is None:
+                self.extent = envelope
+            else:
+                self.extent = (
+                    min(self.extent[0], envelope[0]),
+                    max(self.extent[1], envelope[1]),
+                    min(self.extent[2], envelope[2]),
+                    max(self.extent[3], envelope[3]),
+                )
+
+    def bounds(self):
+        """Returns the current (min_x, max_x, min_y, max_y) extent, or None if empty."""
+        if not self.stale:
+            return self.extent
+
+        if self.spatial_index.exists():
+            L.debug("Reading extent of %s from its spatial index", self.table)
+            return self.spatial_index.bounds()
+
+        L.debug("Recalculating extent of %s", self.table)
+        g = gpkg.ident(self.geom_col)
+        row = (
+            self.db.cursor()
+            .execute(
+                f"""
+                SELECT
+                    Min(MbrMinX({g})), Max(MbrMaxX({g})),
+                    Min(MbrMinY({g})), Max(MbrMaxY({g}))
+                FROM {gpkg.ident(self.table)};
+                """
+            )
+            .fetchone()
+        )
+        return None if None in row else tuple(row)
+
+
+class _ConnectionPool:
+    """
+    Idle connections to working copy databases, kept open between sessions - so each
+    session doesn't have to open the database, load spatialite and set up GeoPackage
+    mode again, and the statements prepared by one session are reused by the next from
+    the connection's statement cache.
+
+    A connection is only reused if the database file hasn't changed since it was
+    released - if the file has been deleted, replaced or written to by something else,
+    the connection is closed and a new one opened instead.
+    A pool can be shared between threads, but not between processes.
+    """
+
+    # Idle connections kept for each database file
+    MAX_IDLE = 2
+
+    # Prepared statements cached by each connection. The SQL sno runs for features is
+    # built the same way each time, so a statement is found in the cache by its text.
+    STATEMENT_CACHE_SIZE = 200
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _file_state(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _check_process(self):
+        # Connections inherited from a parent process belong to it - leave them alone.
+        if os.getpid() != self._pid:
+            self._idle = collections.defaultdict(list)
+            self._pid = os.getpid()
+
+    def acquire(self, path):
+        """Returns an idle connection to the given database file, or a new one."""
+        path = str(path)
+        state = self._file_state(path)
+        with self._lock:
+            self._check_process()
+            idle = self._idle[path]
+            while idle:
+                db_state, db = idle.pop()
+                if db_state == state:
+                    L.debug("Reusing connection to %s", path)
+                    return db
+                db.close()
+
+        L.debug("Opening connection to %s", path)
+        return gpkg.db(path, statementcachesize=self.STATEMENT_CACHE_SIZE)
+
+    def release(self, path, db):
+        """Returns a connection acquired from the pool, so that it can be reused."""
+        path = str(path)
+        if not db.getautocommit():
+            # Something has left a transaction open - don't reuse it.
+            db.close()
+            return
+
+        state = self._file_state(path)
+        with self._lock:
+            self._check_process()
+            idle = self._idle[path]
+            if state is None or len(idle) >= self.MAX_IDLE:
+                db.close()
+            else:
+                idle.append((state, db))
+
+    def discard(self, path):
+        """Closes the idle connections to the given database file."""
+        with self._lock:
+            self._check_process()
+            for state, db in self._idle.pop(str(path), []):
+                db.close()
+
+    def close_all(self):
+        """Closes every idle connection."""
+        with self._lock:
+            self._check_process()
+            for path in list(self._idle):
+                for state, db in self._idle.pop(path):
+                    db.close()
+
+
+_connection_pool = _ConnectionPool()
+atexit.register(_connection_pool.close_all)
+
+
 class WorkingCopy:
     @classmethod
     def open(cls, repo):
@@ -54,6 +400,8 @@ class WorkingCopy:
 
 class WorkingCopyGPKG(WorkingCopy):
     META_PREFIX = ".sno-"
+    # How many tracked rows are compared to the repository tree at a time.
+    DIFF_BATCH_SIZE = 1000
 
     def __init__(self, repo, path):
         self.repo = repo
@@ -78,14 +426,118 @@ class WorkingCopyGPKG(WorkingCopy):
             n += "_" + suffix
         return gpkg.ident(n)
 
+    # Performance profiles - the pragmas set for a session. More can be defined in the
+    # repo config, as sno.profile.<name>.<setting>, which can also override the
+    # pragmas of these ones - see PROFILE_PRAGMAS for the setting names.
+    PROFILES = {
+        "default": {},
+        # -KiB => 1GiB
+        "bulk": {"synchronous": "OFF", "cache_size": "-1048576"},
+        "bulk-load": {
+            "synchronous": "OFF",
+            "cache_size": "-1048576",
+            "journal_mode": "MEMORY",
+            "locking_mode": "EXCLUSIVE",
+        },
+        # 16MiB, and temporary tables & indexes on disk
+        "low-memory": {"cache_size": "-16384", "temp_store": "FILE"},
+        # concurrent readers, and memory-mapped I/O for up to 256MiB of the database
+        "server": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": "268435456",
+        },
+    }
+
+    # The pragmas a profile can set, in the order they're set - and the name of the
+    # setting for each one in the repo config, since config names can't contain "_".
+    PROFILE_PRAGMAS = {
+        "synchronous": "synchronous",
+        "cache_size": "cacheSize",
+        "temp_store": "tempStore",
+        "mmap_size": "mmapSize",
+        "journal_mode": "journalMode",
+        "locking_mode": "lockingMode",
+    }
+
+    # The profile used for a session of each bulk level, unless the repo config
+    # says otherwise - see get_profile.
+    BULK_PROFILES = {0: "default", 1: "bulk", 2: "bulk-load"}
+
+    def get_profile(self, operation=None, bulk=0):
+        """
+        Returns (name, {pragma: value}) for the performance profile used by sessions
+        for the given operation (eg. "checkout", "reset", "diff", "commit").
+        The profile is the one named by the repo config
+        sno.workingcopy.profile.<operation>, or else sno.workingcopy.profile, or else
+        the default for the bulk level.
+        """
+        keys = ["sno.workingcopy.profile"]
+        if operation:
+            keys.insert(0, f"sno.workingcopy.profile.{operation}")
+        name = next(filter(None, (self._get_config(k) for k in keys)), None)
+        if name is None:
+            name = self.BULK_PROFILES[bulk]
+
+        pragmas = dict(self.PROFILES.get(name, {}))
+        is_configured = False
+        for pragma, setting in self.PROFILE_PRAGMAS.items():
+            key = f"sno.profile.{name}.{setting}"
+            value = self._get_config(key)
+            if value is not None:
+                if not re.fullmatch(r"-?\w+", value):
+                    raise InvalidOperation(f"Invalid value for {key}: {value}")
+                pragmas[pragma] = value
+                is_configured = True
+
+        if name not in self.PROFILES and not is_configured:
+            raise InvalidOperation(f"No such working copy profile: {name}")
+        return name, {p: pragmas[p] for p in self.PROFILE_PRAGMAS if p in pragmas}
+
+    def _get_config(self, key):
+        """
+        Returns the value of the given repo config key, or None if it isn't set - or
+        isn't a valid config name, eg. because a profile name is used in it.
+        """
+        try:
+            return self.repo.config[key]
+        except (KeyError, ValueError, pygit2.GitError):
+            return None
+
+    def _set_pragmas(self, dbcur, pragmas):
+        """
+        Sets the given pragmas, and returns the original values of the ones which should
+        be restored at the end of the session - see _restore_pragmas.
+        """
+        orig = {}
+        for pragma, value in pragmas.items():
+            row = dbcur.execute(f"PRAGMA {pragma};").fetchone()
+            dbcur.execute(f"PRAGMA {pragma} = {value};")
+            # WAL mode is kept - it's a property of the database, for other readers.
+            if row is not None and not (
+                pragma == "journal_mode" and value.lower() == "wal"
+            ):
+                orig[pragma] = row[0]
+        return orig
+
+    def _restore_pragmas(self, dbcur, orig):
+        for pragma, value in reversed(list(orig.items())):
+            dbcur.execute(f"PRAGMA {pragma} = {value};")
+            if pragma == "locking_mode":
+                # The exclusive lock is only released on the next access.
+                dbcur.execute("SELECT name FROM sqlite_master LIMIT 1;")
+
     @contextlib.contextmanager
-    def session(self, bulk=0):
+    def session(self, bulk=0, *, operation=None):
         """
         Context manager for GeoPackage DB sessions, yields a connection object inside a transaction
 
         Calling again yields the _same_ connection, the transaction/etc only happen in the outer one.
+        The outer one takes a connection from the pool of idle connections, and returns
+        it to the pool at the end - see _ConnectionPool.
 
-        @bulk controls bulk-loading operating mode:
+        The pragmas set for the session come from the performance profile for
+        @operation, which is configurable - see get_profile. Otherwise, @bulk chooses:
             0: default, no bulk operations (normal)
             1: synchronous, larger cache (bulk changes)
             2: exclusive locking, memory journal (bulk load)
@@ -100,58 +552,70 @@ class WorkingCopyGPKG(WorkingCopy):
             L.debug(f"session(bulk={bulk}): existing/done")
         else:
             L.debug(f"session(bulk={bulk}): new...")
-            self._db = gpkg.db(self.full_path,)
+            profile, pragmas = self.get_profile(operation, bulk)
+            self._db = _connection_pool.acquire(self.full_path)
             dbcur = self._db.cursor()
 
-            if bulk:
-                L.debug("Invoking bulk mode %s", bulk)
-                orig_journal = dbcur.execute("PRAGMA journal_mode;").fetchone()[0]
-                orig_locking = dbcur.execute("PRAGMA locking_mode;").fetchone()[0]
-
-                dbcur.execute("PRAGMA synchronous = OFF;")
-                dbcur.execute("PRAGMA cache_size = -1048576;")  # -KiB => 1GiB
-
-                if bulk >= 2:
-                    dbcur.execute("PRAGMA journal_mode = MEMORY;")
-                    dbcur.execute("PRAGMA locking_mode = EXCLUSIVE;")
+            (L.info if operation else L.debug)(
+                "Working copy profile for %s: %s (%s)",
+                operation or "session",
+                profile,
+                ", ".join(f"{k}={v}" for k, v in pragmas.items()) or "no pragmas",
+            )
+            orig_pragmas = self._set_pragmas(dbcur, pragmas)
 
             try:
                 with self._db:
                     yield self._db
-            except Exception:
-                raise
             finally:
-                if bulk:
-                    L.debug(
-                        "Disabling bulk %s mode (Journal: %s; Locking: %s)",
-                        bulk,
-                        orig_journal,
-                        orig_locking,
-                    )
-                    dbcur.execute("PRAGMA synchronous = ON;")
-                    dbcur.execute("PRAGMA cache_size = -2000;")  # default
-
-                    if bulk >= 2:
-                        dbcur.execute(f"PRAGMA locking_mode = {orig_locking};")
-                        dbcur.execute(
-                            "SELECT name FROM sqlite_master LIMIT 1;"
-                        )  # unlock
-                        dbcur.execute(f"PRAGMA journal_mode = {orig_journal};")
+                if orig_pragmas:
+                    L.debug("Restoring pragmas: %s", orig_pragmas)
+                    self._restore_pragmas(dbcur, orig_pragmas)
 
                 del dbcur
-                self._db.close()
+                _connection_pool.release(self.full_path, self._db)
                 del self._db
                 L.debug(f"session(bulk={bulk}): new/done")
 
+    def _tracked_tables(self):
+        """Returns the names of the tables which have rows in the tracking table."""
+        with self.session() as db:
+            dbcur = db.cursor()
+            dbcur.execute(f"SELECT DISTINCT table_name FROM {self.TRACKING_TABLE};")
+            return {row[0] for row in dbcur}
+
     def is_dirty(self):
         """
         Returns True if there are uncommitted changes in the working copy,
-        or False otherwise.
+        or False otherwise. If there are no tracked rows, that's all that's checked.
+        Otherwise rows which have been edited back to how they are in the repository,
+        or whose geometry is only encoded differently, aren't changes - so tracked rows
+        are compared with the repository (as `sno diff` does), and the comparison stops
+        at the first real change.
         """
+        from .structure import RepositoryStructure
+
+        self.check_not_bulk_editing()
         with self.session() as db:
             dbcur = db.cursor()
-            dbcur.execute(f"SELECT COUNT(*) FROM {self.TRACKING_TABLE};")
-            return dbcur.fetchone()[0]
+            dbcur.execute(f"SELECT EXISTS (SELECT 1 FROM {self.TRACKING_TABLE});")
+            if not dbcur.fetchone()[0]:
+                return False
+
+        tracked_tables = self._tracked_tables()
+
+        base_tree = self.repo[self.get_db_tree()]
+        for dataset in RepositoryStructure(self.repo).iter_at(base_tree):
+            if dataset.name not in tracked_tables:
+                continue
+            tracked_tables.remove(dataset.name)
+            for change in self._diff_db_to_tree_changes(
+                dataset, UNFILTERED, stat_only=True
+            ):
+                return True
+
+        # Tracked rows in a table which isn't a dataset
+        return bool(tracked_tables)
 
     def check_not_dirty(
         self,
@@ -164,6 +628,21 @@ class WorkingCopyGPKG(WorkingCopy):
         if self.is_dirty():
             raise InvalidOperation(message)
 
+    def is_bulk_editing(self):
+        """Returns True if the working copy is in bulk-edit mode - see bulk_edit_begin."""
+        return False
+
+    def check_not_bulk_editing(self):
+        """
+        Checks the working copy isn't in bulk-edit mode, where its changes aren't known.
+        Otherwise, raises InvalidOperation
+        """
+        if self.is_bulk_editing():
+            raise InvalidOperation(
+                "The working copy is in bulk-edit mode. "
+                "Run `sno workingcopy bulk-edit end` first"
+            )
+
     def _get_columns(self, dataset):
         pk_field = None
         cols = {}
@@ -180,6 +659,7 @@ class WorkingCopyGPKG(WorkingCopy):
 
     def delete(self):
         """ Delete the working copy files """
+        _connection_pool.discard(self.full_path)
         self.full_path.unlink()
 
         # for sqlite this might include wal/journal/etc files
@@ -340,34 +820,16 @@ class WorkingCopyGPKG(WorkingCopy):
         self.repo.config["sno.workingcopy.version"] = 1
         self.repo.config["sno.workingcopy.path"] = str(new_path)
 
-    def write_full(self, commit, dataset, safe=True):
+    def write_full(self, commit, dataset, safe=True, jobs=1):
         raise NotImplementedError()
 
-    def _create_spatial_index(self, dataset):
-        L = logging.getLogger(f"{self.__class__.__qualname__}.write_full")
-
-        geom_col = dataset.geom_column_name
-
-        # Create the GeoPackage Spatial Index
-        t0 = time.monotonic()
-        gdal_ds = gdal.OpenEx(
-            str(self.full_path),
-            gdal.OF_VECTOR | gdal.OF_UPDATE | gdal.OF_VERBOSE_ERROR,
-            ["GPKG"],
-        )
-        sql = f"SELECT CreateSpatialIndex({gpkg.param_str(dataset.name)}, {gpkg.param_str(geom_col)});"
-        L.debug("Creating spatial index for %s.%s: %s", dataset.name, geom_col, sql)
-        gdal_ds.ExecuteSQL(sql)
-        del gdal_ds
-        L.info("Created spatial index in %ss", time.monotonic() - t0)
-
     def _create_triggers(self, dbcur, table):
         raise NotImplementedError()
 
     def _drop_triggers(self, dbcur, table):
-        dbcur.execute(f"DROP TRIGGER {self._meta_name(table, 'ins')}")
-        dbcur.execute(f"DROP TRIGGER {self._meta_name(table, 'upd')}")
-        dbcur.execute(f"DROP TRIGGER {self._meta_name(table, 'del')}")
+        dbcur.execute(f"DROP TRIGGER IF EXISTS {self._meta_name(table, 'ins')}")
+        dbcur.execute(f"DROP TRIGGER IF EXISTS {self._meta_name(table, 'upd')}")
+        dbcur.execute(f"DROP TRIGGER IF EXISTS {self._meta_name(table, 'del')}")
 
     @contextlib.contextmanager
     def _suspend_triggers(self, dbcur, table):
@@ -377,6 +839,49 @@ class WorkingCopyGPKG(WorkingCopy):
         finally:
             self._create_triggers(dbcur, table)
 
+    def _spatial_index(self, db, dataset):
+        return GpkgSpatialIndex(db, dataset.name, dataset.geom_column_name)
+
+    @contextlib.contextmanager
+    def _batch_tracking(self, db, table):
+        """
+        Contextmanager. Changes made to the given table through this connection inside
+        the context are tracked as working copy edits - but rather than the tracking
+        triggers writing to the tracking table once for every changed row, an update
+        hook collects the changed primary keys, which are written in one batch on exit.
+        The triggers are still needed to track edits made by other applications.
+
+        The update hook only sees rowids, so for a table whose primary key isn't its
+        rowid, this leaves the triggers to do the tracking.
+        """
+        pk_is_rowid = any(
+            col["pk"] and col["type"].upper() == "INTEGER"
+            for col in db.cursor().execute(f"PRAGMA table_info({gpkg.ident(table)});")
+        )
+        if not pk_is_rowid:
+            yield
+            return
+
+        changed_pks = set()
+
+        def _update_hook(op, db_name, table_name, rowid):
+            if db_name == "main" and table_name == table:
+                changed_pks.add(rowid)
+
+        dbcur = db.cursor()
+        with self._suspend_triggers(dbcur, table):
+            db.setupdatehook(_update_hook)
+            try:
+                yield
+            finally:
+                db.setupdatehook(None)
+
+            dbcur.executemany(
+                f"INSERT OR REPLACE INTO {self.TRACKING_TABLE} (table_name, pk) VALUES (?, ?);",
+                ((table, pk) for pk in changed_pks),
+            )
+            L.debug("Tracked %d changed rows in %s", len(changed_pks), table)
+
     def update_gpkg_contents(self, commit, dataset):
         table = dataset.name
         commit_time = datetime.utcfromtimestamp(commit.commit_time)
@@ -519,6 +1024,115 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
         """
         )
 
+    @property
+    def BULK_EDIT_TABLE(self):
+        return self._meta_name("bulk")
+
+    def is_bulk_editing(self):
+        with self.session() as db:
+            dbcur = db.cursor()
+            dbcur.execute(
+                "SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type='table' AND name=?);",
+                (f"{self.META_PREFIX}bulk",),
+            )
+            return bool(dbcur.fetchone()[0])
+
+    def bulk_edit_begin(self, repo_structure):
+        """
+        Starts bulk-edit mode, for when many rows are going to be changed. The tracking
+        triggers are dropped, so edits aren't tracked as they are made. Instead, the
+        ID of the blob of every feature in the working copy's tree is recorded, so that
+        bulk_edit_end can find the changed rows.
+        """
+        L = logging.getLogger(f"{self.__class__.__qualname__}.bulk_edit_begin")
+        self.check_not_bulk_editing()
+        with self.session(bulk=1) as db:
+            dbcur = db.cursor()
+            dbcur.execute(
+                f"""
+                CREATE TABLE {self.BULK_EDIT_TABLE} (
+                    table_name TEXT NOT NULL,
+                    pk NOT NULL,
+                    blob_id TEXT NOT NULL,
+                    CONSTRAINT {self._meta_name('bulk', 'pk')} PRIMARY KEY (table_name, pk)
+                );
+                """
+            )
+            tree = repo_structure.repo[self.get_db_tree()]
+            for dataset in repo_structure.iter_at(tree):
+                self._drop_triggers(dbcur, dataset.name)
+                dbcur.executemany(
+                    f"INSERT INTO {self.BULK_EDIT_TABLE} (table_name, pk, blob_id) VALUES (?, ?, ?);",
+                    (
+                        (
+                            dataset.name,
+                            dataset.decode_path_to_1pk(blob.name),
+                            blob.id.hex,
+                        )
+                        for blob in dataset.feature_blobs()
+                    ),
+                )
+                L.info("%s: recorded %d features", dataset.name, db.changes())
+
+    def bulk_edit_end(self, repo_structure):
+        """
+        Ends bulk-edit mode - see bulk_edit_begin. Every row which was inserted, updated
+        or deleted since then is added to the tracking table, and the tracking triggers
+        are recreated. Returns the number of rows tracked.
+        """
+        L = logging.getLogger(f"{self.__class__.__qualname__}.bulk_edit_end")
+        if not self.is_bulk_editing():
+            raise InvalidOperation("The working copy isn't in bulk-edit mode")
+
+        total = 0
+        with self.session(bulk=1) as db:
+            dbcur = db.cursor()
+            tree = repo_structure.repo[self.get_db_tree()]
+            for dataset in repo_structure.iter_at(tree):
+                count = self._track_bulk_edits(db, dataset)
+                L.info("%s: %d changed rows", dataset.name, count)
+                total += count
+                self._create_triggers(dbcur, dataset.name)
+            dbcur.execute(f"DROP TABLE {self.BULK_EDIT_TABLE};")
+        return total
+
+    def _track_bulk_edits(self, db, dataset):
+        """
+        Adds the rows of the given dataset's table which differ from the blob IDs
+        recorded by bulk_edit_begin to the tracking table, in one pass. Each row is
+        hashed the way it would be stored in the repository, by a SQL function.
+        """
+        table = dataset.name
+        cols, pk_field = self._get_columns(dataset)
+        col_names = list(cols.keys())
+
+        def _blob_id(*values):
+            feature = dict(zip(col_names, values))
+            return pygit2.hash(dataset.encode_feature_blob(feature)).hex
+
+        db.createscalarfunction("sno_blob_id", _blob_id, len(col_names))
+
+        t = gpkg.ident(table)
+        pk = gpkg.ident(pk_field)
+        row_cols = ", ".join(f"T.{gpkg.ident(c)}" for c in col_names)
+        dbcur = db.cursor()
+        dbcur.execute(
+            f"""
+            INSERT OR REPLACE INTO {self.TRACKING_TABLE} (table_name, pk)
+            SELECT :table, T.{pk}
+            FROM {t} T LEFT OUTER JOIN {self.BULK_EDIT_TABLE} B
+            ON (B.table_name = :table AND B.pk = T.{pk})
+            WHERE B.blob_id IS NULL OR B.blob_id != sno_blob_id({row_cols})
+            UNION ALL
+            SELECT :table, B.pk
+            FROM {self.BULK_EDIT_TABLE} B
+            WHERE B.table_name = :table
+            AND NOT EXISTS (SELECT 1 FROM {t} T WHERE T.{pk} = B.pk);
+            """,
+            {"table": table},
+        )
+        return db.changes()
+
     def _chunk(self, iterable, size):
         """
         Generator. Yield successive chunks from iterable of length <size>.
@@ -530,75 +1144,109 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                 return
             yield chunk
 
-    def write_full(self, commit, *datasets, safe=True):
+    def write_full(self, commit, *datasets, safe=True, jobs=1, bbox=None):
         """
         Writes a full layer into a working-copy table
 
-        Use for new working-copy checkouts.
+        Use for new working-copy checkouts. If jobs > 1, features are decoded by a pool
+        of that many processes - if there are several datasets, each is written into its
+        own temporary database in parallel (see _write_full_parallel), otherwise this
+        process inserts them as they are decoded.
+
+        If a bbox (MINX, MINY, MAXX, MAXY) is given, or the working copy is already
+        limited to one (see get_bbox), only the features of datasets with geometry
+        whose envelope intersects it are written - by a single process, since features
+        whose envelope is cached don't need decoding.
         """
         L = logging.getLogger(f"{self.__class__.__qualname__}.write_full")
-        with self.session(bulk=(0 if safe else 2)) as db:
-            for dataset in datasets:
-                table = dataset.name
+        self.check_not_bulk_editing()
+        if bbox is None:
+            bbox = self.get_bbox()
+        spatial_filter = None
+        if bbox is not None:
+            spatial_filter = SpatialFilter(bbox, EnvelopeCache.for_repo(self.repo))
+            jobs = 1
+
+        if jobs > 1 and len(datasets) > 1:
+            self._write_full_parallel(datasets, jobs, safe=safe)
+        else:
+            with self.session(bulk=(0 if safe else 2), operation="checkout") as db:
+                for dataset in datasets:
+                    table = dataset.name
 
-                dbcur = db.cursor()
-                self.write_meta(dataset)
+                    dbcur = db.cursor()
+                    self.write_meta(dataset)
 
-                # Create the table
-                cols, pk_field = self._get_columns(dataset)
-                col_names = cols.keys()
-                col_specs = cols.values()
-                dbcur.execute(
-                    f"""
-                    CREATE TABLE {gpkg.ident(table)}
-                    ({', '.join(col_specs)});
-                """
-                )
-
-                L.info("Creating features...")
-                sql_insert_features = f"""
-                    INSERT INTO {gpkg.ident(table)}
-                        ({','.join([gpkg.ident(k) for k in col_names])})
-                    VALUES
-                        ({','.join(['?'] * len(col_names))});
-                """
-                feat_progress = 0
-                t0 = time.monotonic()
-                t0p = t0
+                    # Create the table
+                    cols, pk_field = self._get_columns(dataset)
+                    col_names = cols.keys()
+                    col_specs = cols.values()
+                    dbcur.execute(
+                        f"""
+                        CREATE TABLE {gpkg.ident(table)}
+                        ({', '.join(col_specs)});
+                    """
+                    )
 
-                CHUNK_SIZE = 10000
-                total_features = dataset.feature_count()
-                for rows in self._chunk(dataset.feature_tuples(col_names), CHUNK_SIZE):
-                    dbcur.executemany(sql_insert_features, rows)
-                    feat_progress += len(rows)
+                    L.info("Creating features...")
+                    sql_insert_features = f"""
+                        INSERT INTO {gpkg.ident(table)}
+                            ({','.join([gpkg.ident(k) for k in col_names])})
+                        VALUES
+                            ({','.join(['?'] * len(col_names))});
+                    """
+                    feat_progress = 0
+                    t0 = time.monotonic()
+                    t0p = t0
+
+                    CHUNK_SIZE = 10000
+                    total_features = dataset.feature_count()
+                    if spatial_filter is not None and dataset.has_geometry:
+                        batches = self._chunk(
+                            spatial_filter.feature_tuples(dataset, col_names),
+                            CHUNK_SIZE,
+                        )
+                    elif jobs > 1:
+                        batches = self._decode_features_parallel(
+                            dataset, col_names, jobs
+                        )
+                    else:
+                        batches = self._chunk(
+                            dataset.feature_tuples(col_names), CHUNK_SIZE
+                        )
+                    for rows in batches:
+                        dbcur.executemany(sql_insert_features, rows)
+                        feat_progress += len(rows)
+
+                        t0a = time.monotonic()
+                        L.info(
+                            "%.1f%% %d/%d features... @%.1fs (+%.1fs, ~%d F/s)",
+                            feat_progress / total_features * 100,
+                            feat_progress,
+                            total_features,
+                            t0a - t0,
+                            t0a - t0p,
+                            len(rows) / (t0a - t0p or 0.001),
+                        )
+                        t0p = t0a
 
-                    t0a = time.monotonic()
+                    t1 = time.monotonic()
                     L.info(
-                        "%.1f%% %d/%d features... @%.1fs (+%.1fs, ~%d F/s)",
-                        feat_progress / total_features * 100,
-                        feat_progress,
-                        total_features,
-                        t0a - t0,
-                        t0a - t0p,
-                        CHUNK_SIZE / (t0a - t0p or 0.001),
+                        "Added %d features to GPKG in %.1fs", feat_progress, t1 - t0
+                    )
+                    L.info(
+                        "Overall rate: %d features/s",
+                        (feat_progress / (t1 - t0 or 0.001)),
                     )
-                    t0p = t0a
-
-                t1 = time.monotonic()
-                L.info("Added %d features to GPKG in %.1fs", feat_progress, t1 - t0)
-                L.info(
-                    "Overall rate: %d features/s", (feat_progress / (t1 - t0 or 0.001))
-                )
-
-        for dataset in datasets:
-            if dataset.has_geometry:
-                self._create_spatial_index(dataset)
 
-        with self.session() as db:
+        with self.session(operation="checkout") as db:
             dbcur = db.cursor()
             for dataset in datasets:
                 table = dataset.name
 
+                if dataset.has_geometry:
+                    self._spatial_index(db, dataset).create()
+
                 self.update_gpkg_contents(commit, dataset)
 
                 # Create triggers
@@ -608,6 +1256,157 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                 f"INSERT OR REPLACE INTO {self.META_TABLE} (table_name, key, value) VALUES (?, ?, ?);",
                 ("*", "tree", commit.peel(pygit2.Tree).hex),
             )
+            if bbox is not None:
+                dbcur.execute(
+                    f"INSERT OR REPLACE INTO {self.META_TABLE} (table_name, key, value) VALUES (?, ?, ?);",
+                    ("*", "bbox", json.dumps(list(bbox))),
+                )
+
+        if spatial_filter is not None:
+            spatial_filter.envelope_cache.close()
+
+    def get_bbox(self):
+        """
+        Returns the bounding box (MINX, MINY, MAXX, MAXY) which the features in this
+        working copy are limited to - see `sno checkout --bbox` - or None if it has
+        every feature.
+        """
+        with self.session() as db:
+            dbcur = db.cursor()
+            dbcur.execute(
+                f"SELECT value FROM {self.META_TABLE} WHERE table_name=? AND key=?;",
+                ("*", "bbox"),
+            )
+            row = dbcur.fetchone()
+            return tuple(json.loads(row[0])) if row else None
+
+    def _split_by_spatial_filter(self, spatial_filter, dataset, pk_iter):
+        """
+        Returns (matching_pks, other_pks) - the given primary keys of features in the
+        dataset which match the spatial filter, and of those which don't. Features
+        which aren't in the dataset match, as do all features if spatial_filter is None
+        or the dataset has no geometry.
+        """
+        if spatial_filter is None or not dataset.has_geometry:
+            return list(pk_iter), []
+
+        matching_pks = []
+        other_pks = []
+        for pk in pk_iter:
+            blob_id = dataset.get_feature_blob_id(pk)
+            rel_path = dataset.encode_1pk_to_path(
+                dataset.cast_primary_key(pk), relative=True
+            )
+            if blob_id is None or spatial_filter.matches_blob(
+                dataset, pk, rel_path, blob_id
+            ):
+                matching_pks.append(pk)
+            else:
+                other_pks.append(pk)
+        return matching_pks, other_pks
+
+    def _write_full_parallel(self, datasets, jobs, *, safe=True):
+        """
+        Writes the features of each of the given datasets into its own temporary SQLite
+        database using a pool of jobs processes. As each one is finished, its table is
+        copied into the working copy. Then the GeoPackage metadata for all of the
+        datasets is written at once.
+        """
+        L = logging.getLogger(f"{self.__class__.__qualname__}.write_full")
+        t0 = time.monotonic()
+
+        with tempfile.TemporaryDirectory(
+            prefix=".sno-checkout-", dir=self.full_path.parent
+        ) as tmp_dir, concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_decode_worker,
+            initargs=(self.repo.path,),
+        ) as executor:
+            pending = []
+            for i, dataset in enumerate(datasets):
+                cols, pk_field = self._get_columns(dataset)
+                db_path = os.path.join(tmp_dir, f"{i}.sqlite")
+                future = executor.submit(
+                    _write_dataset_to_db,
+                    dataset.tree.hex,
+                    dataset.path,
+                    dataset.version,
+                    dataset.name,
+                    list(cols.keys()),
+                    list(cols.values()),
+                    db_path,
+                )
+                pending.append((dataset, cols, db_path, future))
+
+            # ATTACH can't happen inside a transaction, so this can't be a session
+            db = gpkg.db(self.full_path)
+            try:
+                dbcur = db.cursor()
+                if not safe:
+                    dbcur.execute("PRAGMA synchronous = OFF;")
+                for dataset, cols, db_path, future in pending:
+                    feat_count = future.result()
+                    table = gpkg.ident(dataset.name)
+                    col_specs = ", ".join(cols.values())
+                    dbcur.execute("ATTACH DATABASE ? AS sno_src;", (db_path,))
+                    try:
+                        with db:
+                            dbcur.execute(f"CREATE TABLE main.{table} ({col_specs});")
+                            dbcur.execute(
+                                f"INSERT INTO main.{table} SELECT * FROM sno_src.{table};"
+                            )
+                    finally:
+                        dbcur.execute("DETACH DATABASE sno_src;")
+                    os.unlink(db_path)
+                    L.info(
+                        "Added %d features to %s @%.1fs",
+                        feat_count,
+                        dataset.name,
+                        time.monotonic() - t0,
+                    )
+            finally:
+                db.close()
+
+        with self.session(bulk=(0 if safe else 1), operation="checkout"):
+            for dataset in datasets:
+                self.write_meta(dataset)
+
+        L.info(
+            "Added %d datasets to GPKG in %.1fs", len(datasets), time.monotonic() - t0
+        )
+
+    def _decode_features_parallel(self, dataset, col_names, jobs):
+        """
+        Generator. Decodes the features of the given dataset as tuples using a pool of
+        jobs processes, one partition of the dataset at a time (see
+        DatasetStructure.feature_partitions), and yields a list of tuples for each
+        partition in order. No more than 2 * jobs partitions are decoded ahead of the
+        one being yielded.
+        """
+        partitions = iter(dataset.feature_partitions())
+        args = (dataset.tree.hex, dataset.path, dataset.version, list(col_names))
+        max_buffered = 2 * jobs
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_decode_worker,
+            initargs=(self.repo.path,),
+        ) as executor:
+            pending = collections.deque(
+                executor.submit(_decode_feature_partition, *args, partition)
+                for partition in itertools.islice(partitions, max_buffered)
+            )
+            try:
+                while pending:
+                    rows = pending.popleft().result()
+                    for partition in itertools.islice(partitions, 1):
+                        pending.append(
+                            executor.submit(_decode_feature_partition, *args, partition)
+                        )
+                    if rows:
+                        yield rows
+            finally:
+                for future in pending:
+                    future.cancel()
 
     def write_features(self, dbcur, dataset, pk_iter, *, ignore_missing=False):
         cols, pk_field = self._get_columns(dataset)
@@ -649,27 +1448,37 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
 
         return feat_count
 
-    def diff_db_to_tree(self, dataset, pk_filter=UNFILTERED):
+    def _diff_db_to_tree_changes(self, dataset, pk_filter, stat_only=False):
         """
-        Generates a diff between a working copy DB and the underlying repository tree,
-        for a single dataset only.
-
-        Pass a list of PK values to filter results to them
+        Generator. Yields the changes between a working copy DB and the underlying
+        repository tree for a single dataset, as tuples of one of these forms:
+            ("META", name, old_value, new_value, None)
+            ("I", track_pk, None, db_obj, blob_hash)
+            ("U", track_pk, repo_obj, db_obj, None)
+            ("D", track_pk, repo_obj, None, blob_hash)
+        Inserts and deletes include the blob hash of the feature so that renames -
+        features whose primary key has changed - can be paired up by the caller.
+
+        Rows which encode to the same blob as the repository feature are unchanged, so
+        repository features are only decoded for rows which have really changed.
+        If stat_only is True, features are replaced by dataset.feature_stub - and
+        repository features are only decoded if the row's blob differs and the dataset
+        has a geometry, to check that more than the geometry's encoding has changed.
         """
+        self.check_not_bulk_editing()
         pk_filter = pk_filter or UNFILTERED
-        with self.session() as db:
+        with self.session(operation="diff") as db:
             dbcur = db.cursor()
 
             table = dataset.name
 
-            meta_diff = {}
             meta_old = {key: dataset.get_meta_item(key) for key in GPKG_META_ITEMS}
             meta_new = dict(self.read_meta(dataset))
             for name in set(meta_new.keys()) ^ set(meta_old.keys()):
                 v_old = meta_old.get(name)
                 v_new = meta_new.get(name)
                 if v_old or v_new:
-                    meta_diff[name] = (v_old, v_new)
+                    yield ("META", name, v_old, v_new, None)
 
             pk_field = dataset.primary_key
 
@@ -687,59 +1496,226 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                 params += [str(pk) for pk in pk_filter]
             dbcur.execute(diff_sql, params)
 
-            candidates_ins = collections.defaultdict(list)
-            candidates_upd = {}
-            candidates_del = collections.defaultdict(list)
-
-            for row in dbcur:
-                track_pk = row[0]
-                db_obj = {k: row[k] for k in row.keys() if k != ".__track_pk"}
-
-                try:
-                    repo_obj = dataset.get_feature(track_pk, ogr_geoms=False)
-                except KeyError:
-                    repo_obj = None
-
-                if db_obj[pk_field] is None:
-                    if repo_obj:  # ignore INSERT+DELETE
-                        blob_hash = pygit2.hash(
-                            dataset.encode_feature_blob(repo_obj)
-                        ).hex
-                        candidates_del[blob_hash].append((track_pk, repo_obj))
-                    continue
-
-                elif not repo_obj:
-                    # INSERT
-                    blob_hash = pygit2.hash(dataset.encode_feature_blob(db_obj)).hex
-                    candidates_ins[blob_hash].append(db_obj)
+            # Rows are compared to the repository in batches: the blob of each feature
+            # in the repository is found without decoding it, and features are only
+            # decoded if the row doesn't encode to the same blob.
+            for rows in self._chunk(dbcur, self.DIFF_BATCH_SIZE):
+                repo_blobs = dict(
+                    dataset.get_feature_blobs_bulk(
+                        (row[0] for row in rows), batch_size=len(rows)
+                    )
+                )
+                for row in rows:
+                    yield from self._diff_row_to_tree(
+                        dataset, row, repo_blobs, stat_only
+                    )
 
+    def _diff_row_to_tree(self, dataset, row, repo_blobs, stat_only):
+        """
+        Generator. Yields the change (if any) between the given row from the tracking
+        table joined to the dataset table, and the feature in the repository tree -
+        see _diff_db_to_tree_changes.
+        """
+        pk_field = dataset.primary_key
+        track_pk = row[0]
+        db_obj = {k: row[k] for k in row.keys() if k != ".__track_pk"}
+        repo_blob = repo_blobs[dataset.cast_primary_key(track_pk)]
+
+        if db_obj[pk_field] is None:
+            if repo_blob is not None:  # ignore INSERT+DELETE
+                if stat_only:
+                    repo_obj = dataset.feature_stub(
+                        dataset.cast_primary_key(track_pk), repo_blob.id
+                    )
+                    blob_hash = repo_blob.id.hex
                 else:
-                    # UPDATE
-                    s_old = set(repo_obj.items())
-                    s_new = set(db_obj.items())
-                    if s_old ^ s_new:
-                        candidates_upd[track_pk] = (repo_obj, db_obj)
-
-            # detect renames
-            for h in list(candidates_del.keys()):
-                if h in candidates_ins:
-                    track_pk, repo_obj = candidates_del[h].pop(0)
-                    db_obj = candidates_ins[h].pop(0)
-
-                    candidates_upd[track_pk] = (repo_obj, db_obj)
-
-                    if not candidates_del[h]:
-                        del candidates_del[h]
-                    if not candidates_ins[h]:
-                        del candidates_ins[h]
-
-            return diff.Diff(
-                dataset,
-                meta=meta_diff,
-                inserts=list(itertools.chain(*candidates_ins.values())),
-                deletes=dict(itertools.chain(*candidates_del.values())),
-                updates=candidates_upd,
+                    repo_obj = dataset.get_feature_from_blob(repo_blob, ogr_geoms=False)
+                    blob_hash = pygit2.hash(dataset.encode_feature_blob(repo_obj)).hex
+                yield ("D", track_pk, repo_obj, None, blob_hash)
+            return
+
+        blob_hash = pygit2.hash(dataset.encode_feature_blob(db_obj)).hex
+
+        if repo_blob is None:
+            # INSERT
+            if stat_only:
+                db_obj = dataset.feature_stub(db_obj[pk_field], blob_hash)
+            yield ("I", track_pk, None, db_obj, blob_hash)
+
+        elif blob_hash == repo_blob.id.hex:
+            # Touched, but unchanged
+            return
+
+        elif stat_only and not dataset.has_geometry:
+            # UPDATE - without a geometry, only a real change changes the blob
+            repo_obj = dataset.feature_stub(
+                dataset.cast_primary_key(track_pk), repo_blob.id
             )
+            db_obj = dataset.feature_stub(db_obj[pk_field], blob_hash)
+            yield ("U", track_pk, repo_obj, db_obj, None)
+
+        else:
+            # UPDATE - unless only the encoding of a geometry has changed
+            repo_obj = dataset.get_feature_from_blob(repo_blob, ogr_geoms=False)
+            if not gpkg.features_equal(repo_obj, db_obj):
+                if stat_only:
+                    repo_obj = dataset.feature_stub(repo_obj[pk_field], repo_blob.id)
+                    db_obj = dataset.feature_stub(db_obj[pk_field], blob_hash)
+                yield ("U", track_pk, repo_obj, db_obj, None)
+
+    def diff_db_to_tree(self, dataset, pk_filter=UNFILTERED):
+        """
+        Generates a diff between a working copy DB and the underlying repository tree,
+        for a single dataset only.
+
+        Pass a list of PK values to filter results to them
+        """
+        meta_diff = {}
+        candidates_ins = collections.defaultdict(list)
+        candidates_upd = {}
+        candidates_del = collections.defaultdict(list)
+
+        for change, key, old, new, blob_hash in self._diff_db_to_tree_changes(
+            dataset, pk_filter
+        ):
+            if change == "META":
+                meta_diff[key] = (old, new)
+            elif change == "I":
+                candidates_ins[blob_hash].append(new)
+            elif change == "U":
+                candidates_upd[key] = (old, new)
+            elif change == "D":
+                candidates_del[blob_hash].append((key, old))
+
+        # detect renames
+        for h in list(candidates_del.keys()):
+            if h in candidates_ins:
+                track_pk, repo_obj = candidates_del[h].pop(0)
+                db_obj = candidates_ins[h].pop(0)
+
+                candidates_upd[track_pk] = (repo_obj, db_obj)
+
+                if not candidates_del[h]:
+                    del candidates_del[h]
+                if not candidates_ins[h]:
+                    del candidates_ins[h]
+
+        return diff.Diff(
+            dataset,
+            meta=meta_diff,
+            inserts=list(itertools.chain(*candidates_ins.values())),
+            deletes=dict(itertools.chain(*candidates_del.values())),
+            updates=candidates_upd,
+        )
+
+    def diff_db_to_tree_stream(
+        self, dataset, pk_filter=UNFILTERED, rename_buffer_size=10000, stat_only=False
+    ):
+        """
+        Generator. Like diff_db_to_tree, but yields change records as they are found,
+        instead of building a Diff - see diff.get_dataset_diff_stream.
+
+        Inserts and deletes wait in a side table keyed by blob hash, so that a delete
+        and an insert of the same feature can be paired up as a rename. The side table
+        holds at most rename_buffer_size features - when it is full, the oldest is
+        yielded unpaired, so renames which are further apart than that in the tracking
+        table are yielded as a delete and an insert. If rename_buffer_size is None,
+        the side table isn't bounded.
+
+        If stat_only is True, features are replaced by dataset.feature_stub - enough to
+        count the changes - see _diff_db_to_tree_changes.
+        """
+        renames = _RenameBuffer(rename_buffer_size)
+        for change, key, old, new, blob_hash in self._diff_db_to_tree_changes(
+            dataset, pk_filter, stat_only=stat_only
+        ):
+            if change in ("I", "D"):
+                yield from renames.add(blob_hash, (change, key, old, new))
+            else:
+                yield (change, key, old, new)
+
+        yield from renames.flush()
+
+    def feature_buckets(self, dataset, pks=UNFILTERED):
+        """
+        Returns {bucket: {name: blob_id}} for the rows in the table of the given
+        dataset - the blob each row would be stored as, grouped into the same "xx/yy"
+        buckets and with the same names as in the repository. See
+        DatasetStructure.feature_buckets.
+        If pks is given, only the rows with those primary keys are read and encoded.
+        Otherwise every row is - that's O(rows in the table), and only meant for checks
+        like fsck which have to look at everything anyway.
+        """
+        buckets = collections.defaultdict(dict)
+        pk_field = dataset.primary_key
+        table = gpkg.ident(dataset.name)
+        with self.session(operation="diff") as db:
+            dbcur = db.cursor()
+            if pks is UNFILTERED:
+                rows = dbcur.execute(f"SELECT * FROM {table};")
+            else:
+                CHUNK_SIZE = 100
+                rows = (
+                    row
+                    for pk_chunk in self._chunk(pks, CHUNK_SIZE)
+                    for row in dbcur.execute(
+                        f"""
+                        SELECT * FROM {table}
+                        WHERE {gpkg.ident(pk_field)} IN ({','.join(['?'] * len(pk_chunk))});
+                        """,
+                        pk_chunk,
+                    )
+                )
+            for row in rows:
+                db_obj = dict(zip(row.keys(), row))
+                bucket, name = dataset.feature_bucket(db_obj[pk_field])
+                blob_id = pygit2.hash(dataset.encode_feature_blob(db_obj)).hex
+                buckets[bucket][name] = blob_id
+        return buckets
+
+    def dirty_buckets(self, dataset, tracked_only=True):
+        """
+        Returns {bucket: {name: blob_id}} for each bucket where the rows in the table of
+        the given dataset differ from the features in the repository. The rows in each
+        bucket are hashed as a git tree, and compared with the ID of the bucket's tree in
+        the repository, so features are never decoded - only the buckets returned need
+        comparing feature by feature.
+        If tracked_only is True, only the buckets with tracked rows in them are checked,
+        so only their rows are read - the tracked rows, and the rows of the features in
+        those buckets in the repository. Otherwise every row is read, so that rows which
+        changed without being tracked are found too - see feature_buckets.
+        Buckets which only exist in the repository are returned with no rows.
+        """
+        self.check_not_bulk_editing()
+        repo_buckets = dataset.feature_buckets()
+
+        if tracked_only:
+            with self.session() as db:
+                dbcur = db.cursor()
+                dbcur.execute(
+                    f"SELECT pk FROM {self.TRACKING_TABLE} WHERE table_name=?;",
+                    (dataset.name,),
+                )
+                pks = {dataset.cast_primary_key(row[0]) for row in dbcur}
+            buckets = {dataset.feature_bucket(pk)[0] for pk in pks}
+            for bucket in buckets & repo_buckets.keys():
+                pks.update(
+                    dataset.decode_path_to_1pk(blob.name)
+                    for blob in repo_buckets[bucket]
+                )
+            wc_buckets = self.feature_buckets(dataset, pks) if pks else {}
+        else:
+            wc_buckets = self.feature_buckets(dataset)
+            buckets = repo_buckets.keys() | wc_buckets.keys()
+
+        result = {}
+        for bucket in buckets:
+            blob_ids = wc_buckets.get(bucket, {})
+            tree_id = _bucket_tree_id(blob_ids) if blob_ids else None
+            repo_bucket = repo_buckets.get(bucket)
+            if tree_id != (repo_bucket.id.hex if repo_bucket is not None else None):
+                result[bucket] = blob_ids
+        return result
 
     def diff_to_tree(self, repo_structure, feature_filter=UNFILTERED):
         """
@@ -794,6 +1770,76 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                 db.changes() == 1
             ), f"{self.META_TABLE} update: expected 1Δ, got {db.changes()}"
 
+    # Resets which change at least this fraction of a table's features don't update
+    # the spatial index row by row - it's rebuilt afterwards instead, which takes a full
+    # pass over the table.
+    RESET_SPATIAL_INDEX_REBUILD_RATIO = 0.1
+
+    def _reset_features(self, dbcur, src_ds, dest_ds, extent=None, spatial_filter=None):
+        """
+        Updates the features in the given dataset's table from src_ds to dest_ds, which
+        are two versions of the same dataset. Features are deleted and written in large
+        batches, grouped by the kind of change - see delete_features and write_features.
+        If an _ExtentTracker is given, it's told about the changed features.
+        If a SpatialFilter is given, changed features which don't match it are deleted
+        rather than written.
+        """
+        L = logging.getLogger(f"{self.__class__.__qualname__}.reset")
+
+        diff_index = src_ds.tree.diff_to_tree(dest_ds.tree)
+        L.debug("Index diff: %s changes", len(diff_index))
+
+        deleted_pks = []
+        written_pks = []
+        for d in diff_index.deltas:
+            if d.status == pygit2.GIT_DELTA_DELETED:
+                deleted_pks.append(
+                    src_ds.decode_path_to_1pk(os.path.basename(d.old_file.path))
+                )
+            elif d.status in (pygit2.GIT_DELTA_MODIFIED, pygit2.GIT_DELTA_ADDED):
+                written_pks.append(
+                    dest_ds.decode_path_to_1pk(os.path.basename(d.new_file.path))
+                )
+            else:
+                # GIT_DELTA_RENAMED
+                # GIT_DELTA_COPIED
+                # GIT_DELTA_IGNORED
+                # GIT_DELTA_TYPECHANGE
+                # GIT_DELTA_UNMODIFIED
+                # GIT_DELTA_UNREADABLE
+                # GIT_DELTA_UNTRACKED
+                raise NotImplementedError(f"Delta status: {d.status_char()}")
+
+        L.debug(
+            "reset(): %s deleted, %s added or modified",
+            len(deleted_pks),
+            len(written_pks),
+        )
+        ctx = contextlib.nullcontext()
+        if dest_ds.has_geometry and len(diff_index):
+            row_count = dbcur.execute(
+                f"SELECT COUNT(*) FROM {gpkg.ident(dest_ds.name)};"
+            ).fetchone()[0]
+            if len(diff_index) >= row_count * self.RESET_SPATIAL_INDEX_REBUILD_RATIO:
+                ctx = self._spatial_index(dbcur.getconnection(), dest_ds).suspended()
+
+        if extent is not None:
+            extent.remove(itertools.chain(deleted_pks, written_pks))
+
+        written_pks, outside_pks = self._split_by_spatial_filter(
+            spatial_filter, dest_ds, written_pks
+        )
+        deleted_pks += outside_pks
+
+        with ctx:
+            count = self.delete_features(dbcur, src_ds, deleted_pks)
+            L.debug("reset(): deleted %s features", count)
+            count = self.write_features(dbcur, dest_ds, written_pks)
+            L.debug("reset(): wrote %s features", count)
+
+        if extent is not None:
+            extent.add(written_pks)
+
     def reset(
         self,
         target_tree_or_commit,
@@ -811,9 +1857,13 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
 
         If update_meta=True (the default) the tree ID in the .sno-meta table gets set
         to the new tree ID. Otherwise it is unchanged.
+
+        Raises InvalidOperation in bulk-edit mode, even if force=True - the bulk edits
+        have to be ended (and then discarded) first.
         """
 
         L = logging.getLogger(f"{self.__class__.__qualname__}.reset")
+        self.check_not_bulk_editing()
         commit = None
         if isinstance(target_tree_or_commit, pygit2.Commit):
             commit = target_tree_or_commit
@@ -825,7 +1875,7 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
             f"c={commit.id if commit else 'none'} t={target_tree.hex} update-meta={update_meta}",
         )
 
-        with self.session(bulk=1) as db:
+        with self.session(bulk=1, operation="reset") as db:
             dbcur = db.cursor()
 
             base_tree_id = self.get_db_tree()
@@ -840,8 +1890,13 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                 target_tree,
             )
 
-            # check for dirty working copy
-            is_dirty = self.is_dirty()
+            # features outside the bounding box of a partial checkout are left out
+            bbox = self.get_bbox()
+            spatial_filter = SpatialFilter(bbox) if bbox is not None else None
+
+            # check for dirty working copy - tracked rows are cleaned up even if
+            # they've been edited back to how they were.
+            is_dirty = bool(self._tracked_tables())
             if not force:
                 self.check_not_dirty(
                     "You have uncommitted changes in your working copy. Commit or use --force to discard."
@@ -892,7 +1947,11 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                             "Sorry, no way to do changeset/meta/schema updates yet"
                         )
 
-                    # todo: suspend/remove spatial index
+                    if geom_col is not None:
+                        extent = _ExtentTracker(db, table, geom_col)
+                    else:
+                        extent = None
+
                     if is_dirty:
                         with self._suspend_triggers(dbcur, table):
                             L.debug("Cleaning up dirty rows...")
@@ -903,15 +1962,22 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                             dbcur.execute(sql_changed, (table,))
                             pk_list = [r[0] for r in dbcur]
                             track_count = db.changes()
+                            if extent is not None:
+                                extent.remove(pk_list)
                             count = self.delete_features(dbcur, src_ds, pk_list)
                             L.debug(
                                 "reset(): dirty: removed %s features, tracking Δ count=%s",
                                 count,
                                 track_count,
                             )
+                            pk_list, _ = self._split_by_spatial_filter(
+                                spatial_filter, src_ds, pk_list
+                            )
                             count = self.write_features(
                                 dbcur, src_ds, pk_list, ignore_missing=True
                             )
+                            if extent is not None:
+                                extent.add(pk_list)
                             L.debug(
                                 "reset(): dirty: wrote %s features, tracking Δ count=%s",
                                 count,
@@ -928,78 +1994,35 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                     else:
                         # if we're not updating meta information, we want to track these changes
                         # as working copy edits so they can be committed.
-                        ctx = contextlib.nullcontext()
+                        ctx = self._batch_tracking(db, table)
 
                     with ctx:
-                        # feature diff
-                        diff_index = src_ds.tree.diff_to_tree(dest_ds.tree)
-                        L.debug("Index diff: %s changes", len(diff_index))
-                        for d in diff_index.deltas:
-                            # TODO: improve this by grouping by status then calling
-                            # write_features/delete_features passing multiple PKs?
-                            if d.status == pygit2.GIT_DELTA_DELETED:
-                                old_pk = src_ds.decode_path_to_1pk(
-                                    os.path.basename(d.old_file.path)
-                                )
-                                L.debug("reset(): D %s (%s)", d.old_file.path, old_pk)
-                                self.delete_features(dbcur, src_ds, [old_pk])
-                            elif d.status == pygit2.GIT_DELTA_MODIFIED:
-                                old_pk = src_ds.decode_path_to_1pk(
-                                    os.path.basename(d.old_file.path)
-                                )
-                                new_pk = dest_ds.decode_path_to_1pk(
-                                    os.path.basename(d.new_file.path)
-                                )
-                                L.debug(
-                                    "reset(): M %s (%s) -> %s (%s)",
-                                    d.old_file.path,
-                                    old_pk,
-                                    d.new_file.path,
-                                    new_pk,
-                                )
-                                self.write_features(dbcur, dest_ds, [new_pk])
-                            elif d.status == pygit2.GIT_DELTA_ADDED:
-                                new_pk = dest_ds.decode_path_to_1pk(
-                                    os.path.basename(d.new_file.path)
-                                )
-                                L.debug("reset(): A %s (%s)", d.new_file.path, new_pk)
-                                self.write_features(dbcur, dest_ds, [new_pk])
-                            else:
-                                # GIT_DELTA_RENAMED
-                                # GIT_DELTA_COPIED
-                                # GIT_DELTA_IGNORED
-                                # GIT_DELTA_TYPECHANGE
-                                # GIT_DELTA_UNMODIFIED
-                                # GIT_DELTA_UNREADABLE
-                                # GIT_DELTA_UNTRACKED
-                                raise NotImplementedError(
-                                    f"Delta status: {d.status_char()}"
-                                )
+                        # Changes which are tracked will be committed - so features
+                        # outside the bounding box are written, rather than deleted.
+                        self._reset_features(
+                            dbcur,
+                            src_ds,
+                            dest_ds,
+                            extent,
+                            spatial_filter if update_meta else None,
+                        )
 
                     # Update gpkg_contents
                     if commit:
                         change_time = datetime.utcfromtimestamp(commit.commit_time)
                     else:
                         change_time = datetime.utcnow()
-                    if geom_col is not None:
-                        # FIXME: Why doesn't Extent(geom) work here as an aggregate?
+                    if extent is not None:
+                        min_x, max_x, min_y, max_y = extent.bounds() or (None,) * 4
                         dbcur.execute(
-                            f"""
-                            WITH _BBOX AS (
-                                SELECT
-                                    Min(MbrMinX({gpkg.ident(geom_col)})) AS min_x,
-                                    Min(MbrMinY({gpkg.ident(geom_col)})) AS min_y,
-                                    Max(MbrMaxX({gpkg.ident(geom_col)})) AS max_x,
-                                    Max(MbrMaxY({gpkg.ident(geom_col)})) AS max_y
-                                FROM {gpkg.ident(table)}
-                            )
+                            """
                             UPDATE gpkg_contents
                             SET
                                 last_change=?,
-                                min_x=(SELECT min_x FROM _BBOX),
-                                min_y=(SELECT min_y FROM _BBOX),
-                                max_x=(SELECT max_x FROM _BBOX),
-                                max_y=(SELECT max_y FROM _BBOX)
+                                min_x=?,
+                                min_y=?,
+                                max_x=?,
+                                max_y=?
                             WHERE
                                 table_name=?;
                             """,
@@ -1007,6 +2030,10 @@ class WorkingCopy_GPKG_1(WorkingCopyGPKG):
                                 change_time.strftime(
                                     "%Y-%m-%dT%H:%M:%S.%fZ"
                                 ),  # GPKG Spec Req.15
+                                min_x,
+                                min_y,
+                                max_x,
+                                max_y,
                                 table,
                             ),
                         )
@@ -184,6 +184,27 @@ def test_apply_with_working_copy_with_no_commit(
 
         assert patch['sno.diff/v1+hexwkb'] == original_patch['sno.diff/v1+hexwkb']
 
+        # The changes were tracked, and the tracking triggers are still there
+        db = geopackage(wc_path)
+        cur = db.cursor()
+        feature_changes = original_patch['sno.diff/v1+hexwkb'][H.POINTS.LAYER][
+            'featureChanges'
+        ]
+        expected_pks = {
+            str(feature[H.POINTS.LAYER_PK])
+            for change in feature_changes
+            for feature in change.values()
+        }
+        cur.execute('SELECT pk FROM ".sno-track";')
+        assert {r[0] for r in cur} == expected_pks
+        cur.execute(
+            """
+            SELECT COUNT(*) FROM sqlite_master
+            WHERE type='trigger' AND name LIKE '.sno-%';
+            """
+        )
+        assert cur.fetchone()[0] == 3
+
 
 def test_apply_multiple_dataset_patch_roundtrip(data_archive, cli_runner):
     with data_archive("au-census"):
@@ -208,6 +229,33 @@ def test_apply_multiple_dataset_patch_roundtrip(data_archive, cli_runner):
         assert new_patch_json == patch_json
 
 
+def test_apply_msgpack_patch_roundtrip(data_archive, cli_runner):
+    with data_archive("au-census"):
+        r = cli_runner.invoke(["show", "-o", "json", "master"])
+        assert r.exit_code == 0, r
+        patch_json = json.loads(r.stdout)
+
+        r = cli_runner.invoke(["show", "-o", "msgpack", "master"])
+        assert r.exit_code == 0, r
+        patch_data = r.stdout_bytes
+
+        # note: repo's current branch is 'branch1' which doesn't have the commit on it,
+        # so the patch applies cleanly.
+        r = cli_runner.invoke(["apply", "-"], input=patch_data)
+        assert r.exit_code == 0, r
+
+        r = cli_runner.invoke(["show", "-o", "json"])
+        assert r.exit_code == 0, r
+        assert json.loads(r.stdout) == patch_json
+
+
+def test_apply_invalid_msgpack_patch(data_archive_readonly, cli_runner):
+    with data_archive_readonly("points"):
+        r = cli_runner.invoke(["apply", '-'], input=b"\x81\xa6format\xa4nope")
+        assert r.exit_code == 1, r
+        assert 'Failed to parse msgpack patch file' in r.stderr
+
+
 @pytest.mark.slow
 def test_apply_benchmark(
     data_working_copy, geopackage, benchmark, cli_runner, monkeypatch
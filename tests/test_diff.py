@@ -1,12 +1,20 @@
 import collections
+import io
 import json
+import os
 import re
+from pathlib import Path
 
 import html5lib
+import msgpack
 import pytest
 
 import pygit2
-from sno.diff import Diff
+from sno.dataset1 import Dataset1
+from sno.dataset2 import Dataset2
+from sno.diff import Conflict, Diff
+from sno.diff_cache import DiffCache
+from sno.gpkg import gpkg_geom_to_hex_wkb, hex_wkb_to_gpkg_geom
 
 
 H = pytest.helpers.helpers()
@@ -1274,6 +1282,63 @@ def test_diff_object_add_2():
     assert diff3 == diff1
 
 
+def test_diff_object_add_shares_features():
+    ds = FakeDataset("ds", "pk")
+
+    diff1 = Diff(ds, inserts=DIFF_R1["I"], updates=DIFF_R1["U"], deletes=DIFF_R1["D"])
+    diff2 = Diff(ds, inserts=DIFF_R2["I"], updates=DIFF_R2["U"], deletes=DIFF_R2["D"])
+
+    updates = diff1[ds]["U"]
+    diff3 = diff1 + diff2
+    # neither side is modified
+    assert diff1[ds]["U"] is updates and len(updates) == 4
+    assert len(diff2[ds]["D"]) == 2
+    # features aren't copied
+    assert diff3[ds]["U"]["2"] is DIFF_R1["U"]["2"]
+    assert diff3[ds]["I"][1] is DIFF_R1["I"][2]
+    assert diff3[ds]["I"][2] is DIFF_R2["I"][1]
+    assert Diff(diff3)[ds]["U"] is diff3[ds]["U"]
+
+    with pytest.raises(Conflict):
+        diff1 + Diff(ds, inserts=[{"pk": 8, "v": "h"}])
+
+
+def test_diff_object_iadd_in_place():
+    ds = FakeDataset("ds", "pk")
+
+    diff1 = Diff(ds, inserts=DIFF_R1["I"], updates=DIFF_R1["U"], deletes=DIFF_R1["D"])
+    updates = diff1[ds]["U"]
+    diff1 += Diff(ds, inserts=DIFF_R2["I"], updates=DIFF_R2["U"], deletes=DIFF_R2["D"])
+    # a new Diff makes its own maps, so they're updated in place - but the maps it
+    # was given aren't modified
+    assert diff1[ds]["U"] is updates
+    assert len(DIFF_R1["I"]) == 3 and len(DIFF_R1["U"]) == 4
+
+    # but the maps diff1 made itself are - unless they've been shared since
+    updates = diff1[ds]["U"]
+    clone = Diff(diff1)
+    diff1 += Diff(ds, updates={"2": ({"pk": 2, "v": "b1"}, {"pk": 2, "v": "b2"})})
+    assert clone[ds]["U"]["2"] == ({"pk": 2, "v": "b"}, {"pk": 2, "v": "b1"})
+    assert diff1[ds]["U"] is not updates
+
+    updates = diff1[ds]["U"]
+    diff1 += Diff(
+        ds,
+        inserts=[{"pk": 9, "v": "i"}],
+        updates={"3": ({"pk": 3, "v": "c1"}, {"pk": 3, "v": "c"})},
+        deletes={"10": {"pk": 10, "v": "j"}},
+    )
+    assert diff1[ds]["U"] is updates
+    assert [o["pk"] for o in diff1[ds]["I"]] == [8, 9, 11]
+    assert "3" not in diff1[ds]["U"]
+    assert diff1[ds]["U"]["2"] == ({"pk": 2, "v": "b"}, {"pk": 2, "v": "b2"})
+
+    # if there's a conflict, diff1 isn't changed
+    with pytest.raises(Conflict):
+        diff1 += Diff(ds, inserts=[{"pk": 9, "v": "i"}, {"pk": 20, "v": "x"}])
+    assert [o["pk"] for o in diff1[ds]["I"]] == [8, 9, 11]
+
+
 def test_diff_object_eq_reverse():
     ds = FakeDataset("ds", "pk")
 
@@ -1363,6 +1428,457 @@ def test_diff_3way(data_working_copy, geopackage, cli_runner, insert, request):
         assert len(featureChanges) == 1
 
 
+@pytest.mark.parametrize("output_format", ["text", "json", "geojson", "quiet"])
+@pytest.mark.parametrize("json_style", ["pretty", "extracompact"])
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_diff_stream(
+    archive, output_format, json_style, data_working_copy, geopackage, cli_runner
+):
+    def _normalise(stdout):
+        # streamed changes aren't sorted.
+        if output_format == "json":
+            odata = json.loads(stdout)
+            for ds_diff in odata["sno.diff/v1+hexwkb"].values():
+                ds_diff["featureChanges"].sort(key=json.dumps)
+            return odata
+        elif output_format == "geojson":
+            odata = json.loads(stdout)
+            odata["features"].sort(key=json.dumps)
+            return odata
+        return sorted(stdout.splitlines())
+
+    with data_working_copy(archive) as (repo, wc):
+        db = geopackage(wc)
+        with db:
+            cur = db.cursor()
+            cur.execute(H.POINTS.INSERT, H.POINTS.RECORD)
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET fid=9998 WHERE fid=1;")
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET name='test' WHERE fid=2;")
+            cur.execute(f"DELETE FROM {H.POINTS.LAYER} WHERE fid=3;")
+
+        for commit_spec in ("HEAD", "HEAD^", "HEAD^...HEAD"):
+            args = [
+                "diff",
+                f"--output-format={output_format}",
+                f"--json-style={json_style}",
+                commit_spec,
+            ]
+            r = cli_runner.invoke(args)
+            assert r.exit_code in (0, 1), r
+            expected = _normalise(r.stdout)
+
+            r = cli_runner.invoke(args + ["--stream"])
+            assert r.exit_code in (0, 1), r
+            assert _normalise(r.stdout) == expected
+
+        r = cli_runner.invoke(["diff", "-o", "html", "--output=-", "--stream"])
+        assert r.exit_code == 0, r
+        _check_html_output(r.stdout)
+
+
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_diff_reencoded_geometry(archive, data_working_copy, geopackage, cli_runner):
+    # Geometries which are only encoded differently (here, with an envelope)
+    # aren't changes.
+    with data_working_copy(archive) as (repo, wc):
+        db = geopackage(wc)
+        with db:
+            cur = db.cursor()
+            geom = cur.execute(
+                f"SELECT geom FROM {H.POINTS.LAYER} WHERE fid=1;"
+            ).fetchone()[0]
+            geom_with_envelope = hex_wkb_to_gpkg_geom(
+                gpkg_geom_to_hex_wkb(geom), _add_envelope=True
+            )
+            assert geom_with_envelope != geom
+            cur.execute(
+                f"UPDATE {H.POINTS.LAYER} SET geom=? WHERE fid=1;",
+                [geom_with_envelope],
+            )
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET name='test' WHERE fid=2;")
+
+        r = cli_runner.invoke(["diff", "-o", "json"])
+        assert r.exit_code == 0, r
+        feature_changes = json.loads(r.stdout)["sno.diff/v1+hexwkb"][
+            H.POINTS.LAYER
+        ]["featureChanges"]
+        assert [fc["+"]["fid"] for fc in feature_changes] == [2]
+
+        r = cli_runner.invoke(["diff", "--stat", "-o", "json"])
+        assert r.exit_code == 0, r
+        assert json.loads(r.stdout)["sno.diffstat/v1"][H.POINTS.LAYER][
+            "featureChanges"
+        ] == {"modified": 1, "new": 0, "deleted": 0}
+
+
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_diff_touched_rows(
+    archive, data_working_copy, geopackage, cli_runner, monkeypatch
+):
+    # Rows which are updated to the same values aren't decoded from the repository.
+    decoded = []
+    for cls in (Dataset1, Dataset2):
+        orig_get_feature_from_blob = cls.get_feature_from_blob
+
+        def _get_feature_from_blob(self, blob, _orig=orig_get_feature_from_blob, **kw):
+            decoded.append(blob.id)
+            return _orig(self, blob, **kw)
+
+        monkeypatch.setattr(cls, "get_feature_from_blob", _get_feature_from_blob)
+
+    with data_working_copy(archive) as (repo, wc):
+        db = geopackage(wc)
+        with db:
+            cur = db.cursor()
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET name=name;")
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET name='test' WHERE fid=2;")
+
+        r = cli_runner.invoke(["diff", "-o", "json"])
+        assert r.exit_code == 0, r
+        feature_changes = json.loads(r.stdout)["sno.diff/v1+hexwkb"][
+            H.POINTS.LAYER
+        ]["featureChanges"]
+        assert [fc["+"]["fid"] for fc in feature_changes] == [2]
+        assert len(decoded) == 1
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_diff_msgpack(
+    archive, stream, data_working_copy, geopackage, cli_runner, tmp_path
+):
+    def _hex_wkb(row):
+        if row is None:
+            return None
+        return {
+            k: (v.hex().upper() if isinstance(v, bytes) else v) for k, v in row.items()
+        }
+
+    with data_working_copy(archive) as (repo, wc):
+        db = geopackage(wc)
+        with db:
+            cur = db.cursor()
+            cur.execute(H.POINTS.INSERT, H.POINTS.RECORD)
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET fid=9998 WHERE fid=1;")
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET name='test' WHERE fid=2;")
+            cur.execute(f"DELETE FROM {H.POINTS.LAYER} WHERE fid=3;")
+
+        r = cli_runner.invoke(["diff", "-o", "json"])
+        assert r.exit_code == 0, r
+        expected = json.loads(r.stdout)["sno.diff/v1+hexwkb"]
+
+        args = ["diff", "-o", "msgpack"] + (["--stream"] if stream else [])
+        r = cli_runner.invoke(args)
+        assert r.exit_code == 0, r
+        header, *objects = msgpack.Unpacker(io.BytesIO(r.stdout_bytes), raw=False)
+        assert header == {"format": "sno.diff/v1+wkb"}
+
+        # convert it to the JSON diff layout, to compare.
+        actual = {}
+        for obj in objects:
+            if isinstance(obj, dict):
+                ds_diff = actual[obj["dataset"]] = {
+                    "featureChanges": [],
+                    "metaChanges": {},
+                }
+                continue
+
+            change, key, v_old, v_new = obj
+            if change == "META":
+                ds_diff["metaChanges"][key] = [v_old, v_new]
+                continue
+            assert key is None
+            fc = {"-": _hex_wkb(v_old), "+": _hex_wkb(v_new)}
+            ds_diff["featureChanges"].append({k: v for k, v in fc.items() if v})
+
+        for ds_diff in actual.values():
+            ds_diff["featureChanges"].sort(key=json.dumps)
+        for ds_diff in expected.values():
+            ds_diff["featureChanges"].sort(key=json.dumps)
+        assert actual == expected
+
+        # the same diff can be written to a file
+        msgpack_bytes = r.stdout_bytes
+        output_path = tmp_path / "diff.msgpack"
+        r = cli_runner.invoke(args + [f"--output={output_path}"])
+        assert r.exit_code == 0, r
+        assert output_path.read_bytes() == msgpack_bytes
+
+
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_diff_stat(archive, data_working_copy, geopackage, cli_runner):
+    with data_working_copy(archive) as (repo, wc):
+        r = cli_runner.invoke(["diff", "--stat", "--exit-code"])
+        assert r.exit_code == 0, r
+        assert r.stdout == ""
+
+        db = geopackage(wc)
+        with db:
+            cur = db.cursor()
+            cur.execute(H.POINTS.INSERT, H.POINTS.RECORD)
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET fid=9998 WHERE fid=1;")
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET name='test' WHERE fid=2;")
+            cur.execute(f"DELETE FROM {H.POINTS.LAYER} WHERE fid=3;")
+            # changed and then changed back again
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET t50_fid=t50_fid+1 WHERE fid=4;")
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET t50_fid=t50_fid-1 WHERE fid=4;")
+
+        r = cli_runner.invoke(["diff", "--stat", "-o", "json"])
+        assert r.exit_code == 0, r
+        assert json.loads(r.stdout) == {
+            "sno.diffstat/v1": {
+                H.POINTS.LAYER: {
+                    "metaChanges": None,
+                    "featureChanges": {"modified": 2, "new": 1, "deleted": 1},
+                }
+            }
+        }
+
+        r = cli_runner.invoke(["diff", "--stat"])
+        assert r.exit_code == 0, r
+        assert r.stdout.splitlines() == [
+            f"  {H.POINTS.LAYER}/",
+            "    modified:  2 features",
+            "    new:       1 feature",
+            "    deleted:   1 feature",
+        ]
+
+        # the counts match the full diff
+        for commit_spec in ("HEAD^", "HEAD^...HEAD"):
+            r = cli_runner.invoke(["diff", "-o", "json", commit_spec])
+            assert r.exit_code == 0, r
+            feature_changes = json.loads(r.stdout)["sno.diff/v1+hexwkb"][
+                H.POINTS.LAYER
+            ]["featureChanges"]
+            expected = {
+                "modified": sum(1 for c in feature_changes if len(c) == 2),
+                "new": sum(1 for c in feature_changes if list(c) == ["+"]),
+                "deleted": sum(1 for c in feature_changes if list(c) == ["-"]),
+            }
+
+            r = cli_runner.invoke(["diff", "--stat", "-o", "json", commit_spec])
+            assert r.exit_code == 0, r
+            stat = json.loads(r.stdout)["sno.diffstat/v1"][H.POINTS.LAYER]
+            assert stat["featureChanges"] == expected
+
+        r = cli_runner.invoke(["diff", "--stat", "-o", "quiet"])
+        assert r.exit_code == 1, r
+
+        r = cli_runner.invoke(["diff", "--stat", "-o", "geojson"])
+        assert r.exit_code == 2, r
+
+
+def test_diff_stat_renames(data_working_copy, geopackage, cli_runner, monkeypatch):
+    import sno.working_copy
+
+    class _TinyRenameBuffer(sno.working_copy._RenameBuffer):
+        # if it's bounded at all, it's too small to pair up any renames
+        def __init__(self, max_size=None):
+            super().__init__(None if max_size is None else 0)
+
+    monkeypatch.setattr(sno.working_copy, "_RenameBuffer", _TinyRenameBuffer)
+
+    with data_working_copy("points") as (repo, wc):
+        db = geopackage(wc)
+        with db:
+            cur = db.cursor()
+            for fid in (1, 2, 3):
+                cur.execute(
+                    f"UPDATE {H.POINTS.LAYER} SET fid={fid + 9000} WHERE fid={fid};"
+                )
+
+        r = cli_runner.invoke(["diff", "-o", "json"])
+        assert r.exit_code == 0, r
+        feature_changes = json.loads(r.stdout)["sno.diff/v1+hexwkb"][H.POINTS.LAYER][
+            "featureChanges"
+        ]
+        assert len(feature_changes) == 3
+        assert all(len(c) == 2 for c in feature_changes)
+
+        # the counts match the full diff, however far apart the renames are
+        r = cli_runner.invoke(["diff", "--stat", "-o", "json"])
+        assert r.exit_code == 0, r
+        stat = json.loads(r.stdout)["sno.diffstat/v1"][H.POINTS.LAYER]
+        assert stat["featureChanges"] == {"modified": 3, "new": 0, "deleted": 0}
+
+
+def test_diff_quiet(data_working_copy, geopackage, cli_runner):
+    with data_working_copy("points") as (repo, wc):
+        for commit_spec, expected in (
+            ("HEAD", 0),
+            ("HEAD...HEAD", 0),
+            ("HEAD^...HEAD", 1),
+            ("HEAD^", 1),
+        ):
+            r = cli_runner.invoke(["diff", "-o", "quiet", commit_spec])
+            assert r.exit_code == expected, (commit_spec, r)
+
+        db = geopackage(wc)
+        with db:
+            cur = db.cursor()
+            # changed and then changed back again - tracked, but not a change
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET t50_fid=t50_fid+1 WHERE fid=4;")
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET t50_fid=t50_fid-1 WHERE fid=4;")
+
+        r = cli_runner.invoke(["diff", "-o", "quiet"])
+        assert r.exit_code == 0, r
+
+        with db:
+            cur = db.cursor()
+            cur.execute(f"UPDATE {H.POINTS.LAYER} SET fid=9998 WHERE fid=1;")
+
+        r = cli_runner.invoke(["diff", "-o", "quiet"])
+        assert r.exit_code == 1, r
+        r = cli_runner.invoke(["diff", "-o", "quiet", "--bbox", "0,0,1,1"])
+        assert r.exit_code == 0, r
+        r = cli_runner.invoke(["diff", "--stat", "-o", "quiet"])
+        assert r.exit_code == 1, r
+
+
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_diff_cache(archive, data_archive, cli_runner):
+    with data_archive(archive) as repo_path:
+        repo = pygit2.Repository(str(repo_path))
+        cache_path = Path(repo.path) / "diffs.sno-cache"
+        args = ["diff", "-o", "json", "HEAD^...HEAD"]
+
+        r = cli_runner.invoke(args)
+        assert r.exit_code == 0, r
+        assert cache_path.exists()
+        expected = r.stdout
+
+        # the second diff comes from the cache
+        r = cli_runner.invoke(args)
+        assert r.exit_code == 0, r
+        assert r.stdout == expected
+
+        r = cli_runner.invoke(["show", "-o", "json", "HEAD"])
+        assert r.exit_code == 0, r
+        assert (
+            json.loads(r.stdout)["sno.diff/v1+hexwkb"]
+            == json.loads(expected)["sno.diff/v1+hexwkb"]
+        )
+
+        # filtered diffs are cached separately
+        changes = json.loads(expected)["sno.diff/v1+hexwkb"][H.POINTS.LAYER]
+        fc = changes["featureChanges"][0]
+        pk = (fc.get("-") or fc.get("+"))[H.POINTS.LAYER_PK]
+        r = cli_runner.invoke(args + [f"{H.POINTS.LAYER}:{pk}"])
+        assert r.exit_code == 0, r
+        changes = json.loads(r.stdout)["sno.diff/v1+hexwkb"][H.POINTS.LAYER]
+        assert changes["featureChanges"] == [fc]
+
+
+def test_diff_cache_eviction(tmp_path):
+    ds_diff = {"META": {}, "I": [{"pk": 1, "geom": os.urandom(100)}], "U": {}, "D": {}}
+    empty_diff = {"META": {}, "I": [], "U": {}, "D": {}}
+    keys = [DiffCache.key(None, pygit2.Oid(hex=f"{i:040x}")) for i in range(3)]
+    assert len(set(keys)) == 3
+
+    cache = DiffCache(tmp_path / "diffs.sno-cache", max_size=1000)
+    for key in keys[:2]:
+        cache[key] = ds_diff
+    assert cache.get(keys[0]) == ds_diff
+    assert cache.get(keys[1]) == ds_diff
+
+    # there's only room for one of the larger diffs now. keys[0] was used least
+    # recently, so it is evicted first.
+    cache.max_size = 200
+    cache[keys[2]] = empty_diff
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) == ds_diff
+    assert cache.get(keys[2]) == empty_diff
+
+    # a diff that would never fit isn't cached, and nothing is evicted for it.
+    big_diff = {
+        "META": {},
+        "I": [{"pk": i, "geom": os.urandom(100)} for i in range(10)],
+        "U": {},
+        "D": {},
+    }
+    big_key = DiffCache.key(None, pygit2.Oid(hex=f"{3:040x}"))
+    cache[big_key] = big_diff
+    assert cache.get(big_key) is None
+    assert cache.get(keys[1]) == ds_diff
+    cache.close()
+
+
+@pytest.mark.parametrize("output_format", ["text", "json"])
+def test_diff_jobs(output_format, data_archive, cli_runner):
+    with data_archive("au-census"):
+        args = ["diff", "-o", output_format, "master^...master"]
+        r = cli_runner.invoke(args)
+        assert r.exit_code == 0, r
+        expected = r.stdout
+        if output_format == "json":
+            assert len(json.loads(expected)["sno.diff/v1+hexwkb"]) == 2
+
+        for jobs in ("2", "4"):
+            r = cli_runner.invoke(args + ["--jobs", jobs])
+            assert r.exit_code == 0, r
+            # datasets are always output in the same order.
+            assert r.stdout == expected
+
+        r = cli_runner.invoke(args + ["--jobs", "2", "--stream"])
+        assert r.exit_code == 2, r
+
+
+def test_rename_buffer():
+    from sno.working_copy import _RenameBuffer
+
+    renames = _RenameBuffer(max_size=2)
+    assert renames.add("h1", ("D", "1", {"fid": 1}, None)) == []
+    assert renames.add("h2", ("I", "5", None, {"fid": 5})) == []
+    # a delete and an insert with the same hash are paired up.
+    assert renames.add("h1", ("I", "9", None, {"fid": 9})) == [
+        ("U", "1", {"fid": 1}, {"fid": 9})
+    ]
+    assert renames.add("h3", ("D", "3", {"fid": 3}, None)) == []
+    # the buffer is full, so the oldest record is evicted unpaired.
+    assert renames.add("h4", ("D", "4", {"fid": 4}, None)) == [
+        ("I", "5", None, {"fid": 5})
+    ]
+    assert renames.add("h2", ("D", "2", {"fid": 2}, None)) == [
+        ("D", "3", {"fid": 3}, None)
+    ]
+    assert list(renames.flush()) == [
+        ("D", "4", {"fid": 4}, None),
+        ("D", "2", {"fid": 2}, None),
+    ]
+
+
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_diff_bbox(archive, data_working_copy, geopackage, cli_runner, update):
+    # fid=1 is at (177.0959629713586, -38.00433803621768)
+    inside = "177.0,-38.1,177.2,-37.9"
+    outside = "170.0,-40.0,170.1,-39.9"
+
+    def _feature_changes(*args):
+        r = cli_runner.invoke(["diff", "-o", "json", *args])
+        assert r.exit_code == 0, r
+        return json.loads(r.stdout)["sno.diff/v1+hexwkb"].get(
+            "nz_pa_points_topo_150k", {"featureChanges": []}
+        )["featureChanges"]
+
+    with data_working_copy(archive) as (repo_path, wc):
+        db = geopackage(wc)
+        update(db, 1, "bbox-test")
+
+        # run twice: the second time the envelopes come from the cache.
+        for i in range(2):
+            assert len(_feature_changes("HEAD^...HEAD", "--bbox", inside)) == 1
+            assert len(_feature_changes("HEAD^...HEAD", "--bbox", outside)) == 0
+
+        # working copy changes are filtered too.
+        update(db, 1, "bbox-test-2", commit=False)
+        assert len(_feature_changes("--bbox", inside)) == 1
+        assert len(_feature_changes("--bbox", outside)) == 0
+        assert len(_feature_changes("HEAD^", "--bbox", inside)) == 1
+
+        r = cli_runner.invoke(["diff", "--bbox", "1,2,3"])
+        assert r.exit_code == 2, r
+
+
 @pytest.mark.parametrize("output_format", SHOW_OUTPUT_FORMATS)
 @pytest.mark.parametrize(*V1_OR_V2)
 def test_show_points_HEAD(
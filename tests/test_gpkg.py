@@ -1,4 +1,6 @@
+import json
 import re
+import struct
 
 import pytest
 from osgeo import ogr, osr
@@ -8,6 +10,11 @@ from sno.gpkg import (
     gpkg_geom_to_hex_wkb,
     ogr_to_gpkg_geom,
     gpkg_geom_to_ogr,
+    gpkg_geom_to_geojson,
+    geom_fingerprint,
+    features_equal,
+    geom_envelope,
+    _WKBToGeoJSON,
 )
 
 SRID_RE = re.compile(r'^SRID=(\d+);(.*)$')
@@ -149,3 +156,109 @@ def test_gpkg_wkb_gpkg_roundtrip(
     gpkg_geom = hex_wkb_to_gpkg_geom(hex_wkb_2)
 
     assert gpkg_geom == input
+
+
+@pytest.mark.parametrize(
+    'wkt',
+    [
+        'POINT(1 2)',
+        'POINT(1 2 3)',
+        'POINT EMPTY',
+        'LINESTRING(1 2,3 4.5)',
+        'POLYGON((0 0,0 1,1 1,0 0),(0.25 0.25,0.25 0.5,0.5 0.5,0.25 0.25))',
+        'MULTIPOINT(1 2,3 4)',
+        'MULTILINESTRING((1 2,3 4),(5 6,7 8))',
+        'MULTIPOLYGON(((0 0,0 1,1 1,0 0)),((2 2,2 3,3 3,2 2)))',
+        'GEOMETRYCOLLECTION(POINT(1 2),LINESTRING(1 2,3 4))',
+        'GEOMETRYCOLLECTION EMPTY',
+    ],
+)
+@pytest.mark.parametrize('little_endian_wkb', [False, True])
+@pytest.mark.parametrize('with_envelope', [False, True])
+def test_gpkg_geom_to_geojson(wkt, little_endian_wkb, with_envelope):
+    hex_wkb = gpkg_geom_to_hex_wkb(ogr_to_gpkg_geom(ewkt_to_ogr(wkt)))
+    gpkg_geom = hex_wkb_to_gpkg_geom(
+        hex_wkb, _little_endian_wkb=little_endian_wkb, _add_envelope=with_envelope,
+    )
+    expected = json.loads(gpkg_geom_to_ogr(gpkg_geom).ExportToJson())
+    assert gpkg_geom_to_geojson(gpkg_geom) == expected
+
+
+
+def test_gpkg_geom_to_geojson_ewkb_srid(monkeypatch):
+    # EWKB POINT(1 2) with an embedded SRID, which the fast path doesn't parse
+    ewkb = struct.pack("<BIIdd", 1, 0x20000001, 4326, 1.0, 2.0)
+    with pytest.raises(NotImplementedError):
+        _WKBToGeoJSON(ewkb).geometry()
+
+    class FakeOgrGeometry:
+        def ExportToJson(self):
+            return '{"type": "Point", "coordinates": [1.0, 2.0]}'
+
+    # so it's left to OGR
+    gpkg_geom = b"GP\x00\x01" + struct.pack("<i", 4326) + ewkb
+    monkeypatch.setattr("sno.gpkg.gpkg_geom_to_ogr", lambda g: FakeOgrGeometry())
+    assert gpkg_geom_to_geojson(gpkg_geom) == {
+        "type": "Point",
+        "coordinates": [1.0, 2.0],
+    }
+
+
+@pytest.mark.parametrize(
+    'wkt', ['POINT(1 2)', 'POINT(1 2 3)', 'POINT EMPTY', 'LINESTRING(1 2,3 4)'],
+)
+def test_geom_fingerprint(wkt):
+    hex_wkb = gpkg_geom_to_hex_wkb(ogr_to_gpkg_geom(ewkt_to_ogr(wkt)))
+    fingerprints = {
+        geom_fingerprint(
+            hex_wkb_to_gpkg_geom(
+                hex_wkb,
+                _little_endian=little_endian,
+                _little_endian_wkb=little_endian_wkb,
+                _add_envelope=with_envelope,
+            )
+        )
+        for little_endian in (False, True)
+        for little_endian_wkb in (False, True)
+        for with_envelope in (False, True)
+    }
+    assert len(fingerprints) == 1
+
+    other = ogr_to_gpkg_geom(ewkt_to_ogr('POINT(2 1)'))
+    assert geom_fingerprint(other) not in fingerprints
+    srid_other = ogr_to_gpkg_geom(ewkt_to_ogr(f'SRID=4326;{wkt}'))
+    assert geom_fingerprint(srid_other) not in fingerprints
+
+
+def test_features_equal():
+    geom = ogr_to_gpkg_geom(ewkt_to_ogr('POINT(1 2)'))
+    geom_with_envelope = hex_wkb_to_gpkg_geom(
+        gpkg_geom_to_hex_wkb(geom), _add_envelope=True
+    )
+    a = {'fid': 1, 'geom': geom, 'name': 'a'}
+
+    assert features_equal(a, {'fid': 1, 'geom': geom_with_envelope, 'name': 'a'})
+    assert not features_equal(a, {'fid': 1, 'geom': geom_with_envelope, 'name': 'b'})
+    assert not features_equal(a, {'fid': 1, 'geom': None, 'name': 'a'})
+    assert not features_equal(a, {'fid': 1, 'geom': geom})
+    other_geom = ogr_to_gpkg_geom(ewkt_to_ogr('POINT(2 1)'))
+    assert not features_equal(a, {'fid': 1, 'geom': other_geom, 'name': 'a'})
+
+
+@pytest.mark.parametrize(
+    'wkt,expected',
+    [
+        ('POINT(1 2)', (1, 1, 2, 2)),
+        ('POINT(1 2 3)', (1, 1, 2, 2)),
+        ('POINT EMPTY', None),
+        ('LINESTRING(1 2,3 4.5)', (1, 3, 2, 4.5)),
+    ],
+)
+@pytest.mark.parametrize('little_endian_wkb', [False, True])
+@pytest.mark.parametrize('with_envelope', [False, True])
+def test_geom_envelope(wkt, expected, little_endian_wkb, with_envelope):
+    hex_wkb = gpkg_geom_to_hex_wkb(ogr_to_gpkg_geom(ewkt_to_ogr(wkt)))
+    gpkg_geom = hex_wkb_to_gpkg_geom(
+        hex_wkb, _little_endian_wkb=little_endian_wkb, _add_envelope=with_envelope,
+    )
+    assert geom_envelope(gpkg_geom) == expected
@@ -114,3 +114,112 @@ def test_query_cli_geo_intersects(indexed_dataset, cli_runner):
             assert (
                 intersects
             ), f"No intersection found for idx {i}/{len(data)-1}: {json.dumps(o)}"
+
+
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_query_cli_get_bulk(archive, data_archive, cli_runner):
+    with data_archive(archive):
+        # no spatial index is needed, and missing PKs are skipped.
+        r = cli_runner.invoke(
+            ["query", H.POINTS.LAYER, "get-bulk"], input="3\n1\n\n2\n999999\n"
+        )
+        assert r.exit_code == 0, r
+
+        lines = r.stdout.splitlines()
+        assert len(lines) == 3
+        features = [json.loads(line) for line in lines]
+        assert sorted(f["fid"] for f in features) == [1, 2, 3]
+        feature = next(f for f in features if f["fid"] == 1)
+        assert feature["geom"] == {
+            "coordinates": [177.0959629713586, -38.00433803621768],
+            "type": "Point",
+        }
+        assert feature["t50_fid"] == 2426271
+
+        r = cli_runner.invoke(
+            ["query", "-o", "geojsonseq", H.POINTS.LAYER, "get-bulk", "-"],
+            input="1\n2\n",
+        )
+        assert r.exit_code == 0, r
+        records = r.stdout.split("\x1e")
+        assert records[0] == ""
+        features = [json.loads(record) for record in records[1:]]
+        assert sorted(f["id"] for f in features) == [1, 2]
+        assert all(f["type"] == "Feature" for f in features)
+
+
+@pytest.mark.parametrize(
+    "archive",
+    [pytest.param("points", id="points"), pytest.param("points2", id="points2")],
+)
+def test_query_cli_where(archive, data_working_copy, geopackage, update, cli_runner):
+    with data_working_copy(archive) as (repo_path, wc_path):
+        r = cli_runner.invoke(["query", H.POINTS.LAYER, "where", "t50_fid", "=", "1"])
+        assert r.exit_code == 40, r
+
+        r = cli_runner.invoke(["query", H.POINTS.LAYER, "index", "t50_fid", "name"])
+        assert r.exit_code == 0, r
+
+        r = cli_runner.invoke(["query", H.POINTS.LAYER, "index", "geom"])
+        assert r.exit_code == 2, r
+
+        r = cli_runner.invoke(
+            ["query", H.POINTS.LAYER, "where", "t50_fid", "=", "2426271"]
+        )
+        assert r.exit_code == 0, r
+        assert [f["fid"] for f in json.loads(r.stdout)] == [1]
+
+        r = cli_runner.invoke(
+            ["query", H.POINTS.LAYER, "where", "fid", "between", "1", "3"]
+        )
+        assert r.exit_code == 40, r
+
+        r = cli_runner.invoke(["query", H.POINTS.LAYER, "index", "fid"])
+        assert r.exit_code == 0, r
+        for op, expected in (("between", 3), ("<=", 3), ("lt", 2)):
+            values = ["1", "3"] if op == "between" else ["3"]
+            r = cli_runner.invoke(["query", H.POINTS.LAYER, "where", "fid", op, *values])
+            assert r.exit_code == 0, r
+            assert len(json.loads(r.stdout)) == expected
+
+        # the index is brought up to date with new commits before it's used.
+        db = geopackage(wc_path)
+        update(db, 2, "indexed-name")
+        r = cli_runner.invoke(
+            ["query", H.POINTS.LAYER, "where", "name", "=", "indexed-name"]
+        )
+        assert r.exit_code == 0, r
+        assert [f["fid"] for f in json.loads(r.stdout)] == [2]
+
+
+def test_attribute_index_dataset_path(tmp_path):
+    from sno.attribute_index import AttributeIndex
+
+    class FakeRepo:
+        path = str(tmp_path)
+
+    class FakeDataset:
+        def __init__(self, path):
+            self.path = path
+
+    class FakeTree:
+        def __init__(self, hex):
+            self.hex = hex
+
+    # datasets with the same name in different directories get their own index
+    index_a = AttributeIndex.for_dataset(FakeRepo, FakeDataset("a/parcels"))
+    index_b = AttributeIndex.for_dataset(FakeRepo, FakeDataset("b/parcels"))
+    assert index_a.path != index_b.path
+    assert index_a.path.parent == index_b.path.parent == tmp_path / "attribute-indexes"
+    index_a._set_indexed_tree(index_a.db.cursor(), "name", FakeTree("abc123"))
+    index_b.close()
+    index_a.close()
+
+    index = AttributeIndex(index_a.path, "a/parcels")
+    assert index.indexed_tree("name") == "abc123"
+    index.close()
+
+    # an index of some other dataset is emptied
+    index = AttributeIndex(index_a.path, "b/parcels")
+    assert index.indexed_tree("name") is None
+    index.close()
@@ -14,6 +14,7 @@ from sno import gpkg, structure, fast_import
 from sno.init import OgrImporter, ImportPostgreSQL
 from sno.dataset1 import Dataset1
 from sno.dataset2 import Dataset2
+from sno.lazy_feature import LazyFeature, resolve_dataset_diff
 from sno.structure_version import STRUCTURE_VERSIONS_CHOICE
 
 
@@ -724,6 +725,32 @@ def test_pk_encoding():
     assert ds.decode_path_to_1pk("mytable/.sno-table/b5/24/pERhdmU=") == "Dave"
 
 
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_diff_lazy_features(archive, data_archive):
+    with data_archive(archive) as repo_path:
+        repo = pygit2.Repository(str(repo_path))
+        base_ds = structure.RepositoryStructure.lookup(repo, "HEAD^")[H.POINTS.LAYER]
+        target_ds = structure.RepositoryStructure.lookup(repo, "HEAD")[H.POINTS.LAYER]
+
+        ds_diff = base_ds.diff(target_ds)[H.POINTS.LAYER]
+        features = [f for old, new in ds_diff["U"].values() for f in (old, new)]
+        features += ds_diff["I"] + list(ds_diff["D"].values())
+        assert features
+        assert all(isinstance(f, LazyFeature) for f in features)
+
+        # primary keys, and comparisons between the same blob, don't decode anything
+        for f in features:
+            assert f[H.POINTS.LAYER_PK] == f.pk
+            assert f == LazyFeature(f.dataset, f.path, f.blob_id)
+        assert not any(f.is_resolved for f in features)
+
+        resolve_dataset_diff(ds_diff, batch_size=2)
+        assert all(f.is_resolved for f in features)
+        for f in features:
+            assert dict(f) == f.dataset.get_feature(f.pk, ogr_geoms=False)
+            assert f == f.dataset.get_feature(f.pk, ogr_geoms=False)
+
+
 @pytest.mark.slow
 @pytest.mark.parametrize(*GPKG_IMPORTS)
 @pytest.mark.parametrize(*V1_OR_V2)
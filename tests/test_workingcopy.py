@@ -7,7 +7,10 @@ import apsw
 import pygit2
 
 import sno.checkout
-from sno.working_copy import WorkingCopy
+from sno import gpkg
+from sno.spatial_filter import SpatialFilter
+from sno.structure import RepositoryStructure
+from sno.working_copy import WorkingCopy, WorkingCopy_GPKG_1
 from sno.exceptions import INVALID_ARGUMENT, INVALID_OPERATION
 
 
@@ -68,6 +71,78 @@ def test_checkout_workingcopy(
         assert wc.assert_db_tree_match(head_tree)
 
 
+@pytest.mark.parametrize(
+    "archive,table,pk_field",
+    [
+        pytest.param("points", H.POINTS.LAYER, H.POINTS.LAYER_PK, id="points"),
+        pytest.param("points2", H.POINTS.LAYER, H.POINTS.LAYER_PK, id="points2"),
+        pytest.param(
+            "polygons", H.POLYGONS.LAYER, H.POLYGONS.LAYER_PK, id="polygons-pk"
+        ),
+    ],
+)
+def test_checkout_jobs(
+    archive, table, pk_field, data_archive, tmp_path, cli_runner, geopackage
+):
+    with data_archive(archive) as repo_path:
+        H.clear_working_copy()
+        r = cli_runner.invoke(["checkout", f"--path={tmp_path / 'serial.gpkg'}"])
+        assert r.exit_code == 0, r
+        db = geopackage(tmp_path / "serial.gpkg")
+        row_count = H.row_count(db, table)
+        table_hash = H.db_table_hash(db, table, pk_field)
+        db.close()
+
+        H.clear_working_copy()
+        wc_parallel = tmp_path / "parallel.gpkg"
+        r = cli_runner.invoke(["checkout", f"--path={wc_parallel}", "--jobs=2"])
+        assert r.exit_code == 0, r
+
+        db = geopackage(wc_parallel)
+        assert H.row_count(db, table) == row_count
+        assert H.db_table_hash(db, table, pk_field) == table_hash
+
+        repo = pygit2.Repository(str(repo_path))
+        wc = WorkingCopy.open(repo)
+        assert wc.assert_db_tree_match(repo.head.peel(pygit2.Tree))
+
+
+def test_checkout_jobs_multiple_datasets(
+    data_archive, tmp_path, cli_runner, geopackage
+):
+    tables = ["census2016_sdhca_ot_ra_short", "census2016_sdhca_ot_sos_short"]
+
+    def _contents(db):
+        cur = db.cursor()
+        meta = [
+            cur.execute(f"SELECT * FROM {meta_table} ORDER BY table_name;").fetchall()
+            for meta_table in ("gpkg_contents", "gpkg_geometry_columns")
+        ]
+        return meta + [H.db_table_hash(db, table) for table in tables]
+
+    with data_archive("au-census") as repo_path:
+        H.clear_working_copy()
+        r = cli_runner.invoke(["checkout", f"--path={tmp_path / 'serial.gpkg'}"])
+        assert r.exit_code == 0, r
+        db = geopackage(tmp_path / "serial.gpkg")
+        expected = _contents(db)
+        db.close()
+
+        H.clear_working_copy()
+        wc_parallel = tmp_path / "parallel.gpkg"
+        r = cli_runner.invoke(["checkout", f"--path={wc_parallel}", "--jobs=2"])
+        assert r.exit_code == 0, r
+
+        db = geopackage(wc_parallel)
+        assert _contents(db) == expected
+        # the temporary databases are cleaned up
+        assert not any(p.name.startswith(".sno-checkout-") for p in tmp_path.iterdir())
+
+        repo = pygit2.Repository(str(repo_path))
+        wc = WorkingCopy.open(repo)
+        assert wc.assert_db_tree_match(repo.head.peel(pygit2.Tree))
+
+
 def test_checkout_detached(data_working_copy, cli_runner, geopackage):
     """ Checkout a working copy to edit """
     with data_working_copy("points") as (repo_dir, wc):
@@ -677,3 +752,380 @@ def test_delete_branch(data_working_copy, cli_runner):
 
         r = cli_runner.invoke(["branch", "-d", "test"])
         assert r.exit_code == 0, r
+
+
+@pytest.mark.parametrize("rebuild_spatial_index", [False, True])
+def test_reset_spatial_index(
+    rebuild_spatial_index, data_working_copy, geopackage, cli_runner, monkeypatch
+):
+    if rebuild_spatial_index:
+        monkeypatch.setattr(WorkingCopy_GPKG_1, "RESET_SPATIAL_INDEX_REBUILD_RATIO", 0)
+    rtree = f"rtree_{H.POINTS.LAYER}_geom"
+
+    def _trigger_names(cur):
+        cur.execute(
+            "SELECT name FROM sqlite_master WHERE type='trigger' ORDER BY name;"
+        )
+        return [r[0] for r in cur]
+
+    with data_working_copy("points") as (repo_dir, wc):
+        db = geopackage(wc)
+        cur = db.cursor()
+        triggers_before = _trigger_names(cur)
+
+        r = cli_runner.invoke(["checkout", "HEAD^"])
+        assert r.exit_code == 0, r
+
+        # the spatial index has an entry for exactly the features in the table
+        assert _trigger_names(cur) == triggers_before
+        cur.execute(f"SELECT id FROM {rtree} ORDER BY id;")
+        rtree_ids = [r[0] for r in cur]
+        cur.execute(
+            f"SELECT {H.POINTS.LAYER_PK} FROM {H.POINTS.LAYER} "
+            f"WHERE geom IS NOT NULL ORDER BY {H.POINTS.LAYER_PK};"
+        )
+        assert rtree_ids == [r[0] for r in cur]
+
+
+@pytest.mark.parametrize(
+    "archive,layer",
+    [
+        pytest.param("points", H.POINTS, id="points"),
+        pytest.param("polygons", H.POLYGONS, id="polygons"),
+    ],
+)
+def test_checkout_spatial_index(archive, layer, data_working_copy, geopackage):
+    rtree = f"rtree_{layer.LAYER}_geom"
+    with data_working_copy(archive) as (repo_dir, wc):
+        db = geopackage(wc)
+        cur = db.cursor()
+
+        cur.execute(
+            """
+            SELECT extension_name FROM gpkg_extensions
+            WHERE table_name=? AND column_name='geom';
+            """,
+            (layer.LAYER,),
+        )
+        assert cur.fetchall() == [("gpkg_rtree_index",)]
+
+        def _check_rtree():
+            # every geometry has an entry, which contains its envelope
+            # (R-Tree coordinates are rounded outwards to 32-bit floats)
+            cur.execute(
+                f"""
+                SELECT COUNT(*) FROM {layer.LAYER} T LEFT OUTER JOIN {rtree} R
+                ON T.{layer.LAYER_PK} = R.id
+                WHERE T.geom IS NOT NULL AND NOT (
+                    R.minx <= ST_MinX(T.geom) AND R.maxx >= ST_MaxX(T.geom)
+                    AND R.miny <= ST_MinY(T.geom) AND R.maxy >= ST_MaxY(T.geom)
+                );
+                """
+            )
+            assert cur.fetchone()[0] == 0
+            cur.execute(f"SELECT COUNT(*) FROM {rtree};")
+            rtree_count = cur.fetchone()[0]
+            cur.execute(f"SELECT COUNT(*) FROM {layer.LAYER} WHERE geom IS NOT NULL;")
+            assert rtree_count == cur.fetchone()[0]
+
+        _check_rtree()
+
+        # and the triggers keep it up to date
+        with db:
+            cur.execute(layer.INSERT, layer.RECORD)
+        _check_rtree()
+
+
+@pytest.mark.parametrize("spatial_index", [True, False])
+def test_reset_extent(spatial_index, data_working_copy, geopackage, cli_runner):
+    layer = H.POINTS.LAYER
+    with data_working_copy("points") as (repo_dir, wc):
+        db = geopackage(wc)
+        cur = db.cursor()
+        if not spatial_index:
+            # the extent has to be recalculated from the table
+            with db:
+                cur.execute(
+                    """
+                    SELECT name FROM sqlite_master
+                    WHERE type='trigger' AND name LIKE 'rtree_%';
+                    """
+                )
+                for (name,) in cur.fetchall():
+                    cur.execute(f'DROP TRIGGER "{name}";')
+                cur.execute(f"DROP TABLE rtree_{layer}_geom;")
+                cur.execute("DELETE FROM gpkg_extensions WHERE table_name=?;", (layer,))
+
+        # delete the westernmost feature, so the extent shrinks
+        with db:
+            cur.execute(
+                f"""
+                DELETE FROM {layer} WHERE {H.POINTS.LAYER_PK} = (
+                    SELECT {H.POINTS.LAYER_PK} FROM {layer} ORDER BY ST_MinX(geom) LIMIT 1
+                );
+                """
+            )
+        r = cli_runner.invoke(["commit", "-m", "test1"])
+        assert r.exit_code == 0, r
+
+        # the extent stored in gpkg_contents is wrong, so it can't be the starting point
+        with db:
+            cur.execute(
+                "UPDATE gpkg_contents SET min_x=-1e9, max_y=1e9 WHERE table_name=?;",
+                (layer,),
+            )
+
+        r = cli_runner.invoke(["checkout", "HEAD^"])
+        assert r.exit_code == 0, r
+        H.verify_gpkg_extent(db, layer)
+        cur.execute("SELECT min_x FROM gpkg_contents WHERE table_name=?;", (layer,))
+        min_x = cur.fetchone()[0]
+
+        r = cli_runner.invoke(["checkout", "master"])
+        assert r.exit_code == 0, r
+        H.verify_gpkg_extent(db, layer)
+        cur.execute("SELECT min_x FROM gpkg_contents WHERE table_name=?;", (layer,))
+        assert cur.fetchone()[0] > min_x
+
+
+def test_bulk_edit(data_working_copy, geopackage, cli_runner):
+    layer = H.POINTS.LAYER
+    pk = H.POINTS.LAYER_PK
+
+    def _tracking_triggers(cur):
+        cur.execute(
+            """
+            SELECT COUNT(*) FROM sqlite_master
+            WHERE type='trigger' AND name LIKE '.sno-%';
+            """
+        )
+        return cur.fetchone()[0]
+
+    with data_working_copy("points") as (repo_dir, wc):
+        db = geopackage(wc)
+        cur = db.cursor()
+
+        r = cli_runner.invoke(["workingcopy", "bulk-edit", "begin"])
+        assert r.exit_code == 0, r
+        assert _tracking_triggers(cur) == 0
+
+        r = cli_runner.invoke(["workingcopy", "bulk-edit", "begin"])
+        assert r.exit_code == INVALID_OPERATION, r
+
+        with db:
+            cur.execute(H.POINTS.INSERT, H.POINTS.RECORD)
+            cur.execute(f"UPDATE {layer} SET name='test' WHERE {pk}=1;")
+            cur.execute(f"DELETE FROM {layer} WHERE {pk}=2;")
+            # touched, but not changed
+            cur.execute(f"UPDATE {layer} SET name=name WHERE {pk}=3;")
+
+        # changes aren't known until bulk-edit mode ends
+        r = cli_runner.invoke(["status"])
+        assert r.exit_code == INVALID_OPERATION, r
+
+        # and they can't be discarded either, even by force
+        for args in (["reset"], ["checkout", "--force", "HEAD"]):
+            r = cli_runner.invoke(args)
+            assert r.exit_code == INVALID_OPERATION, r
+            assert "bulk-edit mode" in r.stderr
+        assert _tracking_triggers(cur) == 0
+
+        r = cli_runner.invoke(["workingcopy", "bulk-edit", "end"])
+        assert r.exit_code == 0, r
+        assert r.stdout.splitlines()[-1].endswith(": 3 changed rows")
+        assert _tracking_triggers(cur) == 3
+
+        cur.execute('SELECT pk FROM ".sno-track" ORDER BY CAST(pk AS INTEGER);')
+        assert [r[0] for r in cur] == ["1", "2", str(H.POINTS.RECORD[pk])]
+
+        r = cli_runner.invoke(["diff", "--stat", "-o", "json"])
+        assert r.exit_code == 0, r
+
+        r = cli_runner.invoke(["workingcopy", "bulk-edit", "end"])
+        assert r.exit_code == INVALID_OPERATION, r
+
+
+def test_dirty_buckets(data_working_copy, geopackage, monkeypatch):
+    layer = H.POINTS.LAYER
+    pk = H.POINTS.LAYER_PK
+
+    with data_working_copy("points") as (repo_dir, wc_path):
+        db = geopackage(wc_path)
+        cur = db.cursor()
+        rs = RepositoryStructure(pygit2.Repository(str(repo_dir)))
+        dataset = rs[layer]
+        wc = rs.working_copy
+
+        assert wc.dirty_buckets(dataset) == {}
+        assert not wc.is_dirty()
+
+        # touched, and then edited back to how it was
+        cur.execute(f"SELECT name FROM {layer} WHERE {pk}=1;")
+        name = cur.fetchone()[0]
+        with db:
+            cur.execute(f"UPDATE {layer} SET name='test' WHERE {pk}=1;")
+            cur.execute(f"UPDATE {layer} SET name=? WHERE {pk}=1;", [name])
+        assert H.row_count(db, ".sno-track") == 1
+        assert not wc.is_dirty()
+
+        # a geometry which is only encoded differently - sno diff doesn't show it either
+        cur.execute(f"SELECT geom FROM {layer} WHERE {pk}=3;")
+        geom = cur.fetchone()[0]
+        with db:
+            cur.execute(
+                f"UPDATE {layer} SET geom=? WHERE {pk}=3;",
+                [
+                    gpkg.hex_wkb_to_gpkg_geom(
+                        gpkg.gpkg_geom_to_hex_wkb(geom), _add_envelope=True
+                    )
+                ],
+            )
+        assert H.row_count(db, ".sno-track") == 2
+        assert not wc.is_dirty()
+        with db:
+            cur.execute(f"UPDATE {layer} SET geom=? WHERE {pk}=3;", [geom])
+
+        # changed, but not tracked
+        with db:
+            cur.execute(f"UPDATE {layer} SET name='test' WHERE {pk}=2;")
+            cur.execute(""" DELETE FROM ".sno-track"; """)
+        assert not wc.is_dirty()
+
+        assert wc.dirty_buckets(dataset) == {}
+        bucket, name = dataset.feature_bucket(2)
+        dirty_buckets = wc.dirty_buckets(dataset, tracked_only=False)
+        assert list(dirty_buckets.keys()) == [bucket]
+        assert name in dirty_buckets[bucket]
+
+        # only the rows in the buckets of tracked rows are read
+        encoded = []
+        encode_feature_blob = dataset.encode_feature_blob
+
+        def _encode_feature_blob(feature):
+            encoded.append(feature[pk])
+            return encode_feature_blob(feature)
+
+        monkeypatch.setattr(dataset, "encode_feature_blob", _encode_feature_blob)
+        with db:
+            cur.execute(f"UPDATE {layer} SET name='test' WHERE {pk}=5;")
+        bucket, name = dataset.feature_bucket(5)
+        dirty_buckets = wc.dirty_buckets(dataset)
+        assert list(dirty_buckets.keys()) == [bucket]
+        assert name in dirty_buckets[bucket]
+        assert {dataset.feature_bucket(p)[0] for p in encoded} == {bucket}
+        assert len(encoded) == len(dataset.feature_buckets()[bucket])
+
+
+def test_session_connection_pool(data_working_copy, geopackage):
+    with data_working_copy("points") as (repo_dir, wc_path):
+        repo = pygit2.Repository(str(repo_dir))
+        wc = WorkingCopy.open(repo)
+
+        with wc.session() as db1:
+            with wc.session() as db2:
+                assert db2 is db1
+            # a session of another working copy object doesn't get a connection
+            # that's already in use
+            with WorkingCopy.open(repo).session() as db3:
+                assert db3 is not db1
+
+        # the connection is reused by the next session
+        with wc.session() as db2:
+            assert db2 is db1
+
+        # changes made by something else are seen by the next session
+        db = geopackage(wc_path)
+        with db:
+            db.cursor().execute(f"DELETE FROM {H.POINTS.LAYER} WHERE fid=1;")
+        with wc.session() as db2:
+            assert H.row_count(db2, H.POINTS.LAYER) == H.POINTS.ROWCOUNT - 1
+
+
+def test_session_profiles(data_working_copy, cli_runner):
+    with data_working_copy("points") as (repo_dir, wc_path):
+        repo = pygit2.Repository(str(repo_dir))
+        wc = WorkingCopy.open(repo)
+
+        def _cache_size(db):
+            return db.cursor().execute("PRAGMA cache_size;").fetchone()[0]
+
+        assert wc.get_profile("reset", bulk=1) == (
+            "bulk",
+            {"synchronous": "OFF", "cache_size": "-1048576"},
+        )
+
+        repo.config["sno.profile.tiny.cacheSize"] = "-100"
+        repo.config["sno.workingcopy.profile.diff"] = "tiny"
+        assert wc.get_profile("diff") == ("tiny", {"cache_size": "-100"})
+        assert wc.get_profile("commit") == ("default", {})
+
+        with wc.session() as db:
+            default_cache_size = _cache_size(db)
+        with wc.session(operation="diff") as db:
+            assert _cache_size(db) == -100
+        # the pragmas are restored at the end of the session
+        with wc.session() as db:
+            assert _cache_size(db) == default_cache_size
+
+        # built-in profiles can be changed, and used for everything
+        repo.config["sno.profile.server.mmapSize"] = "0"
+        repo.config["sno.workingcopy.profile"] = "server"
+        assert wc.get_profile("checkout", bulk=2) == (
+            "server",
+            {"synchronous": "NORMAL", "mmap_size": "0", "journal_mode": "WAL"},
+        )
+
+        repo.config["sno.workingcopy.profile.diff"] = "nope"
+        r = cli_runner.invoke(["diff"])
+        assert r.exit_code == INVALID_OPERATION, r
+
+
+def test_checkout_bbox(data_working_copy, geopackage, cli_runner, tmp_path):
+    layer = H.POINTS.LAYER
+    pk = H.POINTS.LAYER_PK
+
+    def _matching_pks(features, bbox):
+        spatial_filter = SpatialFilter(bbox)
+        return sorted(
+            feature_pk
+            for feature_pk, geom in features
+            if spatial_filter.matches_envelope(gpkg.geom_envelope(geom))
+        )
+
+    with data_working_copy("points") as (repo_dir, wc_path):
+        repo = pygit2.Repository(str(repo_dir))
+
+        # a bounding box around the first feature and its neighbours
+        cur = geopackage(wc_path).cursor()
+        cur.execute(f"SELECT geom FROM {layer} WHERE {pk}=1;")
+        min_x, max_x, min_y, max_y = gpkg.geom_envelope(cur.fetchone()[0])
+        bbox = (min_x - 5000, min_y - 5000, max_x + 5000, max_y + 5000)
+        bbox_arg = ",".join(str(c) for c in bbox)
+
+        r = cli_runner.invoke(["checkout", "--bbox", bbox_arg])
+        assert r.exit_code == INVALID_OPERATION, r
+
+        H.clear_working_copy()
+        new_path = tmp_path / "bbox.gpkg"
+        r = cli_runner.invoke(["checkout", "--bbox", bbox_arg, f"--path={new_path}"])
+        assert r.exit_code == 0, r
+
+        wc = WorkingCopy.open(repo)
+        assert wc.get_bbox() == bbox
+        assert not wc.is_dirty()
+
+        def _wc_pks():
+            cur = geopackage(new_path).cursor()
+            cur.execute(f"SELECT {pk} FROM {layer} ORDER BY {pk};")
+            return [row[0] for row in cur]
+
+        head = repo.head.peel(pygit2.Commit)
+        for commit in [head, head.parents[0]]:
+            if commit.id != head.id:
+                r = cli_runner.invoke(["checkout", commit.hex])
+                assert r.exit_code == 0, r
+
+            dataset = RepositoryStructure(repo, commit=commit)[layer]
+            expected_pks = _matching_pks(dataset.feature_tuples([pk, "geom"]), bbox)
+            assert 0 < len(expected_pks) < H.POINTS.ROWCOUNT
+            assert _wc_pks() == expected_pks